@@ -0,0 +1,323 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+"""
+Host-side caches shared by all environments, kept under
+~/.datacats/cache
+"""
+
+import os
+from os import path
+import errno
+import fcntl
+import shutil
+from tempfile import mkdtemp
+
+from datacats import docker
+
+CACHE_DIR = '~/.datacats/cache'
+
+# Directories copied out of preload images are cached per image ID in
+# CACHE_DIR/preload/<image id>/<directory>, set this to the cache size in
+# MB, or 0 to disable the cache
+PRELOAD_CACHE_SIZE_ENV = 'DATACATS_PRELOAD_CACHE_MB'
+DEFAULT_PRELOAD_CACHE_MB = 4096
+# Set this to clone cached directories into new environments with
+# hardlinks when reflinks aren't supported. Saves space and time but
+# changing a file in place (not replacing it) changes it for every
+# environment using the same cache entry, so files that are changed in
+# place or given another owner are still copied.
+PRELOAD_HARDLINK_ENV = 'DATACATS_PRELOAD_HARDLINK'
+# files changed in place rather than replaced, e.g. easy-install.pth by
+# pip install -e
+IN_PLACE_SUFFIXES = ('.pth',)
+
+# pip caches are shared by environments with the same CKAN version in
+# CACHE_DIR/pip/<ckan version>, see "datacats tweak --prune-cache"
+
+# the ioctl(2) request to share one file's data with another copy-on-write,
+# see ioctl_ficlone(2)
+FICLONE = 0x40049409
+# errors from link(2) or FICLONE meaning the method isn't available here
+_CLONE_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL,
+                      errno.ENOTTY, errno.EPERM, errno.EMLINK)
+
+
+def cache_dir(*parts):
+    """
+    Return the path to a directory inside the cache
+    """
+    return path.join(path.expanduser(CACHE_DIR), *parts)
+
+
+def pip_cache_dir(ckan_version):
+    """
+    Return the pip cache directory for environments using ckan_version,
+    creating it if necessary
+    """
+    cache = cache_dir('pip', ckan_version or 'latest')
+    if not path.isdir(cache):
+        os.makedirs(cache)
+    return cache
+
+
+def prune_pip_cache(limit):
+    """
+    Remove the least recently used files from the pip caches until they
+    total no more than limit bytes.
+
+    Returns (number of files removed, bytes removed)
+    """
+    top = cache_dir('pip')
+    files = []
+    for root, _, names in os.walk(top):
+        for name in names:
+            filename = path.join(root, name)
+            st = os.lstat(filename)
+            files.append((max(st.st_atime, st.st_mtime), st.st_size, filename))
+
+    total = sum(size for _, size, _ in files)
+    removed = removed_bytes = 0
+    for _, size, filename in sorted(files):
+        if total <= limit:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+        removed_bytes += size
+
+    # leave the per-version directories for pip_cache_dir
+    for root, _, _ in os.walk(top, topdown=False):
+        if root == top or path.dirname(root) == top:
+            continue
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+    return removed, removed_bytes
+
+
+def preload_cache_bytes():
+    """
+    Return the preload cache size limit in bytes, 0 if it is disabled
+    """
+    try:
+        megabytes = int(os.environ.get(PRELOAD_CACHE_SIZE_ENV,
+                                       DEFAULT_PRELOAD_CACHE_MB))
+    except ValueError:
+        megabytes = DEFAULT_PRELOAD_CACHE_MB
+    return max(megabytes, 0) * 1024 * 1024
+
+
+def _entry_name(image_path):
+    return image_path.strip('/').replace('/', '_')
+
+
+def _tree_size(top):
+    total = 0
+    for root, dirs, files in os.walk(top):
+        for name in dirs + files:
+            total += os.lstat(path.join(root, name)).st_size
+    return total
+
+
+def _entry_size(entry):
+    total = 0
+    for name in os.listdir(entry):
+        try:
+            with open(path.join(entry, name, '.size')) as f:
+                total += int(f.read())
+        except (IOError, ValueError):
+            pass
+    return total
+
+
+def _remove_entry(entry):
+    # rename first so a half removed entry is never used
+    doomed = entry + '.removing-{0}'.format(os.getpid())
+    try:
+        os.rename(entry, doomed)
+    except OSError:
+        return
+    shutil.rmtree(doomed, ignore_errors=True)
+
+
+def preload_dirs(image, image_paths):
+    """
+    Return {path in image: cache directory with a copy of it} for the
+    directories image_paths inside image, copying the ones not cached yet
+    out of the image first. Entries for older versions of image are
+    removed and the least recently used entries are evicted to keep the
+    cache under its size limit.
+
+    Returns None when the cache is disabled or image isn't available
+    locally, callers should copy from the image directly.
+    """
+    limit = preload_cache_bytes()
+    if not limit:
+        return None
+    image_id = docker.image_id(image)
+    if not image_id:
+        return None
+    top = cache_dir('preload')
+    entry = path.join(top, image_id.split(':')[-1])
+    if not path.isdir(entry):
+        os.makedirs(entry)
+    with open(path.join(entry, '.image'), 'w') as f:
+        f.write(image)
+
+    result = dict((p, path.join(entry, _entry_name(p))) for p in image_paths)
+    missing = [p for p in image_paths if not path.isdir(result[p])]
+    if missing:
+        staging = dict((p, mkdtemp(dir=entry, prefix='.extracting-'))
+                       for p in missing)
+        try:
+            docker.extract_from_image(image, staging)
+            for p, tmp in staging.iteritems():
+                with open(path.join(tmp, '.size'), 'w') as f:
+                    f.write(str(_tree_size(tmp)))
+                try:
+                    os.rename(tmp, result[p])
+                except OSError:
+                    # another datacats process cached it first
+                    pass
+        finally:
+            for tmp in staging.values():
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    # mark this entry as most recently used
+    os.utime(entry, None)
+    _prune_preload_cache(top, entry, image, limit)
+    return result
+
+
+def _prune_preload_cache(top, keep, image, limit):
+    """
+    Remove entries for other versions of image (they can't be used again
+    once the image is replaced) then the least recently used entries
+    until the cache is no larger than limit bytes, never removing keep.
+    """
+    entries = []
+    for name in os.listdir(top):
+        entry = path.join(top, name)
+        if entry == keep or '.' in name or not path.isdir(entry):
+            continue
+        try:
+            with open(path.join(entry, '.image')) as f:
+                entry_image = f.read()
+        except IOError:
+            entry_image = None
+        if entry_image == image:
+            _remove_entry(entry)
+            continue
+        entries.append((os.stat(entry).st_mtime, entry))
+
+    total = _entry_size(keep) + sum(_entry_size(e) for _, e in entries)
+    for _, entry in sorted(entries):
+        if total <= limit:
+            break
+        total -= _entry_size(entry)
+        _remove_entry(entry)
+
+
+def _linkable(source, owner):
+    """
+    Return True if a hardlink to source can be given to owner and used
+    without changing the cached source file
+    """
+    if source.endswith(IN_PLACE_SUFFIXES):
+        return False
+    if owner is None:
+        return True
+    st = os.lstat(source)
+    return (st.st_uid, st.st_gid) == tuple(owner)
+
+
+class _Cloner(object):
+    """
+    Copies files with the first method of reflink, hardlink (if allowed)
+    and a plain copy that works on this filesystem
+    """
+    def __init__(self, hardlink):
+        self.methods = ['reflink'] + (['hardlink'] if hardlink else []) + ['copy']
+
+    def clone(self, src, dst):
+        while True:
+            method = self.methods[0]
+            try:
+                if method == 'copy':
+                    shutil.copy2(src, dst)
+                elif method == 'hardlink':
+                    os.link(src, dst)
+                else:
+                    _reflink(src, dst)
+                return
+            except (IOError, OSError) as e:
+                if method == 'copy' or e.errno not in _CLONE_UNSUPPORTED:
+                    raise
+                self.methods.pop(0)
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except (IOError, OSError):
+                os.remove(dst)
+                raise
+    shutil.copystat(src, dst)
+
+
+def clone_tree(src, dst, owner=None, hardlink=None):
+    """
+    Copy the contents of directory src into directory dst as cheaply as
+    the filesystem allows: reflinks where supported, otherwise hardlinks
+    (only when hardlink is True or PRELOAD_HARDLINK_ENV is set) or plain
+    copies. Files that would change the linked src file when given to
+    owner or changed in place are never hardlinked.
+
+    :param owner: (uid, gid) to give the copied files, or None to leave
+                  them owned by the current user
+    """
+    if hardlink is None:
+        hardlink = bool(os.environ.get(PRELOAD_HARDLINK_ENV))
+    linker = _Cloner(hardlink)
+    copier = _Cloner(False)
+    if not path.isdir(dst):
+        os.makedirs(dst)
+
+    def chown(target):
+        if owner is not None:
+            os.lchown(target, *owner)
+
+    for root, dirs, files in os.walk(src):
+        target_root = path.join(dst, path.relpath(root, src))
+        for name in list(dirs):
+            source, target = path.join(root, name), path.join(target_root, name)
+            if path.islink(source):
+                # os.walk doesn't follow it, copy it as a link instead
+                dirs.remove(name)
+                files.append(name)
+                continue
+            if not path.isdir(target):
+                os.mkdir(target)
+            shutil.copystat(source, target)
+            chown(target)
+        for name in files:
+            if root == src and name == '.size':
+                continue
+            source, target = path.join(root, name), path.join(target_root, name)
+            if path.islink(source):
+                os.symlink(os.readlink(source), target)
+            elif hardlink and _linkable(source, owner):
+                linker.clone(source, target)
+            else:
+                copier.clone(source, target)
+            chown(target)
@@ -0,0 +1,271 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+"""
+Recording of the Docker API calls a datacats command makes to a cassette
+file, and replaying them later without Docker so the command's Python
+side can be timed offline and reproducibly.
+
+Set DATACATS_CASSETTE=record:FILE to record, DATACATS_CASSETTE=replay:FILE
+to replay. Replayed calls take as long as they did when recorded, times
+DATACATS_CASSETTE_SCALE (default 1, 0 doesn't wait at all).
+
+Only the API traffic is replayed: files that containers wrote to their
+volumes while recording aren't, and checks that services are up still
+connect to them, so replay commands like info and stop against the same
+environment directories the recording was made with.
+"""
+
+from __future__ import absolute_import
+
+import sys
+import json
+import time
+import base64
+from os import environ
+from StringIO import StringIO
+from collections import Iterator
+from importlib import import_module
+from threading import Lock
+
+from requests.models import Response
+from docker.errors import APIError
+
+from datacats.error import DatacatsError
+
+CASSETTE_ENV = 'DATACATS_CASSETTE'
+CASSETTE_SCALE_ENV = 'DATACATS_CASSETTE_SCALE'
+CASSETTE_VERSION = 1
+
+# the RecordingClient to save when the command finishes
+_recorder = None
+
+
+def from_env():
+    """
+    Return (mode, filename) from DATACATS_CASSETTE, mode is 'record',
+    'replay' or None when it isn't set
+    """
+    value = environ.get(CASSETTE_ENV)
+    if not value:
+        return None, None
+    mode, sep, filename = value.partition(':')
+    if mode not in ('record', 'replay') or not sep or not filename:
+        raise DatacatsError('{0} must be record:FILE or replay:FILE, not "{1}"'
+                            .format(CASSETTE_ENV, value))
+    return mode, filename
+
+
+def scale_from_env():
+    value = environ.get(CASSETTE_SCALE_ENV, '1')
+    try:
+        return float(value)
+    except ValueError:
+        raise DatacatsError('{0} must be a number, not "{1}"'
+                            .format(CASSETTE_SCALE_ENV, value))
+
+
+def client_from_env(make_client):
+    """
+    Return the Docker client to use according to DATACATS_CASSETTE:
+    make_client() recorded, a ReplayClient or make_client() itself
+    """
+    global _recorder
+    mode, filename = from_env()
+    if mode == 'replay':
+        return ReplayClient(filename, scale_from_env())
+    client = make_client()
+    if mode == 'record':
+        _recorder = RecordingClient(client, filename)
+        return _recorder
+    return client
+
+
+def save():
+    """
+    Write the calls recorded by client_from_env, if any, to the cassette
+    """
+    if not _recorder:
+        return
+    try:
+        _recorder.save()
+    except IOError as e:
+        print >> sys.stderr, 'Unable to write cassette: {0}'.format(e)
+
+
+def _key(args, kwargs):
+    # what a replayed call is matched on
+    return json.dumps([args, kwargs], sort_keys=True, default=repr)
+
+
+def _encode(value):
+    if isinstance(value, str):
+        try:
+            return {'text': value.decode('utf-8')}
+        except UnicodeDecodeError:
+            return {'base64': base64.b64encode(value)}
+    if isinstance(value, tuple):
+        return {'tuple': [_encode(v) for v in value]}
+    if hasattr(value, 'read'):
+        return {'file': _encode(value.read())}
+    return {'json': value}
+
+
+def _decode(value):
+    if 'text' in value:
+        return value['text'].encode('utf-8')
+    if 'base64' in value:
+        return base64.b64decode(value['base64'])
+    if 'tuple' in value:
+        return tuple(_decode(v) for v in value['tuple'])
+    if 'file' in value:
+        return StringIO(_decode(value['file']))
+    return value['json']
+
+
+def _encode_error(e):
+    error = {'module': type(e).__module__, 'name': type(e).__name__,
+             'message': str(e)}
+    if isinstance(e, APIError):
+        error.update(status=e.response.status_code, reason=e.response.reason,
+                     explanation=e.explanation)
+    return error
+
+
+def _decode_error(error):
+    try:
+        cls = getattr(import_module(error['module']), error['name'])
+    except (ImportError, AttributeError):
+        cls = Exception
+    if issubclass(cls, APIError):
+        response = Response()
+        response.status_code = error['status']
+        response.reason = error['reason']
+        response._content = ''
+        return cls(error['message'], response, error['explanation'])
+    return cls(error['message'])
+
+
+class RecordingClient(object):
+    """
+    Wraps a docker-py Client to record every method call made on it,
+    write them to filename with save()
+    """
+    def __init__(self, client, filename):
+        self._client = client
+        self.filename = filename
+        self.calls = []
+        self._lock = Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._call(name, attr, args, kwargs)
+        return call
+
+    def _call(self, name, fn, args, kwargs):
+        record = {'method': name, 'key': _key(args, kwargs)}
+        with self._lock:
+            self.calls.append(record)
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            record['seconds'] = time.time() - start
+            record['error'] = _encode_error(e)
+            raise
+        record['seconds'] = time.time() - start
+        if isinstance(result, Iterator):
+            record['stream'] = []
+            return self._stream(record['stream'], result)
+        record['result'] = _encode(result)
+        # file-like results have been read by _encode
+        return _decode(record['result'])
+
+    def _stream(self, chunks, result):
+        last = time.time()
+        for chunk in result:
+            chunks.append((time.time() - last, _encode(chunk)))
+            last = time.time()
+            yield chunk
+
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump({
+                'version': CASSETTE_VERSION,
+                'api_version': self._client.api_version,
+                'calls': self.calls,
+                }, f, indent=1)
+
+
+class ReplayClient(object):
+    """
+    Stands in for a docker-py Client, answering each method call with
+    the result of a matching call in the cassette filename. Calls are
+    matched by method and arguments, or by method alone in the order they
+    were recorded when the arguments differ (eg. temporary directories).
+
+    :param scale: multiplies the recorded time of each call
+    """
+    def __init__(self, filename, scale=1):
+        try:
+            with open(filename) as f:
+                cassette = json.load(f)
+        except (IOError, ValueError) as e:
+            raise DatacatsError('Unable to read cassette {0}: {1}'.format(filename, e))
+        if cassette.get('version') != CASSETTE_VERSION:
+            raise DatacatsError('Cassette {0} was recorded by a different version'
+                                ' of datacats'.format(filename))
+        self.filename = filename
+        self.scale = scale
+        self.api_version = cassette['api_version']
+        # {method: [recorded calls not replayed yet]}
+        self._calls = {}
+        for record in cassette['calls']:
+            self._calls.setdefault(record['method'], []).append(record)
+        self._lock = Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self._replay(name, _key(args, kwargs))
+        return call
+
+    def unplayed(self):
+        """
+        Return the number of recorded calls not replayed yet
+        """
+        return sum(len(calls) for calls in self._calls.itervalues())
+
+    def _next(self, name, key):
+        with self._lock:
+            calls = self._calls.get(name)
+            if not calls:
+                raise DatacatsError('No more {0} calls recorded in cassette {1}'
+                                    .format(name, self.filename))
+            for i, record in enumerate(calls):
+                if record['key'] == key:
+                    return calls.pop(i)
+            return calls.pop(0)
+
+    def _replay(self, name, key):
+        record = self._next(name, key)
+        time.sleep(record['seconds'] * self.scale)
+        if 'error' in record:
+            raise _decode_error(record['error'])
+        if 'stream' in record:
+            return self._stream(record['stream'])
+        return _decode(record['result'])
+
+    def _stream(self, chunks):
+        for delay, chunk in chunks:
+            time.sleep(delay * self.scale)
+            yield _decode(chunk)
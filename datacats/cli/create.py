@@ -11,6 +11,7 @@ from datacats.environment import Environment
 from datacats.cli.install import install_all, clean_pyc
 from datacats.error import DatacatsError
 from datacats.docker import is_boot2docker
+from datacats.parallel import Step, run_steps
 
 from datacats.cli.util import y_or_n_prompt, confirm_password
 
@@ -26,7 +27,7 @@ def create(opts):
 Usage:
   datacats create [-bin] [--interactive] [-s NAME] [--address=IP] [--syslog]
                   [--ckan=CKAN_VERSION] [--no-datapusher] [--site-url SITE_URL]
-                  [--no-init-db] ENVIRONMENT_DIR [PORT]
+                  [--no-init-db] [--timings] ENVIRONMENT_DIR [PORT]
 
 Options:
   --address=IP            Address to listen on (Linux-only)
@@ -40,9 +41,18 @@ Options:
   -s --site=NAME          Pick a site to create [default: primary]
   --site-url SITE_URL     The site_url to use in API responses (e.g. http://example.org:{port}/)
   --syslog                Log to the syslog
+  --timings               Show how long each step of creating the environment took
 
 ENVIRONMENT_DIR is a path for the new environment directory. The last
 part of this path will be used as the environment name.
+
+The virtualenv and source for new environments are cached in
+~/.datacats/cache/preload. Set DATACATS_PRELOAD_CACHE_MB to limit its
+size (0 disables it) and DATACATS_PRELOAD_HARDLINK=1 to hardlink files
+from the cache on filesystems without reflinks.
+
+Set DATACATS_WEB_WORKER=1 to run setup steps in one long-lived web
+container per environment instead of a new container for each step.
 """
     if opts['--address'] and is_boot2docker():
         raise DatacatsError('Cannot specify address on boot2docker.')
@@ -60,13 +70,14 @@ part of this path will be used as the environment name.
         site_url=opts['--site-url'],
         interactive=opts['--interactive'],
         init_db=not opts['--no-init-db'],
+        timings=opts['--timings'],
         )
 
 
 def create_environment(environment_dir, port, ckan_version, create_skin,
         site_name, start_web, create_sysadmin, address, log_syslog=False,
         datapusher=True, quiet=False, site_url=None, interactive=False,
-        init_db=True):
+        init_db=True, timings=False):
 
     if not init_db:
         print 'Since the database will not be initialized, we will not copy datapusher.'
@@ -80,32 +91,42 @@ def create_environment(environment_dir, port, ckan_version, create_skin,
 
         if not quiet:
             write('Creating environment "{0}/{1}"'.format(environment.name, environment.site_name))
+        # Steps run as soon as the steps they require are done, so e.g. the
+        # environment is saved while the virtualenv and source are copied
         steps = [
-            lambda: environment.create_directories(making_full_environment),
-            environment.create_bash_profile
-            ] + \
-            ([
-                environment.create_virtualenv,
-                environment.save,
-                lambda: environment.create_source(datapusher),
-                environment.create_ckan_ini] if making_full_environment else []
-            ) + \
-            [
-                environment.save_site,
-                environment.start_supporting_containers,
-                environment.fix_storage_permissions,
-                lambda: environment.update_ckan_ini(skin=create_skin),
+            Step('directories', lambda: environment.create_directories(
+                making_full_environment)),
+            Step('bash_profile', environment.create_bash_profile, ['directories']),
+            Step('storage_permissions', environment.fix_storage_permissions,
+                 ['directories']),
+            ]
+        saved = source = ckan_ini = ['directories']
+        if making_full_environment:
+            steps += [
+                Step('preload', lambda: environment.create_virtualenv_and_source(
+                    datapusher), ['directories']),
+                Step('save', environment.save, ['directories']),
+                Step('ckan_ini', environment.create_ckan_ini, ['preload']),
+                ]
+            saved, source, ckan_ini = ['save'], ['preload'], ['ckan_ini']
+        steps += [
+            Step('save_site', environment.save_site, saved),
+            # solr needs schema.xml from the source
+            Step('supporting_containers', environment.start_supporting_containers,
+                 source),
+            Step('update_ckan_ini',
+                 lambda: environment.update_ckan_ini(skin=create_skin), ckan_ini),
             ]
-
         if create_skin and making_full_environment:
-            steps.append(environment.create_install_template_skin)
+            steps.append(Step('skin', environment.create_install_template_skin,
+                              ['update_ckan_ini']))
 
-        for fn in steps:
-            fn()
-            if not quiet:
-                write('.')
+        step_timings = run_steps(
+            steps, on_done=None if quiet else lambda name: write('.'))
         if not quiet:
             write('\n')
+        if timings:
+            _print_timings(step_timings)
 
         return finish_init(environment, start_web, create_sysadmin,
                            log_syslog=log_syslog, site_url=site_url,
@@ -119,6 +140,12 @@ def create_environment(environment_dir, port, ckan_version, create_skin,
         raise
 
 
+def _print_timings(step_timings):
+    width = max(len(name) for name, _ in step_timings)
+    for name, seconds in sorted(step_timings, key=lambda t: -t[1]):
+        print '{0:<{1}}  {2:6.2f}s'.format(name, width, seconds)
+
+
 def reset(environment, opts):
     """Resets a site to the default state. This will re-initialize the
 database and recreate the administrator account.
@@ -248,7 +275,8 @@ def finish_init(environment, start_web, create_sysadmin, log_syslog=False,
         create_sysadmin = False
 
     if do_install:
-        install_all(environment, False, verbose=False, quiet=quiet)
+        # the virtualenv is new, whatever an old manifest says
+        install_all(environment, False, verbose=False, quiet=quiet, force=True)
 
     if init_db:
         if not quiet:
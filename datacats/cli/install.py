@@ -5,8 +5,8 @@
 # See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
 
 import sys
-from os import listdir, walk, remove
-from os.path import isdir, exists, join
+from os import listdir
+from os.path import isdir, exists
 from datacats.docker import container_logs
 
 from clint.textui import colored
@@ -21,23 +21,40 @@ def install(environment, opts):
     """Install or reinstall Python packages within this environment
 
 Usage:
-  datacats install [-q] [--address=IP] [ENVIRONMENT [PACKAGE ...]]
-  datacats install -c [q] [--address=IP] [ENVIRONMENT]
+  datacats install [-bfq] [--address=IP] [--wheelhouse=DIR] [ENVIRONMENT [PACKAGE ...]]
+  datacats install -c [bq] [--address=IP] [--wheelhouse=DIR] [ENVIRONMENT]
 
 Options:
   --address=IP          The address to bind to when reloading after install
+  -b --batch            Install all packages and their requirements with a
+                        single pip command in one container
   -c --clean            Reinstall packages into a clean virtualenv
+  -f --force            Reinstall packages even if their setup.py, setup.cfg
+                        and requirements files haven't changed
   -q --quiet            Do not show output from installing packages and requirements.
+  --wheelhouse=DIR      Install offline using only the wheels in DIR instead of
+                        downloading packages
+
+Only packages changed since they were last installed are installed, and
+running sites are reloaded only if something was installed.
+
+Downloaded and built packages are cached in ~/.datacats/cache/pip and
+shared with other environments using the same CKAN version.
+
+Set DATACATS_WEB_WORKER=1 to run the install steps in one long-lived web
+container per environment instead of a new container for each step.
 
 ENVIRONMENT may be an environment name or a path to an environment directory.
 Default: '.'
 """
     environment.require_data()
-    install_all(environment, opts['--clean'], verbose=not opts['--quiet'],
-        packages=opts['PACKAGE'])
+    installed = install_all(environment, opts['--clean'], verbose=not opts['--quiet'],
+        packages=opts['PACKAGE'], wheelhouse=opts['--wheelhouse'],
+        batch=opts['--batch'], force=opts['--force'])
+    if not installed:
+        return
 
-    for site in environment.sites:
-        environment = Environment.load(environment.name, site)
+    for _, environment in sorted(Environment.load_all_sites(environment.name).items()):
         if 'web' in environment.containers_running():
             # FIXME: reload without changing debug setting?
             manage.reload_(environment, {
@@ -48,7 +65,9 @@ Default: '.'
                 'PORT': None,
                 '--syslog': False,
                 '--site-url': None,
-                '--interactive': False
+                '--interactive': False,
+                '--exec': environment.web_shell_available(),
+                '--timings': False,
                 })
 
 
@@ -56,20 +75,20 @@ def clean_pyc(environment, quiet=False):
     if not quiet:
         print 'Cleaning environment {} of pyc files...'.format(environment.name)
 
-    for root, _, files in walk(environment.target):
-        for f in files:
-            if f.endswith('.pyc'):
-                remove(join(root, f))
-
+    removed, seconds = environment.clean_pyc()
+    if not quiet:
+        print 'Removed {0} pyc files in {1:.2f}s'.format(len(removed), seconds)
 
-def install_all(environment, clean, verbose=False, quiet=False, packages=None):
-    logs = check_connectivity()
-    if logs.strip():
-        raise DatacatsError(logs)
 
-    if clean:
-        clean_pyc(environment, quiet)
+def install_all(environment, clean, verbose=False, quiet=False, packages=None,
+                wheelhouse=None, batch=False, force=False):
+    """
+    Install the packages in environment (or only those named in packages)
+    and their requirements, skipping packages that haven't changed since
+    they were last installed unless clean or force are set.
 
+    Returns the list of packages installed.
+    """
     srcdirs = set()
     reqdirs = set()
     for d in listdir(environment.target):
@@ -94,16 +113,52 @@ def install_all(environment, clean, verbose=False, quiet=False, packages=None):
     except KeyError:
         raise DatacatsError('ckan not found in environment directory')
 
+    hashes = environment.package_install_hashes(srcdirs)
+    if not (clean or force):
+        installed = environment.installed_package_hashes()
+        srcdirs = [d for d in srcdirs if installed.get(d) != hashes[d]]
+        reqdirs = [d for d in reqdirs if installed.get(d) != hashes[d]]
+        if not srcdirs:
+            if not quiet:
+                print 'Packages unchanged since last install, use --force to reinstall'
+            return []
+
+    if wheelhouse:
+        if not isdir(wheelhouse):
+            raise DatacatsError('Wheelhouse directory {0} not found'.format(wheelhouse))
+    else:
+        logs = check_connectivity()
+        if logs.strip():
+            raise DatacatsError(logs)
+
     if clean:
+        clean_pyc(environment, quiet)
         environment.clean_virtualenv()
-        environment.install_extra()
+        environment.install_extra(wheelhouse)
+
+    if batch:
+        # ckan first so its pins win, see task.merge_requirements
+        srcdirs = sorted(srcdirs, key=lambda d: (d != 'ckan', d))
+        reqdirs = sorted(reqdirs, key=lambda d: (d != 'ckan', d))
+        if verbose:
+            print colored.yellow('Installing ' + ', '.join(srcdirs) + '\n')
+        elif not quiet:
+            print 'Installing ' + ', '.join(srcdirs)
+        environment.install_packages(
+            srcdirs, reqdirs, sys.stdout if verbose and not quiet else None, wheelhouse)
+        if verbose and not quiet:
+            print
+        environment.record_installed_packages(
+            dict((d, hashes[d]) for d in srcdirs), clean)
+        return srcdirs
 
     for s in srcdirs:
         if verbose:
             print colored.yellow('Installing ' + s + '\n')
         elif not quiet:
             print 'Installing ' + s
-        environment.install_package_develop(s, sys.stdout if verbose and not quiet else None)
+        environment.install_package_develop(
+            s, sys.stdout if verbose and not quiet else None, wheelhouse)
         if verbose and not quiet:
             print
     for s in reqdirs:
@@ -111,9 +166,13 @@ def install_all(environment, clean, verbose=False, quiet=False, packages=None):
             print colored.yellow('Installing ' + s + ' requirements' + '\n')
         elif not quiet:
             print 'Installing ' + s + ' requirements'
-        environment.install_package_requirements(s, sys.stdout if verbose and not quiet else None)
+        environment.install_package_requirements(
+            s, sys.stdout if verbose and not quiet else None, wheelhouse)
         if verbose:
             print
+    environment.record_installed_packages(
+        dict((d, hashes[d]) for d in srcdirs), clean)
+    return srcdirs
 
 
 def _print_logs(c_id):
@@ -38,43 +38,50 @@ arguments available to each command.
 
 import sys
 import traceback
+from importlib import import_module
 from docopt import docopt
-from datacats.cli import (create, manage, install, pull, purge, shell, deploy,
-    migrate, less)
-from datacats.environment import Environment
 from datacats.error import DatacatsError, UndocumentedError
-from datacats.userprofile import UserProfile
 from datacats.version import __version__
+from datacats import tracing
 
+DEFAULT_PROFILE_FILE = 'datacats-profile.json'
 
+
+# command: (module in datacats.cli, function). Modules are only imported
+# when their command runs, they pull in docker-py, requests etc.
 COMMANDS = {
-    'create': create.create,
-    'deploy': deploy.deploy,
-    'info': manage.info,
-    'init': create.init,
-    'install': install.install,
-    'list': manage.list_,
-    'logs': manage.logs,
-    'open': manage.open_,
-    'paster': shell.paster,
-    'pull': pull.pull,
-    'purge': purge.purge,
-    'reload': manage.reload_,
-    'shell': shell.shell,
-    'start': manage.start,
-    'stop': manage.stop,
-    'migrate': migrate.migrate,
-    'less': less.less,
-    'reset': create.reset,
-    'tweak': manage.tweak,
+    'create': ('create', 'create'),
+    'deploy': ('deploy', 'deploy'),
+    'info': ('manage', 'info'),
+    'init': ('create', 'init'),
+    'install': ('install', 'install'),
+    'list': ('manage', 'list_'),
+    'logs': ('manage', 'logs'),
+    'open': ('manage', 'open_'),
+    'paster': ('shell', 'paster'),
+    'pull': ('pull', 'pull'),
+    'purge': ('purge', 'purge'),
+    'reload': ('manage', 'reload_'),
+    'shell': ('shell', 'shell'),
+    'start': ('manage', 'start'),
+    'stop': ('manage', 'stop'),
+    'migrate': ('migrate', 'migrate'),
+    'less': ('less', 'less'),
+    'reset': ('create', 'reset'),
+    'tweak': ('manage', 'tweak'),
 }
 
 
 COMMANDS_THAT_USE_SSH = [
-    deploy.deploy
+    'deploy'
 ]
 
 
+def _command_function(command):
+    module, function = COMMANDS[command]
+    return getattr(import_module('datacats.cli.' + module), function)
+
+
 def main():
     """
     The main entry point for datacats cli tool
@@ -84,22 +91,30 @@ def main():
     and runs the corresponding command
     """
     # pylint: disable=bare-except
+    args, profile_file = _profile_argument(sys.argv[1:])
+    if profile_file:
+        tracing.enable()
     try:
-        command_fn, opts = _parse_arguments(sys.argv[1:])
+        command, command_fn, opts = _parse_arguments(args)
         # purge handles loading differently
         # 1 - Bail and just call the command if it doesn't have ENVIRONMENT.
-        if command_fn == purge.purge or 'ENVIRONMENT' not in opts:
+        if command == 'purge' or 'ENVIRONMENT' not in opts:
             return command_fn(opts)
+        # 2 - tweak --prune-cache only touches the cache shared by all of them
+        if command == 'tweak' and opts['--prune-cache']:
+            return command_fn(None, opts)
 
+        from datacats.environment import Environment
         environment = Environment.load(
             opts['ENVIRONMENT'] or '.',
             opts['--site'] if '--site' in opts else 'primary')
 
-        if command_fn not in COMMANDS_THAT_USE_SSH:
+        if command not in COMMANDS_THAT_USE_SSH:
             return command_fn(environment, opts)
 
         # for commands that communicate with a remote server
         # we load UserProfile and test our communication
+        from datacats.userprofile import UserProfile
         user_profile = UserProfile()
         user_profile.test_ssh_key(environment)
 
@@ -110,6 +125,15 @@ def main():
     except SystemExit:
         raise
     except:
+        docker = sys.modules.get('datacats.docker')
+        requests = sys.modules.get('requests')
+        if docker and requests and isinstance(sys.exc_info()[1], requests.ConnectionError):
+            # the saved Docker API version may be out of date, check next time
+            try:
+                docker.forget_handshake()
+            except DatacatsError as e:
+                _error_exit(e)
+            _error_exit(DatacatsError(docker.DOCKER_FAIL_STRING))
         exc_info = "\n".join([line.rstrip()
             for line in traceback.format_exception(*sys.exc_info())])
         user_message = ("Something that should not"
@@ -126,6 +150,40 @@ def main():
 
         _error_exit(DatacatsError(user_message,
             parent_exception=UndocumentedError(exc_info)))
+    finally:
+        # nothing to clean up if docker was never used
+        docker = sys.modules.get('datacats.docker')
+        if docker:
+            # images committed along the way are only intermediate steps
+            docker.remove_committed_images()
+            docker.stop_web_workers()
+        cassette = sys.modules.get('datacats.cassette')
+        if cassette:
+            cassette.save()
+        if profile_file:
+            _write_profile(profile_file)
+
+
+def _profile_argument(args):
+    """
+    Return (args without a leading --profile option, trace file name or
+    None if it wasn't given)
+    """
+    if args and args[0] == '--profile':
+        return args[1:], DEFAULT_PROFILE_FILE
+    if args and args[0].startswith('--profile='):
+        return args[1:], args[0][len('--profile='):]
+    return args, None
+
+
+def _write_profile(filename):
+    try:
+        tracing.write_trace(filename)
+    except IOError as e:
+        print >> sys.stderr, 'Unable to write profile: {0}'.format(e)
+    else:
+        print >> sys.stderr, 'Profile written to {0}'.format(filename)
+    print >> sys.stderr, tracing.summary()
 
 
 def _error_exit(exception):
@@ -146,11 +204,11 @@ def _parse_arguments(args):
         # if above didn't exit, this certainly will
         return docopt(__doc__, ['--help'])
 
-    command_fn = COMMANDS[command]
+    command_fn = _command_function(command)
 
     opts = docopt(command_fn.__doc__, args, version=__version__)
 
-    return command_fn, opts
+    return command, command_fn, opts
 
 
 def _subcommand_arguments(args):
@@ -8,9 +8,13 @@ from os import listdir
 from os.path import expanduser
 import webbrowser
 import sys
+import re
+import time
 
 from datacats.error import DatacatsError
 from datacats.docker import is_boot2docker
+from datacats.validate import RESERVED_NAMES
+from datacats.cache import prune_pip_cache
 from datacats.cli.util import require_extra_image
 from datacats.task import EXTRA_IMAGE_MAPPING
 from datacats.cli.util import confirm_password
@@ -22,34 +26,38 @@ def write(s):
 
 
 def stop(environment, opts):
-    # pylint: disable=unused-argument
     """Stop serving environment and remove all its containers
 
 Usage:
-  datacats stop [-r] [-s NAME] [ENVIRONMENT]
+  datacats stop [-r] [-s NAME] [--fast] [ENVIRONMENT]
 
 Options:
   -s --site=NAME    Specify a site to stop. [default: primary]
+  --fast            Give solr and extra containers one second to shut down
+                    before killing them, postgres still shuts down cleanly
 
 ENVIRONMENT may be an environment name or a path to an environment directory.
 Default: '.'
 """
-    environment.stop_ckan()
-    environment.stop_supporting_containers()
+    environment.stop(fast=opts['--fast'])
 
 
 def start(environment, opts):
     """Create containers and start serving environment
 
 Usage:
-  datacats start [-b] [--site-url SITE_URL] [-p|--no-watch] [-s NAME]
-                 [-i] [--syslog] [--address=IP] [ENVIRONMENT [PORT]]
+  datacats start [-b] [--site-url SITE_URL] [-p|--no-watch] [-s NAME] [--exec]
+                 [-i] [--syslog] [--timings] [--address=IP] [ENVIRONMENT [PORT]]
   datacats start -r [-b] [--site-url SITE_URL] [-s NAME] [--syslog]
-                 [-i] [--address=IP] [ENVIRONMENT]
+                 [-i] [--timings] [--address=IP] [ENVIRONMENT]
 
 Options:
   --address=IP          Address to listen on (Linux-only)
   -b --background       Don't wait for response from web server
+  --exec                Mount the source and virtualenv writable in the web
+                        container, so shell and paster run in it instead of
+                        starting a new container. The running site can then
+                        change them, and test.ini is written on every start
   --no-watch            Do not automatically reload templates and .py files on change
   -i --interactive      Calls out to docker via the command line, allowing
                         for interactivity with the web image.
@@ -58,6 +66,7 @@ Options:
   --syslog              Log to the syslog
   --site-url SITE_URL   The site_url to use in API responses. Defaults to old setting or
                         will attempt to determine it. (e.g. http://example.org:{port}/)
+  --timings             Show how long each supporting container took to start
 
 ENVIRONMENT may be an environment name or a path to an environment directory.
 Default: '.'
@@ -76,9 +85,9 @@ def reload_(environment, opts):
 
 Usage:
   datacats reload [-b] [-p|--no-watch] [--syslog] [-s NAME] [--site-url=SITE_URL]
-                            [-i] [--address=IP] [ENVIRONMENT [PORT]]
+                            [-i] [--exec] [--timings] [--address=IP] [ENVIRONMENT [PORT]]
   datacats reload -r [-b] [--syslog] [-s NAME] [--address=IP] [--site-url=SITE_URL]
-                            [-i] [ENVIRONMENT]
+                            [-i] [--timings] [ENVIRONMENT]
 
 Options:
   --address=IP          Address to listen on (Linux-only)
@@ -87,10 +96,13 @@ Options:
   --site-url=SITE_URL   The site_url to use in API responses. Can use Python template syntax
                         to insert the port and address (e.g. http://example.org:{port}/)
   -b --background       Don't wait for response from web server
+  --exec                Mount the source and virtualenv writable in the web
+                        container for shell and paster, see "datacats start"
   --no-watch            Do not automatically reload templates and .py files on change
   -p --production       Reload with apache and debug=false
   -s --site=NAME        Specify a site to reload [default: primary]
   --syslog              Log to the syslog
+  --timings             Show how long each supporting container took to start
 
 ENVIRONMENT may be an environment name or a path to an environment directory.
 Default: '.'
@@ -122,13 +134,18 @@ Default: '.'
         require_extra_image(EXTRA_IMAGE_MAPPING[container])
 
     environment.stop_supporting_containers()
-    environment.start_supporting_containers()
+    timings = environment.start_supporting_containers(
+        wait=not opts['--background'])
+    if opts['--timings']:
+        for container in sorted(timings, key=timings.get):
+            write('{0:>12}: {1:.2f}s\n'.format(container, timings[container]))
 
     environment.start_ckan(
         production=opts['--production'],
         paster_reload=not opts['--no-watch'],
         log_syslog=opts['--syslog'],
-        interactive=opts['--interactive'])
+        interactive=opts['--interactive'],
+        shell=opts['--exec'])
     write('Starting web server at {0} ...'.format(environment.web_address()))
     if opts['--background']:
         write('\n')
@@ -198,7 +215,7 @@ Usage:
   datacats list
 """
     for p in sorted(listdir(expanduser('~/.datacats'))):
-        if p == 'user-profile':
+        if p == 'user-profile' or p in RESERVED_NAMES:
             continue
         print p
 
@@ -209,8 +226,11 @@ def logs(environment, opts):
 Usage:
   datacats logs [--postgres | --solr | --datapusher] [-s NAME] [-tr] [--tail=LINES] [ENVIRONMENT]
   datacats logs -f [--postgres | --solr | --datapusher] [-s NAME] [-r] [ENVIRONMENT]
+  datacats logs --all -f [-s NAME] [-r] [--since=WHEN] [--grep=PATTERN] [ENVIRONMENT]
 
 Options:
+  --all              Follow the logs of all this site's containers together,
+                     each line prefixed with its container and time
   --datapusher       Show logs for datapusher instead of web logs
   --postgres         Show postgres database logs instead of web logs
   -f --follow        Follow logs instead of exiting immediately
@@ -218,10 +238,16 @@ Options:
   -t --timestamps    Add timestamps to log lines
   -s --site=NAME     Specify a site for logs if needed [default: primary]
   --tail=LINES       Number of lines to show [default: all]
+  --since=WHEN       Skip output from before WHEN, a unix timestamp or a
+                     time ago like 30s, 10m, 2h or 1d
+  --grep=PATTERN     Show only lines matching the regular expression PATTERN
 
 ENVIRONMENT may be an environment name or a path to an environment directory.
 Default: '.'
 """
+    if opts['--all']:
+        _follow_all_logs(environment, opts['--since'], opts['--grep'])
+        return
     container = 'web'
     if opts['--solr']:
         container = 'solr'
@@ -244,6 +270,38 @@ Default: '.'
         print
 
 
+SINCE_UNIT_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def _since_timestamp(since):
+    """
+    Return the unix timestamp for a --since value
+    """
+    match = re.match(r'^(\d+)([smhd]?)$', since)
+    if not match:
+        raise DatacatsError('Invalid --since value {0}, use a unix timestamp'
+                            ' or a time ago like 10m'.format(since))
+    number, unit = match.groups()
+    if not unit:
+        return int(number)
+    return int(time.time()) - int(number) * SINCE_UNIT_SECONDS[unit]
+
+
+def _follow_all_logs(environment, since, grep):
+    since = _since_timestamp(since) if since else None
+    try:
+        pattern = re.compile(grep) if grep else None
+    except re.error as e:
+        raise DatacatsError('Invalid --grep pattern: {0}'.format(e))
+
+    try:
+        for container, timestamp, line in environment.follow_all_logs(since, pattern):
+            # RFC 3339 from docker, show only the time to the millisecond
+            write('{0:<10} {1:<12} | {2}'.format(container, timestamp[11:23], line))
+    except KeyboardInterrupt:
+        print
+
+
 def open_(environment, opts):
     # pylint: disable=unused-argument
     """Open web browser window to this environment
@@ -273,17 +331,34 @@ Usage:
   datacats tweak --install-postgis [ENVIRONMENT]
   datacats tweak --add-redis [ENVIRONMENT]
   datacats tweak --admin-password [ENVIRONMENT]
+  datacats tweak --prune-cache [--cache-size=MB]
+  datacats tweak --clean-pyc [--dry-run] [ENVIRONMENT]
 
 Options:
   --install-postgis    Install postgis in ckan database
   --add-redis          Adds redis next time this environment reloads
   -s --site=NAME       Choose a site to tweak [default: primary]
   -p --admin-password  Prompt to change the admin password
+  --prune-cache        Remove the least recently used files from the pip
+                       cache shared by all environments
+  --cache-size=MB      Size to prune the pip cache to [default: 1024]
+  --clean-pyc          Remove .pyc files from the environment directory
+  --dry-run            List the .pyc files instead of removing them
 
 ENVIRONMENT may be an environment name or a path to an environment directory.
 
 Default: '.'
 """
+    if opts['--prune-cache']:
+        # the cache is shared, no environment is loaded for this
+        try:
+            limit = int(opts['--cache-size']) * 1024 * 1024
+        except ValueError:
+            raise DatacatsError('--cache-size must be a number of megabytes')
+        removed, removed_bytes = prune_pip_cache(limit)
+        print 'Removed {0} files ({1:.1f} MB) from the pip cache'.format(
+            removed, removed_bytes / 1024.0 / 1024)
+        return
 
     environment.require_data()
     if opts['--install-postgis']:
@@ -297,3 +372,11 @@ Default: '.'
         environment.add_extra_container('redis', error_on_exists=True)
     if opts['--admin-password']:
         environment.create_admin_set_password(confirm_password())
+    if opts['--clean-pyc']:
+        found, seconds = environment.clean_pyc(dry_run=opts['--dry-run'])
+        if opts['--dry-run']:
+            for filename in found:
+                print filename
+            print 'Found {0} pyc files in {1:.2f}s'.format(len(found), seconds)
+        else:
+            print 'Removed {0} pyc files in {1:.2f}s'.format(len(found), seconds)
@@ -6,9 +6,16 @@
 
 import sys
 import json
+import time
+from os import makedirs, rename
+from os.path import expanduser, dirname, isdir
+from functools import partial
+from threading import Lock
 
-from datacats.docker import pull_stream
+from datacats.docker import (pull_stream, image_tag, image_exists,
+                             local_images, forget_local_images)
 from datacats.error import DatacatsError
+from datacats.parallel import run_parallel
 
 IMAGES = [
     'datacats/web:latest',
@@ -23,6 +30,20 @@ EXTRA_IMAGES = [
     'datacats/ckan:2.3'
     ]
 
+# images pulled at once, the daemon downloads layers they share only once
+PULL_WORKERS = 3
+PULL_ATTEMPTS = 5
+# doubled after each failed attempt
+PULL_RETRY_DELAY_SECONDS = 1
+# minimum time between redraws of the progress display
+PROGRESS_REDRAW_SECONDS = 0.2
+# {repository:tag: {"digest": digest, "time": unix time}} as last pulled,
+# see stale_images
+PULLED_IMAGES_CACHE = '~/.datacats/cache/pulled-images.json'
+# images pulled more recently than this aren't checked with the registry
+# again unless they changed locally
+PULL_CHECK_TTL_SECONDS = 6 * 60 * 60
+
 
 def write(line):
     sys.stdout.write(line)
@@ -33,7 +54,8 @@ def pull(opts):
     """Download or update required datacats docker images
 
 Usage:
-  datacats pull [-a]
+  datacats pull [-af]
+  datacats pull --offline [-a]
 
 Options:
   -a --all           Pull optional images as well as required
@@ -41,18 +63,115 @@ Options:
                      when needed, but you can use this to make
                      sure you have all the images you need if
                      you are going offline.
+  -f --force         Check every image with the registry, by default
+                     images pulled in the last 6 hours are skipped
+                     unless they have changed locally
+  --offline          Only check that the images are available locally,
+                     without using the network
 """
-    for i in IMAGES + (EXTRA_IMAGES if opts['--all'] else []):
-        retrying_pull_image(i)
+    images = IMAGES + (EXTRA_IMAGES if opts['--all'] else [])
+    if opts['--offline']:
+        missing = [i for i in images if not image_exists(image_tag(i))]
+        if missing:
+            raise DatacatsError('Missing images: {0}\nRun "datacats pull" while'
+                                ' online to download them.'.format(', '.join(missing)))
+        print 'All {0} images are available locally.'.format(len(images))
+        return
+
+    if not opts['--force']:
+        images = stale_images(images)
+        if not images:
+            print 'Images are up to date, use --force to check with the registry anyway.'
+            return
+    pull_images(images)
+
+
+def _repo_digests(info):
+    return [d.split('@', 1)[1] for d in info.get('RepoDigests') or () if '@' in d]
+
+
+def _load_pulled_images():
+    try:
+        with open(expanduser(PULLED_IMAGES_CACHE)) as f:
+            pulled = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return pulled if isinstance(pulled, dict) else {}
+
+
+def _save_pulled_images(pulled):
+    filename = expanduser(PULLED_IMAGES_CACHE)
+    try:
+        if not isdir(dirname(filename)):
+            makedirs(dirname(filename))
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(pulled, f)
+        rename(filename + '.tmp', filename)
+    except (IOError, OSError):
+        pass
+
+
+def stale_images(images):
+    """
+    Return the images that need to be pulled: ones missing locally, not
+    pulled within PULL_CHECK_TTL_SECONDS or whose local digest no longer
+    matches the one recorded when they were pulled. Local images are
+    listed only once.
+    """
+    pulled = _load_pulled_images()
+    local = local_images()
+    now = time.time()
+    stale = []
+    for image in images:
+        tag = image_tag(image)
+        record = pulled.get(tag)
+        info = local.get(tag)
+        if (not info or not record or now - record['time'] > PULL_CHECK_TTL_SECONDS or
+                record['digest'] not in _repo_digests(info)):
+            stale.append(image)
+    return stale
+
+
+def pull_images(images, workers=PULL_WORKERS, out=None):
+    """
+    Pull images, workers at a time, showing the progress of each one.
+
+    Raises DatacatsError for the first image that couldn't be pulled once
+    the others have finished.
+    """
+    progress = PullProgress(images, out or sys.stdout)
+    digests = {}
+
+    def pull_one(image):
+        try:
+            digests[image_tag(image)] = retrying_pull_image(image, progress)
+        except DatacatsError:
+            progress.finish(image, failed=True)
+            raise
+        progress.finish(image)
+
+    try:
+        run_parallel(pull_one, images, workers)
+    finally:
+        pulled = _load_pulled_images()
+        local = local_images()
+        for tag, digest in digests.iteritems():
+            if not digest and tag in local:
+                # older daemons don't report the digest while pulling
+                digest = (_repo_digests(local[tag]) or [None])[0]
+            pulled[tag] = {'digest': digest, 'time': time.time()}
+        _save_pulled_images(pulled)
 
 
-def retrying_pull_image(image_name):
-    _retry_func(pull_image, image_name, 5,
+def retrying_pull_image(image_name, progress=None):
+    return _retry_func(partial(pull_image, progress=progress), image_name, PULL_ATTEMPTS,
+                progress.retrying if progress else
                 lambda img, num: write("Pulling image {} failed. Retrying.".format(image_name)),
-                "Failed to pull image {}.".format(image_name))
+                "Failed to pull image {}.".format(image_name),
+                delay=PULL_RETRY_DELAY_SECONDS)
 
 
-def _retry_func(func, param, num, retry_notif, error_msg):
+def _retry_func(func, param, num, retry_notif, error_msg, delay=0):
     """
     A function which retries a given function num times and calls retry_notif each
     time the function is retried.
@@ -62,32 +181,138 @@ def _retry_func(func, param, num, retry_notif, error_msg):
                         function. Will also receive the number of retries so far as a second
                         parameter.
     :param: error_msg: The message
+    :param delay: seconds to wait before the first retry, doubled for each
+                  retry after that
 
-    Throws DatacatsError if we run out of retries. Returns otherwise.
+    Throws DatacatsError if we run out of retries. Returns what func returned otherwise.
     """
     for retry_num in range(num):
         if retry_num:
             retry_notif(param, retry_num)
+            time.sleep(delay * 2 ** (retry_num - 1))
         try:
-            func(param)
-            return
+            return func(param)
         except DatacatsError:
             pass
 
     raise DatacatsError(error_msg)
 
 
-def pull_image(image_name):
-    sys.stdout.write('Pulling image ' + image_name)
-    sys.stdout.flush()
+def pull_image(image_name, progress=None):
+    """
+    Pull image_name, reporting status messages to progress or writing a
+    dot for each one if it is None.
+
+    Returns the image digest reported by the daemon, or None
+    """
+    if not progress:
+        sys.stdout.write('Pulling image ' + image_name)
+        sys.stdout.flush()
+    digest = None
     for s in pull_stream(image_name):
+        if s.get('status', '').startswith('Digest: '):
+            digest = s['status'][len('Digest: '):]
         if 'status' not in s:
             if 'error' in s:
                 # Line to make the error appear after the ...
-                print
+                if not progress:
+                    print
                 raise DatacatsError(s['error'])
-            else:
+            elif not progress:
                 print json.dumps(s)
-        sys.stdout.write('.')
-        sys.stdout.flush()
-    sys.stdout.write('\n')
+        if progress:
+            progress.update(image_name, s)
+        else:
+            sys.stdout.write('.')
+            sys.stdout.flush()
+    forget_local_images()
+    if not progress:
+        sys.stdout.write('\n')
+    return digest
+
+
+def _megabytes(size):
+    return '{0:.1f} MB'.format(size / 1e6)
+
+
+class PullProgress(object):
+    """
+    Layer progress of images being pulled at the same time, from the
+    status messages of pull_stream. On a terminal one line per image is
+    redrawn as they arrive, otherwise a line is written as each image
+    finishes.
+    """
+    def __init__(self, images, out):
+        self.images = list(images)
+        self.out = out
+        self.tty = hasattr(out, 'isatty') and out.isatty()
+        # {image: {layer id: [bytes downloaded, layer size, done]}}
+        self.layers = dict((image, {}) for image in self.images)
+        self.started = {}
+        self.state = dict((image, 'waiting') for image in self.images)
+        self._lock = Lock()
+        self._drawn = 0
+        self._last_draw = 0
+
+    def update(self, image, status):
+        """
+        Record one pull_stream status message for image
+        """
+        with self._lock:
+            self.started.setdefault(image, time.time())
+            self.state[image] = 'pulling'
+            # layer messages have progressDetail, even if empty
+            if 'progressDetail' in status and status.get('id'):
+                layer = self.layers[image].setdefault(status['id'], [0, 0, False])
+                detail = status['progressDetail'] or {}
+                if status['status'] == 'Downloading':
+                    layer[0] = detail.get('current', layer[0])
+                    layer[1] = detail.get('total', layer[1])
+                elif status['status'] == 'Download complete':
+                    layer[0] = layer[1] = max(layer[0], layer[1])
+                elif status['status'] in ('Pull complete', 'Already exists'):
+                    layer[2] = True
+            self._draw()
+
+    def retrying(self, image, attempt):
+        with self._lock:
+            self.state[image] = 'retry {0}'.format(attempt)
+            self._draw()
+
+    def finish(self, image, failed=False):
+        with self._lock:
+            self.state[image] = 'failed' if failed else 'done'
+            if self.tty:
+                self._draw(force=True)
+            else:
+                self.out.write(self.line(image) + '\n')
+                self.out.flush()
+
+    def line(self, image):
+        """
+        Return the progress summary for image
+        """
+        layers = self.layers[image].values()
+        downloaded = sum(l[0] for l in layers)
+        total = sum(l[1] for l in layers)
+        elapsed = time.time() - self.started.get(image, time.time())
+        rate = downloaded / elapsed if elapsed > 0 else 0
+        return '{0:<24} {1:<8} {2:>3}/{3:<3} layers {4:>9} / {5:<9} {6:>9}/s'.format(
+            image, self.state[image], len([l for l in layers if l[2]]),
+            len(layers), _megabytes(downloaded), _megabytes(total),
+            _megabytes(rate))
+
+    def _draw(self, force=False):
+        if not self.tty:
+            return
+        now = time.time()
+        if not force and now - self._last_draw < PROGRESS_REDRAW_SECONDS:
+            return
+        self._last_draw = now
+        if self._drawn:
+            # move back up to redraw over the previous lines
+            self.out.write('\x1b[{0}A'.format(self._drawn))
+        for image in self.images:
+            self.out.write('\r\x1b[K' + self.line(image) + '\n')
+        self.out.flush()
+        self._drawn = len(self.images)
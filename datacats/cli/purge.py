@@ -45,8 +45,7 @@ Default: '.'
     if not opts['--yes']:
         y_or_n_prompt('datacats purge will delete all stored data')
 
-    environment.stop_ckan()
-    environment.stop_supporting_containers()
+    environment.stop()
 
     environment.purge_data(sites)
 
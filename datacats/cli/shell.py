@@ -19,6 +19,9 @@ Options:
 
 ENVIRONMENT may be an environment name or a path to an environment directory.
 Default: '.'
+
+The shell runs inside the site's web container if it was started with
+"datacats start --exec", which is much quicker than starting a new container.
 """
     environment.require_data()
     environment.start_supporting_containers()
@@ -41,6 +44,8 @@ Options:
 You must be inside a datacats environment to run this. The paster command will
 run within your current directory inside the environment. You don't need to
 specify the --plugin option. The --config option also need not be specified.
+Like shell, it runs inside the site's web container if it was started with
+"datacats start --exec".
 """
     environment = Environment.load('.')
     environment.require_data()
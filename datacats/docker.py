@@ -9,12 +9,21 @@ from __future__ import absolute_import
 import sys
 
 from datacats.scripts import get_script_path
-from os import environ, devnull
+from datacats.parallel import run_parallel
+from datacats import tracing, cassette
+from os import environ, devnull, lchown, makedirs, rename
+from os.path import expanduser, dirname, isdir
 import json
+import tarfile
+import time
 import subprocess
 import tempfile
+from threading import Lock, Semaphore, Thread
+from Queue import Queue, Empty
+from collections import deque
 from urlparse import urlparse
 from functools import cmp_to_key
+from inspect import getargspec
 from warnings import warn
 
 
@@ -24,6 +33,12 @@ from warnings import warn
 # in the future.
 
 from docker import Client
+from docker.unixconn import unixconn
+from requests.adapters import HTTPAdapter
+try:
+    import requests.packages.urllib3 as urllib3
+except ImportError:
+    import urllib3
 from docker.constants import DEFAULT_DOCKER_API_VERSION
 from docker.utils import kwargs_from_env, compare_version, LogConfig
 from docker.errors import APIError, TLSParameterError
@@ -44,6 +59,22 @@ The simplest way to create and start a docker-machine VM is to run \
 "docker-machine create dev && docker-machine start dev",\
 then to add the line "eval '$(docker-machine env dev)'" to your .bashrc file.'''
 MINIMUM_API_VERSION = '1.16'
+# The negotiated API version and boot2docker detection are saved here per
+# DOCKER_HOST and TLS settings so each datacats command doesn't repeat them
+HANDSHAKE_CACHE = '~/.datacats/cache/docker-handshake.json'
+HANDSHAKE_TTL_SECONDS = 600
+HANDSHAKE_ENVIRONMENT = ('DOCKER_HOST', 'DOCKER_TLS_VERIFY', 'DOCKER_CERT_PATH')
+# Connections kept open to the Docker daemon, enough for our thread pools
+DOCKER_POOL_SIZE = 16
+# first API version with GET /containers/(id)/archive
+ARCHIVE_API_VERSION = '1.20'
+# Container output kept for error messages, see log_tail
+LOG_TAIL_BYTES = 16 * 1024
+# at most this many lines are requested from docker logs by log_tail
+LOG_TAIL_LINES = 1000
+# lines from each container waiting to be read from multiplex_logs before
+# its reader stops reading more
+MULTIPLEX_BUFFER_LINES = 200
 
 
 def get_api_version(*versions):
@@ -54,13 +85,43 @@ def get_api_version(*versions):
 
 # Lazy instantiation of _docker
 _docker = None
+# see local_images
+_local_images = None
 
-try:
-    _docker_kwargs = kwargs_from_env()
-except TLSParameterError:
-    print ('Please create your docker-machine VM with the command'
-           ' "docker-machine create --driver=virtualbox dev"')
-    exit(1)
+# Image ids created by web_command(commit=True) during this process,
+# see remove_committed_images
+_committed_images = []
+
+# Names of containers started by start_web_worker during this process,
+# see stop_web_workers
+_web_workers = set()
+_web_workers_lock = Lock()
+
+# Result of list_containers, reset whenever this process creates or
+# removes named containers. Held while listing, so a container created
+# meanwhile can't be left out of the saved result
+_containers = None
+_containers_lock = Lock()
+
+# Keeps a worker container alive without doing anything, commands are
+# run inside it with exec_command
+WEB_WORKER_COMMAND = ['tail', '-f', '/dev/null']
+
+# Lazy instantiation of the Client arguments from DOCKER_* environment
+# variables, see _get_docker_kwargs
+_docker_kwargs = None
+
+
+def _get_docker_kwargs():
+    global _docker_kwargs
+    if _docker_kwargs is None:
+        try:
+            _docker_kwargs = kwargs_from_env()
+        except TLSParameterError:
+            print ('Please create your docker-machine VM with the command'
+                   ' "docker-machine create --driver=virtualbox dev"')
+            exit(1)
+    return _docker_kwargs
 
 
 def _machine_check_connectivity():
@@ -80,42 +141,186 @@ def _machine_check_connectivity():
             if status == 'Stopped':
                 raise DatacatsError('Please start your docker-machine '
                                     'VM with "docker-machine start dev"')
-
-            # XXX HACK: This exists because of
-            #           http://github.com/datacats/datacats/issues/63,
-            # as a temporary fix.
-            if 'tls' in _docker_kwargs:
-                # It will print out messages to the user otherwise.
-                _docker_kwargs['tls'].assert_hostname = False
         except subprocess.CalledProcessError:
             raise DatacatsError('Please create a docker-machine with '
                                 '"docker-machine start dev"')
 
 
-def _get_docker():
-    global _docker
+def _handshake_key():
+    return '|'.join(environ.get(name, '') for name in HANDSHAKE_ENVIRONMENT)
+
+
+def forget_handshake():
+    """
+    Discard the saved handshake values for this Docker host, e.g. after
+    failing to connect with them.
+
+    Raises DatacatsError if the docker-machine VM isn't running, which a
+    saved handshake skips checking.
+    """
+    cached = _read_handshake_cache()
+    if cached.pop(_handshake_key(), None) is not None:
+        _write_handshake_cache(cached)
+    if sys.platform.startswith('darwin'):
+        _machine_check_connectivity()
+
+
+def _read_handshake_cache():
+    try:
+        with open(expanduser(HANDSHAKE_CACHE)) as f:
+            cached = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return cached if isinstance(cached, dict) else {}
+
+
+def _write_handshake_cache(cached):
+    filename = expanduser(HANDSHAKE_CACHE)
+    try:
+        if not isdir(dirname(filename)):
+            makedirs(dirname(filename))
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(cached, f)
+        rename(filename + '.tmp', filename)
+    except (IOError, OSError):
+        # saving is only an optimization
+        pass
 
-    if not _docker:
-        if sys.platform.startswith('darwin'):
-            _machine_check_connectivity()
 
-        # Create the Docker client
-        version_client = Client(version=MINIMUM_API_VERSION, **_docker_kwargs)
+def _load_handshake():
+    """
+    Return the saved handshake values for this Docker host, or {} if
+    there are none from the last HANDSHAKE_TTL_SECONDS
+    """
+    entry = _read_handshake_cache().get(_handshake_key())
+    if not isinstance(entry, dict):
+        return {}
+    if not 0 <= time.time() - entry.get('time', 0) < HANDSHAKE_TTL_SECONDS:
+        return {}
+    return entry
+
+
+def _save_handshake(**values):
+    """
+    Save values for this Docker host along with the other handshake values
+    still fresh. Failing to save is not an error.
+    """
+    entry = _load_handshake()
+    entry.update(values)
+    entry.setdefault('time', time.time())
+    cached = _read_handshake_cache()
+    cached[_handshake_key()] = entry
+    _write_handshake_cache(cached)
+
+
+def _negotiate_api_version():
+    version_client = Client(version=MINIMUM_API_VERSION, **_get_docker_kwargs())
+    try:
+        api_version = version_client.version()['ApiVersion']
+    except ConnectionError:
         try:
+            # workaround for connection issue when old version specified
+            # on some clients
+            version_client = Client(**_get_docker_kwargs())
             api_version = version_client.version()['ApiVersion']
-        except ConnectionError:
-            try:
-                # workaround for connection issue when old version specified
-                # on some clients
-                version_client = Client(**_docker_kwargs)
-                api_version = version_client.version()['ApiVersion']
-            except:
-                raise DatacatsError(DOCKER_FAIL_STRING)
         except:
             raise DatacatsError(DOCKER_FAIL_STRING)
+    except:
+        raise DatacatsError(DOCKER_FAIL_STRING)
+
+    return get_api_version(DEFAULT_DOCKER_API_VERSION, api_version)
+
+
+class _UnixHTTPConnectionPool(unixconn.UnixHTTPConnectionPool):
+    def __init__(self, base_url, socket_path, timeout=60, maxsize=1):
+        # pylint: disable=non-parent-init-called,super-init-not-called
+        urllib3.connectionpool.HTTPConnectionPool.__init__(
+            self, 'localhost', timeout=timeout, maxsize=maxsize)
+        self.base_url = base_url
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+
+class _UnixAdapter(unixconn.UnixAdapter):
+    """
+    docker-py's UnixAdapter keeps a pool with a single connection per
+    request URL, so connections are rarely reused and concurrent requests
+    open (and throw away) extra ones. Share one larger pool instead.
+    """
+    def get_connection(self, url, proxies=None):
+        with self.pools.lock:
+            pool = self.pools.get(self.socket_path)
+            if pool:
+                return pool
+            pool = _UnixHTTPConnectionPool(
+                url, self.socket_path, self.timeout, DOCKER_POOL_SIZE)
+            self.pools[self.socket_path] = pool
+        return pool
+
+
+def _unix_adapter_replaceable(adapter):
+    """
+    True if adapter and docker-py's unix connection pool are laid out the
+    way _UnixAdapter expects (docker-py 1.7), other versions keep the
+    stock adapter
+    """
+    try:
+        args = getargspec(unixconn.UnixHTTPConnectionPool.__init__).args
+    except TypeError:
+        return False
+    return (args[:4] == ['self', 'base_url', 'socket_path', 'timeout'] and
+            all(hasattr(adapter, a) for a in ('pools', 'socket_path', 'timeout')))
 
-        version = get_api_version(DEFAULT_DOCKER_API_VERSION, api_version)
-        _docker = Client(version=version, **_docker_kwargs)
+
+def _enlarge_connection_pools(client):
+    """
+    Let client keep up to DOCKER_POOL_SIZE connections open to the daemon
+    """
+    # pylint: disable=protected-access
+    for prefix, adapter in client.adapters.items():
+        if isinstance(adapter, unixconn.UnixAdapter):
+            if not _unix_adapter_replaceable(adapter):
+                continue
+            adapter = _UnixAdapter(
+                'http+unix://' + adapter.socket_path, adapter.timeout)
+            client.mount(prefix, adapter)
+            client._custom_adapter = adapter
+        elif isinstance(adapter, HTTPAdapter):
+            adapter._pool_maxsize = DOCKER_POOL_SIZE
+            adapter.init_poolmanager(adapter._pool_connections,
+                                     DOCKER_POOL_SIZE, block=adapter._pool_block)
+
+
+def _make_client():
+    if sys.platform.startswith('darwin'):
+        # XXX HACK: This exists because of
+        #           http://github.com/datacats/datacats/issues/63,
+        # as a temporary fix.
+        if 'tls' in _get_docker_kwargs():
+            # It will print out messages to the user otherwise.
+            _get_docker_kwargs()['tls'].assert_hostname = False
+
+    version = _load_handshake().get('api_version')
+    if not version:
+        if sys.platform.startswith('darwin'):
+            _machine_check_connectivity()
+        version = _negotiate_api_version()
+        _save_handshake(api_version=version)
+
+    # Create the Docker client
+    client = Client(version=version, **_get_docker_kwargs())
+    _enlarge_connection_pools(client)
+    return client
+
+
+def _get_docker():
+    global _docker
+
+    if not _docker:
+        # recorded or replayed when DATACATS_CASSETTE is set
+        _docker = cassette.client_from_env(_make_client)
+        if tracing.enabled():
+            _docker = tracing.TracedClient(_docker)
 
     return _docker
 
@@ -124,13 +329,16 @@ _boot2docker = None
 
 def is_boot2docker():
     global _boot2docker
+    if _boot2docker is None:
+        _boot2docker = _load_handshake().get('boot2docker')
     if _boot2docker is None:
         _boot2docker = 'Boot2Docker' in _get_docker().info()['OperatingSystem']
+        _save_handshake(boot2docker=_boot2docker)
     return _boot2docker
 
 
 def docker_host():
-    url = _docker_kwargs.get('base_url')
+    url = _get_docker_kwargs().get('base_url')
     if not url:
         return 'localhost'
 
@@ -160,6 +368,7 @@ def binds_to_volumes(volumes):
     return [v['bind'] for v in volumes.itervalues()]
 
 
+@tracing.traced
 def web_command(command, ro=None, rw=None, links=None,
                 image='datacats/web', volumes_from=None, commit=False,
                 clean_up=False, stream_output=None, entrypoint=None):
@@ -173,7 +382,9 @@ def web_command(command, ro=None, rw=None, links=None,
     :param links: links passed to start
     :param image: docker image name to use
     :param volumes_from:
-    :param commit: True to create a new image based on result
+    :param commit: True to create a new image based on result. The image
+                   is tracked and removed by remove_committed_images unless
+                   the caller removes it first with remove_image
     :param clean_up: True to remove container even on error
     :param stream_output: file to write stderr+stdout from command
     :param entrypoint: override entrypoint (script that runs command)
@@ -197,13 +408,14 @@ def web_command(command, ro=None, rw=None, links=None,
             stream_output.write(output)
     if _get_docker().wait(c['Id']):
         # Before the (potential) cleanup, grab the logs!
-        logs = _get_docker().logs(c['Id'])
+        logs = log_tail(c['Id'])
 
         if clean_up:
             remove_container(c['Id'])
         raise WebCommandError(command, c['Id'][:12], logs)
     if commit:
         rval = _get_docker().commit(c['Id'])
+        _committed_images.append(rval['Id'])
     if not remove_container(c['Id']):
         # circle ci doesn't let us remove containers, quiet the warnings
         if not environ.get('CIRCLECI', False):
@@ -212,6 +424,54 @@ def web_command(command, ro=None, rw=None, links=None,
         return rval['Id']
 
 
+@tracing.traced
+def exec_command(container, command, stream_output=None):
+    """
+    Run a command inside a running container with docker exec.
+
+    :param container: name or id of a running container
+    :param command: command to execute
+    :param stream_output: file to write stderr+stdout from command
+
+    Raises WebCommandError if the command exits with a non-zero status.
+    """
+    exec_id = _get_docker().exec_create(
+        container, command, stdout=True, stderr=True)
+    logs = LogBuffer(LOG_TAIL_BYTES, tee=stream_output)
+    for output in _get_docker().exec_start(exec_id, stream=True):
+        logs.write(output)
+    if _get_docker().exec_inspect(exec_id)['ExitCode']:
+        raise WebCommandError(command, container, logs.tail())
+
+
+def start_web_worker(name, ro=None, rw=None, links=None,
+                     image='datacats/web', volumes_from=None):
+    """
+    Start (or reuse) a long-lived web container that commands can be run
+    in with exec_command, instead of creating a new container for every
+    web_command. It is removed by stop_web_workers.
+
+    :returns: name of the worker container
+    """
+    with _web_workers_lock:
+        if name in _web_workers:
+            return name
+        # left over from an interrupted run
+        remove_container(name, force=True)
+        run_container(name, image, WEB_WORKER_COMMAND, ro=ro, rw=rw,
+                      links=links, volumes_from=volumes_from)
+        _web_workers.add(name)
+    return name
+
+
+def stop_web_workers():
+    """
+    Remove all worker containers started by start_web_worker
+    """
+    while _web_workers:
+        remove_container(_web_workers.pop(), force=True)
+
+
 def remote_server_command(command, environment, user_profile, **kwargs):
     """
       Wraps web_command function with docker bindings needed to connect to
@@ -253,6 +513,7 @@ def remote_server_command(command, environment, user_profile, **kwargs):
         raise e
 
 
+@tracing.traced
 def run_container(name, image, command=None, environment=None,
                   ro=None, rw=None, links=None, detach=True, volumes_from=None,
                   port_bindings=None, log_syslog=False):
@@ -285,6 +546,7 @@ def run_container(name, image, command=None, environment=None,
         tty=False,
         ports=list(port_bindings) if port_bindings else None,
         host_config=host_config)
+    _forget_containers()
     try:
         _get_docker().start(
             container=c['Id'],
@@ -302,29 +564,82 @@ def run_container(name, image, command=None, environment=None,
 
 def rename_container(old_name, new_name):
     _docker.rename(old_name, new_name)
+    _forget_containers()
+
+
+def image_tag(name):
+    """
+    Return name as repository:tag, adding the default tag if it has none
+    """
+    if ':' in name.split('/')[-1]:
+        return name
+    return name + ':latest'
+
+
+def local_images():
+    """
+    Return {repository:tag: image dict from docker images} for the local
+    images. They are listed once and remembered, call forget_local_images
+    after pulling or tagging images.
+    """
+    global _local_images
+    if _local_images is None:
+        images = {}
+        for info in _get_docker().images():
+            for tag in info.get('RepoTags') or ():
+                if tag != '<none>:<none>':
+                    images[tag] = info
+        _local_images = images
+    return _local_images
+
+
+def forget_local_images():
+    global _local_images
+    _local_images = None
 
 
 def image_exists(name):
     """
     Queries Docker about if a particular image has been downloaded.
 
-    :param name: The name of the image to check for.
+    :param name: The name of the image to check for, any tag of the
+                 repository will do if it doesn't include a tag
     """
-    # This returns a list of container dicts matching (exactly)
-    # the name `name`.
-    return bool(_get_docker().images(name=name))
+    if ':' in name.split('/')[-1]:
+        return name in local_images()
+    return any(tag.rsplit(':', 1)[0] == name for tag in local_images())
 
 
-def remove_container(name, force=False):
+def image_id(name):
+    """
+    Return the ID of image name, or None if it hasn't been downloaded
+    """
+    try:
+        return _get_docker().inspect_image(name)['Id']
+    except APIError as e:
+        if e.response.status_code == 404:
+            return None
+        raise
+
+
+@tracing.traced
+def remove_container(name, force=False, grace=None):
     """
     Wrapper for docker remove_container
 
+    :param force: kill the container instead of stopping it first
+    :param grace: seconds the container has to stop after SIGTERM before
+                  it is killed, None for Docker's default
     :returns: True if container was found and removed
     """
 
+    _forget_containers()
     try:
         if not force:
-            _get_docker().stop(name)
+            if grace is None:
+                _get_docker().stop(name)
+            else:
+                _get_docker().stop(name, timeout=grace)
     except APIError:
         pass
     try:
@@ -334,6 +649,56 @@ def remove_container(name, force=False):
         return False
 
 
+def list_containers():
+    """
+    Return {name: container summary dict} for all datacats containers,
+    running or not, as listed by docker ps -a. The listing is made with a
+    single request and reused until this process creates or removes a
+    container, so checking many containers or sites stays cheap.
+
+    Use container_running to check the summary's status.
+    """
+    global _containers
+    with _containers_lock:
+        if _containers is None:
+            containers = {}
+            for c in _get_docker().containers(
+                    all=True, filters={'name': 'datacats_'}):
+                for name in c['Names']:
+                    # link aliases look like /other_container/alias
+                    name = name[1:]
+                    if '/' not in name:
+                        containers[name] = c
+            _containers = containers
+        return _containers
+
+
+def container_running(summary):
+    """
+    Return True if a container summary from list_containers is running
+    """
+    return summary['Status'].startswith('Up')
+
+
+def container_mounts(info):
+    """
+    Return {path in container: True if read-only} for the host directories
+    bound into a container, from its inspect_container info
+    """
+    mounts = {}
+    for bind in (info.get('HostConfig') or {}).get('Binds') or ():
+        parts = bind.split(':')
+        mounts[parts[1]] = len(parts) > 2 and 'ro' in parts[2].split(',')
+    return mounts
+
+
+def _forget_containers():
+    global _containers
+    with _containers_lock:
+        _containers = None
+
+
+@tracing.traced
 def inspect_container(name):
     """
     Wrapper for docker inspect_container
@@ -346,6 +711,17 @@ def inspect_container(name):
         return None
 
 
+def container_address(name):
+    """
+    Return the IP address of a running container on the docker bridge
+    network, or None if it isn't running
+    """
+    info = inspect_container(name)
+    if not info or not info['State']['Running']:
+        return None
+    return info['NetworkSettings']['IPAddress']
+
+
 def container_logs(name, tail, follow, timestamps):
     """
     Wrapper for docker logs, attach commands.
@@ -358,7 +734,7 @@ def container_logs(name, tail, follow, timestamps):
             stream=True
             )
 
-    return _docker.logs(
+    return _get_docker().logs(
         name,
         stdout=True,
         stderr=True,
@@ -367,20 +743,199 @@ def container_logs(name, tail, follow, timestamps):
     )
 
 
-def collect_logs(name):
+def container_events(name, event, since=None, until=None):
+    """
+    Wrapper for docker events, filtered to one container and event type.
+
+    :returns: generator of event dicts that blocks waiting for new events
+              until the until timestamp has passed
+    """
+    return _get_docker().events(
+        since=since,
+        until=until,
+        filters={'container': name, 'event': event},
+        decode=True)
+
+
+class LogBuffer(object):
+    """
+    File-like collector for container output that keeps only the last
+    max_bytes written (everything if max_bytes is None) and copies all of
+    it to tee, if given, as it arrives.
+    """
+    def __init__(self, max_bytes=None, tee=None):
+        self.max_bytes = max_bytes
+        self.tee = tee
+        self.truncated = False
+        self._chunks = deque()
+        self._size = 0
+
+    def write(self, data):
+        if self.tee:
+            self.tee.write(data)
+        if not data:
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        while self.max_bytes is not None and self._size > self.max_bytes:
+            self.truncated = True
+            excess = self._size - self.max_bytes
+            first = self._chunks[0]
+            if len(first) <= excess:
+                self._chunks.popleft()
+                self._size -= len(first)
+            else:
+                self._chunks[0] = first[excess:]
+                self._size -= excess
+
+    def getvalue(self):
+        """
+        Return the output kept as a string
+        """
+        value = ''.join(self._chunks)
+        self._chunks = deque([value] if value else [])
+        return value
+
+    def tail(self):
+        """
+        Return the output kept, starting at a line boundary and marked
+        when earlier output was dropped
+        """
+        value = self.getvalue()
+        if not self.truncated:
+            return value
+        newline = value.find('\n')
+        if newline >= 0:
+            value = value[newline + 1:]
+        return '[... earlier output truncated ...]\n' + value
+
+
+def iter_lines(chunks, tee=None):
+    """
+    Yield complete lines (including '\\n') from an iterable of output
+    chunks as they arrive, then any unterminated last line. Every chunk
+    is also written to tee, if given.
+    """
+    partial = []
+    for chunk in chunks:
+        if tee:
+            tee.write(chunk)
+        start = 0
+        while True:
+            end = chunk.find('\n', start)
+            if end < 0:
+                break
+            partial.append(chunk[start:end + 1])
+            yield ''.join(partial)
+            partial = []
+            start = end + 1
+        if start < len(chunk):
+            partial.append(chunk[start:])
+    if partial:
+        yield ''.join(partial)
+
+
+def stream_logs(name, follow=True, tee=None):
+    """
+    Return a generator of the lines of output from a container, following
+    it until it exits when follow is True.
+
+    :param tee: file to also write the raw output to
+    """
+    return iter_lines(container_logs(name, "all", follow, False), tee)
+
+
+def collect_logs(name, max_bytes=None, tee=None):
     """
     Returns a string representation of the logs from a container.
     This is similar to container_logs but uses the `follow` option
     and flattens the logs into a string instead of a generator.
 
     :param name: The container name to grab logs for
+    :param max_bytes: keep only this many bytes from the end of the logs
+    :param tee: file to also write the logs to as they arrive
     :return: A string representation of the logs
     """
-    logs = container_logs(name, "all", True, None)
-    string = ""
-    for s in logs:
-        string += s
-    return string
+    logs = LogBuffer(max_bytes, tee)
+    for s in container_logs(name, "all", True, None):
+        logs.write(s)
+    return logs.getvalue()
+
+
+def follow_logs(name, since=None, timestamps=False):
+    """
+    Return a generator of output chunks from a container that follows it
+    until it exits.
+
+    :param since: unix timestamp of the earliest output to include
+    :param timestamps: True to start each line with its RFC 3339 timestamp
+    """
+    return _get_docker().logs(name, stdout=True, stderr=True, stream=True,
+                              timestamps=timestamps, since=since)
+
+
+def multiplex_logs(names, since=None, pattern=None,
+                   buffer_lines=MULTIPLEX_BUFFER_LINES):
+    """
+    Follow the logs of several containers at once. Returns a generator of
+    (name, timestamp, line) in the order lines arrive that ends when every
+    container has exited.
+
+    Each container is read by its own thread, which blocks once
+    buffer_lines of its lines are waiting so a busy container can't use
+    unbounded memory.
+
+    :param since: unix timestamp of the earliest output to include
+    :param pattern: compiled regular expression, only lines it matches
+                    are included
+    """
+    lines = Queue()
+    slots = dict((name, Semaphore(buffer_lines)) for name in names)
+    finished = object()
+
+    def read(name):
+        try:
+            for line in iter_lines(follow_logs(name, since, timestamps=True)):
+                timestamp, _, line = line.partition(' ')
+                if pattern and not pattern.search(line):
+                    continue
+                slots[name].acquire()
+                lines.put((name, timestamp, line))
+        except (APIError, ConnectionError) as e:
+            slots[name].acquire()
+            lines.put((name, '', 'Error following logs: {0}\n'.format(e)))
+        finally:
+            lines.put((name, None, finished))
+
+    for name in names:
+        thread = Thread(target=read, args=(name,))
+        thread.daemon = True
+        thread.start()
+
+    following = len(names)
+    while following:
+        try:
+            # a timeout keeps KeyboardInterrupt working while we wait
+            name, timestamp, line = lines.get(timeout=1)
+        except Empty:
+            continue
+        if line is finished:
+            following -= 1
+            continue
+        slots[name].release()
+        yield name, timestamp, line
+
+
+def log_tail(name, max_bytes=LOG_TAIL_BYTES):
+    """
+    Return the end of the logs from a container for an error message,
+    no more than max_bytes of it
+    """
+    logs = LogBuffer(max_bytes)
+    for s in _get_docker().logs(name, stdout=True, stderr=True,
+                                stream=True, tail=LOG_TAIL_LINES):
+        logs.write(s)
+    return logs.tail()
 
 
 def check_connectivity():
@@ -388,9 +943,10 @@ def check_connectivity():
                       ro={get_script_path('check_connectivity.sh'):
                           '/project/check_connectivity.sh'},
                       detach=False)
-    return collect_logs(c['Id'])
+    return collect_logs(c['Id'], LOG_TAIL_BYTES)
 
 
+@tracing.traced
 def pull_stream(image):
     """
     Return generator of pull status objects
@@ -414,15 +970,106 @@ def data_only_container(name, volumes):
         command='true',
         volumes=volumes,
         detach=True)
+    _forget_containers()
     return c
 
 
+def archive_supported():
+    """
+    Return True if files can be streamed out of containers as tar
+    archives with this Docker daemon and docker-py
+    """
+    client = _get_docker()
+    return (hasattr(client, 'get_archive') and
+            compare_version(ARCHIVE_API_VERSION, client.api_version) >= 0)
+
+
+class _OwnerTarFile(tarfile.TarFile):
+    """
+    TarFile that gives extracted files to self.owner (uid, gid) if set,
+    instead of the owners recorded in the archive
+    """
+    owner = None
+
+    def chown(self, tarinfo, targetpath):
+        if self.owner is None:
+            return tarfile.TarFile.chown(self, tarinfo, targetpath)
+        lchown(targetpath, *self.owner)
+
+
+def _strip_top_dir(name):
+    parts = name.split('/', 1)
+    return parts[1] if len(parts) == 2 else ''
+
+
+def _extract_dir_contents(fileobj, target, owner):
+    """
+    Extract the contents of the single top-level directory in a tar
+    stream (as returned by get_archive for a directory) into target
+    """
+    tar = _OwnerTarFile.open(fileobj=fileobj, mode='r|')
+    tar.owner = owner
+    try:
+        for member in tar:
+            member.name = _strip_top_dir(member.name)
+            if (not member.name or member.name.startswith('/') or
+                    '..' in member.name.split('/')):
+                continue
+            if member.islnk():
+                member.linkname = _strip_top_dir(member.linkname)
+            tar.extract(member, target)
+    finally:
+        tar.close()
+
+
+def extract_from_image(image, paths, owner=None):
+    """
+    Copy directories out of an image without starting a container by
+    streaming them as tar archives. Requires archive_supported().
+
+    :param image: image to copy from
+    :param paths: {directory in image: host directory to copy its contents
+                   into}, copied in parallel
+    :param owner: (uid, gid) to give the copied files, by default they
+                  belong to the current user (or keep the image's owners
+                  when running as root)
+    """
+    c = _get_docker().create_container(image=image, command='true')
+    try:
+        def extract(path):
+            stream, _ = _get_docker().get_archive(c['Id'], path)
+            _extract_dir_contents(stream, paths[path], owner)
+        run_parallel(extract, paths)
+    finally:
+        _get_docker().remove_container(c['Id'], force=True)
+
+
 def remove_image(image, force=False, noprune=False):
     _get_docker().remove_image(image, force=force, noprune=noprune)
+    if image in _committed_images:
+        _committed_images.remove(image)
+
+
+def remove_committed_images():
+    """
+    Remove any images created by web_command(commit=True) that their
+    callers didn't clean up, so they don't pile up as dangling images.
+
+    :returns: list of image ids that could not be removed
+    """
+    failed = []
+    while _committed_images:
+        image = _committed_images.pop()
+        try:
+            _get_docker().remove_image(image, force=True)
+        except APIError:
+            failed.append(image)
+    return failed
 
 
 def get_tags(image):
-    return [i['RepoTags'][0].split(':')[1] for i in _get_docker().images(image)]
+    return [tag.rsplit(':', 1)[1] for tag in local_images()
+            if tag.rsplit(':', 1)[0] == image]
 
 
 def require_images():
@@ -4,31 +4,37 @@
 # the terms of the GNU Affero General Public License version 3.0.
 # See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
 
-from os.path import isdir, exists, join
+from os.path import isdir, exists, join, dirname, basename, abspath
 from os import makedirs, remove, environ
 import sys
 import subprocess
 import shutil
 import json
-import time
 import socket
 from sha import sha
 from struct import unpack
 from ConfigParser import (SafeConfigParser, Error as ConfigParserError)
 
-from datacats import task, scripts
+from datacats import task, scripts, cache
 from datacats.docker import (web_command, run_container, remove_container,
-                             inspect_container, is_boot2docker,
-                             docker_host, container_logs, APIError)
+                             is_boot2docker, docker_host, container_logs, log_tail,
+                             multiplex_logs, APIError, exec_command, start_web_worker,
+                             list_containers, container_running,
+                             container_address, inspect_container, container_mounts)
 from datacats.template import ckan_extension_template
-from datacats.network import wait_for_service_available, ServiceTimeout
+from datacats.network import (wait_for_service_available, wait_for_ready,
+                              postgres_probe, solr_probe, exec_probe,
+                              address_reachable, ServiceTimeout,
+                              POSTGRES_PORT, SOLR_PORT)
 from datacats.password import generate_password
-from datacats.error import DatacatsError, WebCommandError, PortAllocatedError
+from datacats.error import DatacatsError, PortAllocatedError
 
 WEB_START_TIMEOUT_SECONDS = 30
+SERVICE_START_TIMEOUT_SECONDS = 60
 DB_INIT_RETRY_SECONDS = 30
-DB_INIT_RETRY_DELAY = 2
 DOCKER_EXE = 'docker'
+# Set to run commands in one long-lived web container per environment
+WEB_WORKER_ENV = 'DATACATS_WEB_WORKER'
 
 
 class Environment(object):
@@ -151,6 +157,38 @@ class Environment(object):
         else:
             (port, address, site_url, passwords) = (None, None, None, None)
 
+        return cls._from_settings(
+            (datadir, name, ckan_version, always_prod, deploy_target,
+             remote_server_key, extra_containers),
+            srcdir, extension_dir, site_name,
+            (port, address, site_url, passwords), load_sites=not allow_old)
+
+    @classmethod
+    def load_all_sites(cls, environment_name=None):
+        """
+        Return {site name: Environment} for every site of an existing
+        environment, reading its configuration files once instead of once
+        per site as calling load() for each site would.
+
+        Raises DatacatsError if environment can't be found or if there is an
+        error parsing the environment information.
+        """
+        srcdir, extension_dir, datadir = task.find_environment_dirs(
+            environment_name)
+        settings = task.load_environment(srcdir, datadir)
+        sites = task.load_all_sites(srcdir, settings[0])
+        return dict(
+            (site_name, cls._from_settings(settings, srcdir, extension_dir,
+                                           site_name, site))
+            for site_name, site in sites.iteritems())
+
+    @classmethod
+    def _from_settings(cls, env_settings, srcdir, extension_dir, site_name,
+                       site_settings, load_sites=True):
+        (datadir, name, ckan_version, always_prod, deploy_target,
+            remote_server_key, extra_containers) = env_settings
+        (port, address, site_url, passwords) = site_settings
+
         environment = cls(name, srcdir, datadir, site_name, ckan_version=ckan_version,
                           port=port, deploy_target=deploy_target, site_url=site_url,
                           always_prod=always_prod, address=address,
@@ -163,7 +201,7 @@ class Environment(object):
         else:
             environment._generate_passwords()
 
-        if not allow_old:
+        if load_sites:
             environment._load_sites()
         return environment
 
@@ -243,11 +281,22 @@ class Environment(object):
             rw_venv=True,
             )
 
-    def install_extra(self):
+    def clean_pyc(self, dry_run=False):
+        """
+        Remove .pyc files from the environment directory
+
+        :param dry_run: True to only find the files
+        :returns: (files removed or found, seconds taken)
+        """
+        return task.clean_pyc(self.target, dry_run)
+
+    def install_extra(self, wheelhouse=None):
         self.user_run_script(
             script=scripts.get_script_path('install_extra_packages.sh'),
             args=[],
-            rw_venv=True
+            rw_venv=True,
+            ro=_wheelhouse_mount(wheelhouse),
+            pip_cache=True
         )
 
     def create_source(self, datapusher=True):
@@ -257,32 +306,65 @@ class Environment(object):
         """
         task.create_source(self.target, self._preload_image(), datapusher)
 
-    def start_supporting_containers(self, log_syslog=False):
+    def create_virtualenv_and_source(self, datapusher=True):
+        """
+        Populate venv and ckan directory from preloaded image in a single
+        pass, see create_virtualenv and create_source
+        """
+        if is_boot2docker():
+            self.create_virtualenv()
+            self.create_source(datapusher)
+            return
+        task.extract_preload(self.target, self.datadir, self._preload_image(),
+                             datapusher=datapusher)
+
+    def start_supporting_containers(self, log_syslog=False, wait=False):
         """
         Start all supporting containers (containers required for CKAN to
         operate) if they aren't already running.
 
             :param log_syslog: A flag to redirect all container logs to host's syslog
+            :param wait: Wait until postgres and solr are ready to use
 
+        Returns {container type: seconds taken to start} for the containers
+        that were started.
         """
         log_syslog = True if self.always_prod else log_syslog
         # in production we always use log_syslog driver (to aggregate all the logs)
-        task.start_supporting_containers(
+        return task.start_supporting_containers(
             self.sitedir,
             self.target,
             self.passwords,
             self._get_container_name,
             self.extra_containers,
-            log_syslog=log_syslog
+            log_syslog=log_syslog,
+            ready_checks={
+                'postgres': self.wait_for_postgres_available,
+                'solr': self.wait_for_solr_available,
+                } if wait else None,
             )
 
-    def stop_supporting_containers(self):
+    def stop_supporting_containers(self, fast=False):
         """
         Stop and remove supporting containers (containers that are used by CKAN but don't host
         CKAN or CKAN plugins). This method should *only* be called after CKAN has been stopped
         or behaviour is undefined.
+
+        :param fast: give containers other than postgres only a second to shut down
+        """
+        task.stop_supporting_containers(self._get_container_name, self.extra_containers, fast)
+
+    def stop(self, fast=False):
         """
-        task.stop_supporting_containers(self._get_container_name, self.extra_containers)
+        Stop and remove all of this site's containers at the same time,
+        postgres once CKAN is gone
+
+        :param fast: give containers other than postgres only a second to shut down
+        """
+        task.stop_containers(
+            self._get_container_name,
+            list(task.KILLED_CONTAINERS) + ['postgres', 'solr'] + list(self.extra_containers),
+            fast)
 
     def fix_storage_permissions(self):
         """
@@ -339,27 +421,21 @@ class Environment(object):
         """
         Run db init to create all ckan tables
 
-        :param retry_seconds: how long to retry waiting for db to start
+        :param retry_seconds: how long to wait for the db to accept connections
         """
-        # XXX workaround for not knowing how long we need to wait
-        # for postgres to be ready. fix this by changing the postgres
-        # entrypoint, or possibly running once with command=/bin/true
-        started = time.time()
-        while True:
-            try:
-                self.run_command(
-                    '/usr/lib/ckan/bin/paster --plugin=ckan db init '
-                    '-c /project/development.ini',
-                    db_links=True,
-                    clean_up=True,
-                    )
-                break
-            except WebCommandError:
-                if started + retry_seconds > time.time():
-                    raise
-            time.sleep(DB_INIT_RETRY_DELAY)
+        # a fresh postgres container creates the cluster and our users
+        # before it starts listening, wait for that without starting
+        # a web container for each attempt
+        self.wait_for_postgres_available(retry_seconds)
+        self.run_command(
+            '/usr/lib/ckan/bin/paster --plugin=ckan db init '
+            '-c /project/development.ini',
+            db_links=True,
+            clean_up=True,
+            )
 
     def install_postgis_sql(self):
+        self.wait_for_postgres_available(DB_INIT_RETRY_SECONDS)
         web_command(
             '/scripts/install_postgis.sh',
             image='datacats/postgres',
@@ -389,13 +465,15 @@ class Environment(object):
             raise DatacatsError('Failed to read and parse development.ini: ' + str(e))
 
     def start_ckan(self, production=False, log_syslog=False, paster_reload=True,
-                   interactive=False):
+                   interactive=False, shell=False):
         """
         Start the apache server or paster serve
 
         :param log_syslog: A flag to redirect all container logs to host's syslog
         :param production: True for apache, False for paster serve + debug on
         :param paster_reload: Instruct paster to watch for file changes
+        :param shell: mount the source and venv writable in a paster serve
+                      web container so shell and paster can run in it
         """
         self.stop_ckan()
 
@@ -441,7 +519,8 @@ class Environment(object):
             self._create_run_ini(port, production)
             try:
                 self._run_web_container(port, command, address, log_syslog=log_syslog,
-                                        datapusher=datapusher, interactive=interactive)
+                                        datapusher=datapusher, interactive=interactive,
+                                        shell=shell and not production)
                 if not is_boot2docker():
                     self.address = address
             except PortAllocatedError:
@@ -494,9 +573,12 @@ class Environment(object):
             cp.write(runini)
 
     def _run_web_container(self, port, command, address, log_syslog=False,
-                           datapusher=True, interactive=False):
+                           datapusher=True, interactive=False, shell=False):
         """
         Start web container on port with command
+
+        :param shell: mount everything interactive_shell needs, so shell and
+                      paster commands can be run in the container with exec
         """
         if is_boot2docker():
             ro = {}
@@ -515,8 +597,7 @@ class Environment(object):
 
         if datapusher:
             if 'datapusher' not in self.containers_running():
-                raise DatacatsError(container_logs(self._get_container_name('datapusher'), "all",
-                                                   False, False))
+                raise DatacatsError(log_tail(self._get_container_name('datapusher')))
             links[self._get_container_name('datapusher')] = 'datapusher'
 
         ro = dict({
@@ -528,6 +609,8 @@ class Environment(object):
             self.sitedir + '/files': '/var/www/storage',
             self.sitedir + '/run/development.ini': '/project/development.ini'
             }
+        if shell:
+            ro, rw = self._web_shell_volumes(ro, rw)
         try:
             if not interactive:
                 run_container(
@@ -565,6 +648,38 @@ class Environment(object):
             else:
                 raise
 
+    def _web_shell_volumes(self, ro, rw):
+        """
+        Return the web container's ro and rw volumes changed to match
+        interactive_shell's: project and venv writable, all of our scripts
+        on /scripts and test.ini for running the tests
+        """
+        ro = dict((src, bind) for src, bind in ro.iteritems()
+                  if not bind.startswith('/scripts/') and src != self.target)
+        ro[scripts.SCRIPTS_DIR] = '/scripts'
+        ro.update(self._proxy_settings())
+        rw = dict(rw)
+        rw[self.target] = '/project'
+        if not is_boot2docker():
+            del ro[self.datadir + '/venv']
+            rw[self.datadir + '/venv'] = '/usr/lib/ckan'
+        if exists(self.target + '/ckan/test-core.ini'):
+            self._create_run_ini(self.port, production=True, output='test.ini',
+                                 source='ckan/test-core.ini', override_site_url=False)
+            ro[self.sitedir + '/run/test.ini'] = '/project/ckan/test-core.ini'
+        return ro, rw
+
+    def web_shell_available(self):
+        """
+        Return True if the web container is running with the volumes
+        interactive_shell needs, so commands can be run in it with exec
+        """
+        info = inspect_container(self._get_container_name('web'))
+        if not info or not info['State']['Running']:
+            return False
+        mounts = container_mounts(info)
+        return mounts.get('/project') is False and '/scripts' in mounts
+
     def wait_for_web_available(self):
         """
         Wait for the web server to become available or raise DatacatsError
@@ -576,11 +691,61 @@ class Environment(object):
                     self.web_address(),
                     WEB_START_TIMEOUT_SECONDS):
                 raise DatacatsError('Error while starting web container:\n' +
-                                    container_logs(self._get_container_name('web'), "all",
-                                                   False, None))
+                                    log_tail(self._get_container_name('web')))
         except ServiceTimeout:
             raise DatacatsError('Timeout while starting web container. Logs:' +
-                                container_logs(self._get_container_name('web'), "all", False, None))
+                                log_tail(self._get_container_name('web')))
+
+    def wait_for_postgres_available(self, timeout=SERVICE_START_TIMEOUT_SECONDS):
+        """
+        Wait for the postgres container to accept connections or raise
+        DatacatsError if it fails to start.
+        """
+        container = self._get_container_name('postgres')
+        address = self._reachable_address(container, POSTGRES_PORT)
+        if address:
+            probe = postgres_probe(address)
+        else:
+            probe = exec_probe(container, ['pg_isready', '-q', '-h', '127.0.0.1'])
+        self._wait_for_container(container, 'postgres', probe, timeout)
+
+    def wait_for_solr_available(self, timeout=SERVICE_START_TIMEOUT_SECONDS):
+        """
+        Wait for the solr container to answer pings or raise DatacatsError
+        if it fails to start.
+        """
+        container = self._get_container_name('solr')
+        address = self._reachable_address(container, SOLR_PORT)
+        if address:
+            probe = solr_probe(address)
+        else:
+            probe = exec_probe(container, [
+                'bash', '-c', 'exec 3<>/dev/tcp/127.0.0.1/8080'])
+        self._wait_for_container(container, 'solr', probe, timeout)
+
+    def _reachable_address(self, container, port):
+        """
+        Return the address of container if this host can connect to it,
+        otherwise services are probed from inside with docker exec
+        """
+        if is_boot2docker():
+            # container addresses aren't reachable from outside the VM
+            return None
+        address = container_address(container)
+        if address and address_reachable(address, port):
+            return address
+        return None
+
+    def _wait_for_container(self, container, description, probe, timeout):
+        try:
+            if not wait_for_ready(container, probe, timeout):
+                raise DatacatsError('Error while starting {0} container:\n'
+                                    .format(description) +
+                                    log_tail(container))
+        except ServiceTimeout:
+            raise DatacatsError('Timeout while starting {0} container. Logs:'
+                                .format(description) +
+                                log_tail(container))
 
     def _choose_port(self):
         """
@@ -605,23 +770,20 @@ class Environment(object):
         """
         Stop and remove the web container
         """
-        remove_container(self._get_container_name('web'), force=True)
-        remove_container(self._get_container_name('datapusher'), force=True)
+        task.stop_containers(self._get_container_name, task.KILLED_CONTAINERS)
 
     def _current_web_port(self):
         """
         return just the port number for the web container, or None if
         not running
         """
-        info = inspect_container(self._get_container_name('web'))
-        if info is None:
-            return None
-        try:
-            if not info['State']['Running']:
-                return None
-            return info['NetworkSettings']['Ports']['5000/tcp'][0]['HostPort']
-        except TypeError:
+        info = list_containers().get(self._get_container_name('web'))
+        if info is None or not container_running(info):
             return None
+        for port in info['Ports']:
+            if port['PrivatePort'] == 5000 and 'PublicPort' in port:
+                return str(port['PublicPort'])
+        return None
 
     def fully_running(self):
         """
@@ -655,6 +817,7 @@ class Environment(object):
 
         with open(self.target + '/.datacats-environment', 'w') as f:
             cp.write(f)
+        task.forget_config(self.target + '/.datacats-environment')
 
     def containers_running(self):
         """
@@ -697,7 +860,9 @@ class Environment(object):
 
     def interactive_shell(self, command=None, paster=False, detach=False):
         """
-        launch interactive shell session with all writable volumes
+        launch interactive shell session with all writable volumes. When the
+        web container was started with shell=True the shell runs in it with
+        docker exec, otherwise in a new container
 
         :param: list of strings to execute instead of bash
         """
@@ -709,6 +874,19 @@ class Environment(object):
             command = []
         use_tty = sys.stdin.isatty() and sys.stdout.isatty()
 
+        if paster:
+            if command and command != ['help'] and command != ['--help']:
+                command += ['--config=/project/development.ini']
+            command = [self.extension_dir] + command
+
+        if not detach and self.web_shell_available():
+            # much quicker than starting a new container
+            if paster:
+                command = ['/scripts/paster_cd.sh'] + command
+            return subprocess.call([
+                DOCKER_EXE, 'exec', '-i'] + (['-t'] if use_tty else []) + [
+                self._get_container_name('web'), '/scripts/shell_exec.sh'] + command)
+
         background = environ.get('CIRCLECI', False) or detach
 
         if is_boot2docker():
@@ -723,9 +901,6 @@ class Environment(object):
         script = scripts.get_script_path('shell.sh')
         if paster:
             script = scripts.get_script_path('paster.sh')
-            if command and command != ['help'] and command != ['--help']:
-                command += ['--config=/project/development.ini']
-            command = [self.extension_dir] + command
 
         proxy_settings = self._proxy_settings()
         if proxy_settings:
@@ -767,11 +942,14 @@ class Environment(object):
             ['--hostname', self.name,
             'datacats/web', '/scripts/shell.sh'] + command)
 
-    def install_package_requirements(self, psrc, stream_output=None):
+    def install_package_requirements(self, psrc, stream_output=None,
+                                     wheelhouse=None):
         """
         Install from requirements.txt file found in psrc
 
         :param psrc: name of directory in environment directory
+        :param wheelhouse: directory of wheels to install from instead of
+                           the package index, for offline installs
         """
         package = self.target + '/' + psrc
         assert isdir(package), package
@@ -785,14 +963,19 @@ class Environment(object):
             args=['/project/' + psrc + reqname],
             rw_venv=True,
             rw_project=True,
-            stream_output=stream_output
+            ro=_wheelhouse_mount(wheelhouse),
+            stream_output=stream_output,
+            pip_cache=True
             )
 
-    def install_package_develop(self, psrc, stream_output=None):
+    def install_package_develop(self, psrc, stream_output=None,
+                                wheelhouse=None):
         """
         Install a src package in place (setup.py develop)
 
         :param psrc: name of directory under project directory
+        :param wheelhouse: directory of wheels to install dependencies from
+                           instead of the package index
         """
         package = self.target + '/' + psrc
         assert isdir(package), package
@@ -803,11 +986,81 @@ class Environment(object):
             args=['/project/' + psrc],
             rw_venv=True,
             rw_project=True,
-            stream_output=stream_output
+            ro=_wheelhouse_mount(wheelhouse),
+            stream_output=stream_output,
+            pip_cache=True
+            )
+
+    def package_install_hashes(self, psrcs):
+        """
+        Return {name: hash of setup.py, setup.cfg and requirements files}
+        for the packages in psrcs
+
+        :param psrcs: names of directories in environment directory
+        """
+        return dict((psrc, task.package_install_hash(self.target, psrc))
+                    for psrc in psrcs)
+
+    def installed_package_hashes(self):
+        """
+        Return {name: hash} for packages recorded with
+        record_installed_packages
+        """
+        return task.load_install_manifest(self.datadir)
+
+    def record_installed_packages(self, hashes, clean=False):
+        """
+        Record packages as installed
+
+        :param hashes: {name: hash} from package_install_hashes
+        :param clean: True to forget all other packages, e.g. after the
+                      virtualenv was emptied
+        """
+        installed = {} if clean else self.installed_package_hashes()
+        installed.update(hashes)
+        task.save_install_manifest(self.datadir, installed)
+
+    def install_packages(self, develop, requirements, stream_output=None,
+                         wheelhouse=None):
+        """
+        Install src packages in place and the requirements of other (or the
+        same) packages with a single pip command, so pip resolves all of
+        them once
+
+        :param develop: names of directories under project directory to
+                        install in place
+        :param requirements: names of directories in environment directory
+                             with requirements.txt or pip-requirements.txt
+        :param wheelhouse: directory of wheels to install from instead of
+                           the package index
+        """
+        args = []
+        ro = _wheelhouse_mount(wheelhouse) or {}
+        if requirements:
+            if not isdir(self.sitedir + '/run'):
+                makedirs(self.sitedir + '/run')  # upgrade old datadir
+            reqfile = self.sitedir + '/run/requirements.txt'
+            with open(reqfile, 'w') as f:
+                f.write(task.merge_requirements(self.target, requirements, develop))
+            ro[reqfile] = '/requirements.txt'
+            args += ['-r', '/requirements.txt']
+        for psrc in develop:
+            args += ['-e', '/project/' + psrc]
+        if not args:
+            return
+        return self.user_run_script(
+            script=scripts.get_script_path('install_batch.sh'),
+            args=args,
+            rw_venv=True,
+            rw_project=True,
+            ro=ro,
+            stream_output=stream_output,
+            pip_cache=True
             )
 
     def user_run_script(self, script, args, db_links=False, rw_venv=False,
-                        rw_project=False, rw=None, ro=None, stream_output=None):
+                        rw_project=False, rw=None, ro=None, stream_output=None,
+                        pip_cache=False):
         return self.run_command(
             command=['/scripts/run_as_user.sh', '/scripts/run.sh'] + args,
             db_links=db_links,
@@ -818,17 +1071,37 @@ class Environment(object):
                 scripts.get_script_path('run_as_user.sh'): '/scripts/run_as_user.sh',
                 script: '/scripts/run.sh',
                 }),
-            stream_output=stream_output
+            stream_output=stream_output,
+            pip_cache=pip_cache
             )
 
     def run_command(self, command, db_links=False, rw_venv=False,
                     rw_project=False, rw=None, ro=None, clean_up=False,
-                    stream_output=None):
+                    stream_output=None, commit=False, pip_cache=False):
+        """
+        Run command in a web container with this environment's volumes
+
+        :param pip_cache: True to mount the pip cache shared with other
+                          environments of this CKAN version on /pip-cache,
+                          and pip_cache.sh which install scripts source
+        :param commit: True to save the resulting container as an image and
+                       return its id. Nothing in a normal run needs this, and
+                       committing costs an image layer per call.
+        """
 
         rw = {} if rw is None else dict(rw)
         ro = {} if ro is None else dict(ro)
 
+        if environ.get(WEB_WORKER_ENV) and not (commit or db_links or rw):
+            worker_command = _web_worker_command(command, ro)
+            if worker_command is not None:
+                return exec_command(self._start_web_worker(), worker_command,
+                                    stream_output=stream_output)
+
         ro.update(self._proxy_settings())
+        if pip_cache:
+            rw[cache.pip_cache_dir(self.ckan_version)] = '/pip-cache'
+            ro[scripts.get_script_path('pip_cache.sh')] = '/scripts/pip_cache.sh'
 
         if is_boot2docker():
             volumes_from = self._get_container_name('venv')
@@ -851,7 +1124,25 @@ class Environment(object):
 
         return web_command(command=command, ro=ro, rw=rw, links=links,
                            volumes_from=volumes_from, clean_up=clean_up,
-                           commit=True, stream_output=stream_output)
+                           commit=commit, stream_output=stream_output)
+
+    def _start_web_worker(self):
+        """
+        Start the web worker container for this environment if it isn't
+        running yet and return its name. It has the venv, project and pip
+        cache mounted read-write and all of our scripts under /scripts.
+        """
+        if is_boot2docker():
+            rw = {}
+            volumes_from = self._get_container_name('venv')
+        else:
+            rw = {self.datadir + '/venv': '/usr/lib/ckan'}
+            volumes_from = None
+        rw[self.target] = '/project'
+        rw[cache.pip_cache_dir(self.ckan_version)] = '/pip-cache'
+        ro = dict({scripts.SCRIPTS_DIR: '/scripts'}, **self._proxy_settings())
+        return start_web_worker(self._get_container_name('worker'), ro=ro,
+                                rw=rw, volumes_from=volumes_from)
 
     def purge_data(self, which_sites=None, never_delete=False):
         """
@@ -906,6 +1197,7 @@ class Environment(object):
                 if self.target:
                     with open(self.target + '/.datacats-environment', 'w') as conf:
                         cp.write(conf)
+                    task.forget_config(self.target + '/.datacats-environment')
 
             datadirs = ['sites/' + datadir for datadir in datadirs]
 
@@ -937,6 +1229,22 @@ class Environment(object):
             follow,
             timestamps)
 
+    def follow_all_logs(self, since=None, pattern=None):
+        """
+        Follow the logs of every container of this site at once.
+
+        :param since: unix timestamp of the earliest output to include
+        :param pattern: compiled regular expression to filter lines with
+
+        Returns a generator of (container, timestamp, line), see
+        datacats.docker.multiplex_logs
+        """
+        containers = dict(
+            (self._get_container_name(c), c)
+            for c in (r.replace('(halted)', '') for r in self.containers_running()))
+        for name, timestamp, line in multiplex_logs(containers, since, pattern):
+            yield containers[name], timestamp, line
+
     def compile_less(self):
         c = run_container(
             name=self._get_container_name('lessc'), image='datacats/lessc',
@@ -995,6 +1303,7 @@ class Environment(object):
             - 'lessc'
             - 'datapusher'
             - 'redis'
+            - 'worker'
         The name will be formatted appropriately with any prefixes and postfixes
         needed.
 
@@ -1006,5 +1315,32 @@ class Environment(object):
             return 'datacats_{}_{}_{}'.format(container_type, self.name, self.site_name)
 
 
+def _wheelhouse_mount(wheelhouse):
+    """
+    Return ro mounts for an offline install from wheelhouse, if given
+    """
+    if not wheelhouse:
+        return None
+    return {abspath(wheelhouse): '/wheelhouse'}
+
+
+def _web_worker_command(command, ro):
+    """
+    Return command adjusted to run in the web worker container, where the
+    whole scripts directory is mounted on /scripts instead of individual
+    scripts, or None if ro mounts anything that isn't one of our scripts.
+    """
+    targets = {}
+    for src, bind in ro.iteritems():
+        if dirname(src) != scripts.SCRIPTS_DIR:
+            return None
+        targets[bind] = '/scripts/' + basename(src)
+    if isinstance(command, basestring):
+        if any(bind != target for bind, target in targets.iteritems()):
+            return None
+        return command
+    return [targets.get(c, c) for c in command]
+
+
 def posix_quote(s):
     return "\\'".join("'" + p + "'" for p in s.split("'"))
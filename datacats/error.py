@@ -1,11 +1,10 @@
-from clint.textui import colored
-
-
 class DatacatsError(Exception):
 
     def __init__(self, message, parent_exception=None):
         self.message = message
         if parent_exception and hasattr(parent_exception, 'user_description'):
+            # imported here to keep "datacats --help" fast
+            from clint.textui import colored
             vals = {
                 "original": self.message,
                 "type_description": parent_exception.user_description,
@@ -26,6 +25,7 @@ class DatacatsError(Exception):
         """
         Print the error message to stdout with colors and borders
         """
+        from clint.textui import colored
         print colored.blue("-" * 40)
         print colored.red("datacats: problem was encountered:")
         print self.message
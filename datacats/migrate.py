@@ -61,6 +61,8 @@ This migration is necessary to support multiple sites within the same environmen
 Your current site will be kept and will be named "primary".
 
 Would you like to continue the migration? (y/n) [n]:"""
+    # datacats.task imports this module
+    from datacats.task import forget_config
     new_site_name = 'primary'
 
     split = _split_path(datadir)
@@ -114,6 +116,7 @@ Would you like to continue the migration? (y/n) [n]:"""
 
     with open(config_loc, 'w') as config:
         cp.write(config)
+    forget_config(config_loc)
 
     # Make a session secret for it (make it per-site)
     cp = SafeConfigParser()
@@ -125,6 +128,7 @@ Would you like to continue the migration? (y/n) [n]:"""
 
     with open(config_loc, 'w') as config:
         cp.write(config)
+    forget_config(config_loc)
 
     with open(path_join(datadir, '.version'), 'w') as f:
         f.write('2')
@@ -138,6 +142,8 @@ This format version doesn't support multiple sites, and after this only your
 wish to do a migration back to a version which supports multisite.
 
 Would you like to continue the migration? (y/n) [n]:"""
+    # datacats.task imports this module
+    from datacats.task import forget_config
     _, env_name = _split_path(datadir)
 
     print 'Making sure that containers are stopped...'
@@ -179,6 +185,7 @@ Would you like to continue the migration? (y/n) [n]:"""
 
     with open(datacats_env_location, 'w') as config:
         cp.write(config)
+    forget_config(datacats_env_location)
 
     cp = SafeConfigParser()
     cp.read(path_join(datadir, 'passwords.ini'))
@@ -188,6 +195,7 @@ Would you like to continue the migration? (y/n) [n]:"""
 
     with open(path_join(datadir, 'passwords.ini'), 'w') as config:
         cp.write(config)
+    forget_config(path_join(datadir, 'passwords.ini'))
 
 
 migrations = {
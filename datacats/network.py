@@ -5,47 +5,230 @@
 # See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
 
 import time
+import errno
+import random
+import socket
+import struct
+from threading import Thread, Event
 from requests import get, ConnectionError, Timeout
 
-from datacats.docker import inspect_container
+from datacats.docker import (inspect_container, container_events,
+                             exec_command, APIError)
+from datacats.error import WebCommandError
 
 
 class ServiceTimeout(Exception):
     pass
 
 RETRY_DELAY_SECONDS = 0.1
+MAX_RETRY_DELAY_SECONDS = 2
 READ_TIMEOUT_SECONDS = 0.1
 REQUEST_TIMEOUT_SECONDS = 3
+REACHABLE_TIMEOUT_SECONDS = 1
+WATCH_WINDOW_SECONDS = 2
 
+POSTGRES_PORT = 5432
+SOLR_PORT = 8080
+# StartupMessage for protocol 3.0 as user postgres, see
+# http://www.postgresql.org/docs/9.3/static/protocol-message-formats.html
+_PG_STARTUP_BODY = struct.pack('!i', 196608) + 'user\0postgres\0\0'
+PG_STARTUP_MESSAGE = struct.pack('!i', len(_PG_STARTUP_BODY) + 4) + _PG_STARTUP_BODY
+# SQLSTATE sent while postgres is starting up or shutting down
+PG_CANNOT_CONNECT_NOW = '57P03'
 
-def wait_for_service_available(container, url, timeout):
+
+def address_reachable(host, port, timeout=REACHABLE_TIMEOUT_SECONDS):
     """
-    Wait up to timeout seconds for service at host:port
-    to start.
+    Return True if this host can connect to host:port, or at least reach
+    host, which refuses the connection if nothing listens on port yet.
+    Container addresses can't be reached with Docker for Mac, remote
+    daemons or rootless Docker.
+    """
+    try:
+        socket.create_connection((host, port), timeout).close()
+    except socket.error as e:
+        return e.errno == errno.ECONNREFUSED
+    return True
 
-    Returns True if service becomes available, False if the
-    container stops or raises ServiceTimeout if timeout is
-    reached.
+
+def http_probe(url, retry_server_errors=False):
     """
-    start = time.time()
-    remaining = timeout
-    while True:
-        remaining = start + timeout - time.time()
-        if remaining < 0:
-            raise ServiceTimeout
+    Return a probe for wait_for_ready that GETs url. Any response is
+    ready, except 5xx responses which are failures, or not ready yet
+    with retry_server_errors.
+    """
+    def probe(remaining):
         try:
             response = get(url,
                 timeout=min(remaining, REQUEST_TIMEOUT_SECONDS))
-            if 500 <= response.status_code < 600:
-                return False
-            return True
         except (ConnectionError, Timeout):
+            return None
+        if 500 <= response.status_code < 600:
+            return None if retry_server_errors else False
+        return True
+    return probe
+
+
+def solr_probe(host, port=SOLR_PORT):
+    """
+    Return a probe for wait_for_ready that pings solr's admin handler,
+    which answers 500 or 503 while the cores are still loading
+    """
+    return http_probe('http://{0}:{1}/solr/admin/ping'.format(host, port),
+                      retry_server_errors=True)
+
+
+def postgres_probe(host, port=POSTGRES_PORT):
+    """
+    Return a probe for wait_for_ready that checks postgres accepts
+    connections the way pg_isready does: send a startup message and treat
+    any reply other than "the database system is starting up" as ready.
+    """
+    def probe(remaining):
+        try:
+            conn = socket.create_connection(
+                (host, port), min(remaining, REQUEST_TIMEOUT_SECONDS))
+        except socket.error:
+            return None
+        try:
+            conn.sendall(PG_STARTUP_MESSAGE)
+            reply = conn.recv(1024)
+        except socket.error:
+            return None
+        finally:
+            conn.close()
+        # 'R' is an authentication request, other errors (bad password etc.)
+        # still mean the server is taking connections
+        if reply[:1] not in ('R', 'E') or PG_CANNOT_CONNECT_NOW in reply:
+            return None
+        return True
+    return probe
+
+
+def exec_probe(container, command):
+    """
+    Return a probe for wait_for_ready that runs command inside container
+    with docker exec and is ready when it exits successfully. Useful when
+    container addresses can't be reached from this host (boot2docker).
+    """
+    def probe(remaining):
+        # pylint: disable=unused-argument
+        try:
+            exec_command(container, command)
+        except (WebCommandError, APIError):
+            return None
+        return True
+    return probe
+
+
+class _DeathWatch(object):
+    """
+    Follow the Docker events stream in a background thread and set
+    self.died as soon as container emits a die event. self.stopped is set
+    if the stream ends or fails first, callers should then poll instead.
+
+    The stream is read in windows of WATCH_WINDOW_SECONDS so that close()
+    releases the thread and its connection soon after the wait is over.
+    """
+    def __init__(self, container, until):
+        self.container = container
+        self.until = until
+        self.died = Event()
+        self.stopped = Event()
+        self._closed = Event()
+        self._thread = Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        since = int(time.time()) - 1
+        try:
+            while not self._closed.is_set() and since <= self.until:
+                until = since + WATCH_WINDOW_SECONDS
+                for _ in container_events(self.container, 'die',
+                                          since=since, until=until):
+                    self.died.set()
+                    return
+                if time.time() < until - 1:
+                    # the daemon ended the stream early
+                    break
+                since = until
+        except (APIError, ConnectionError, ValueError):
             pass
-        if not inspect_container(container)['State']['Running']:
-            return False
+        self.stopped.set()
+
+    def close(self):
+        """
+        Stop following the events stream once the current window ends
+        """
+        self._closed.set()
+
+    def wait(self, seconds):
+        """
+        Sleep up to seconds, waking early if the container dies.
+        Returns True if the container died.
+        """
+        if self.stopped.is_set():
+            time.sleep(seconds)
+        else:
+            self.died.wait(seconds)
+        return self.died.is_set()
+
+
+def _running(container):
+    info = inspect_container(container)
+    return bool(info and info['State']['Running'])
 
-        remaining = start + timeout - time.time()
-        delay = max(0, min(RETRY_DELAY_SECONDS, remaining))
-        time.sleep(delay)
 
-    raise ServiceTimeout
+def wait_for_ready(container, probe, timeout):
+    """
+    Wait up to timeout seconds for probe to report that the service in
+    container is ready.
+
+    probe(remaining_seconds) returns True when ready, False when the
+    service has failed or None to try again. It is retried with
+    exponential backoff and jitter while a die event from the Docker
+    events stream ends the wait early.
+
+    Returns True if the service becomes available, False if the probe
+    fails or the container stops, or raises ServiceTimeout if timeout is
+    reached.
+    """
+    start = time.time()
+    if not _running(container):
+        return False
+    watch = _DeathWatch(container, start + timeout)
+    try:
+        delay = RETRY_DELAY_SECONDS
+        while True:
+            remaining = start + timeout - time.time()
+            if remaining <= 0:
+                raise ServiceTimeout
+            result = probe(remaining)
+            if result is not None:
+                return result
+            if watch.died.is_set():
+                return False
+            if watch.stopped.is_set() and not _running(container):
+                return False
+
+            remaining = start + timeout - time.time()
+            if remaining <= 0:
+                raise ServiceTimeout
+            if watch.wait(min(remaining, delay * random.uniform(0.5, 1))):
+                return False
+            delay = min(delay * 2, MAX_RETRY_DELAY_SECONDS)
+    finally:
+        watch.close()
+
+
+def wait_for_service_available(container, url, timeout):
+    """
+    Wait up to timeout seconds for service at host:port
+    to start.
+
+    Returns True if service becomes available, False if the
+    container stops or raises ServiceTimeout if timeout is
+    reached.
+    """
+    return wait_for_ready(container, http_probe(url), timeout)
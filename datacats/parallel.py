@@ -0,0 +1,107 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import sys
+import time
+from Queue import Queue
+from threading import Thread
+from multiprocessing.pool import ThreadPool
+
+# AsyncResult.get needs a timeout to be interruptible with ^C on python 2
+_FOREVER_SECONDS = 60 * 60 * 24 * 365
+
+
+def run_parallel(fn, items, workers=None):
+    """
+    Call fn(item) for each item in a pool of threads and return the results
+    in the same order as items. If any call raises, the first exception is
+    re-raised after the remaining calls have finished.
+
+    :param workers: maximum number of calls at once, default: one per item
+    """
+    items = list(items)
+    if not items:
+        return []
+    pool = ThreadPool(min(workers or len(items), len(items)))
+    results = [pool.apply_async(fn, (item,)) for item in items]
+    pool.close()
+    # wait for every call, not just up to the first failure, so callers
+    # can clean up without racing calls that are still running
+    for result in results:
+        result.wait(_FOREVER_SECONDS)
+    return [result.get() for result in results]
+
+
+class Step(object):
+    """
+    A unit of work for run_steps. fn is called with no arguments once all
+    the steps named in requires have finished successfully.
+    """
+    def __init__(self, name, fn, requires=()):
+        self.name = name
+        self.fn = fn
+        self.requires = frozenset(requires)
+
+
+def run_steps(steps, on_done=None):
+    """
+    Run each of steps in its own thread as soon as the steps it requires
+    have finished, so independent steps run in parallel.
+
+    If a step raises, no more steps are started (so everything downstream
+    of it is cancelled), steps already running are allowed to finish and
+    then the first exception is re-raised.
+
+    :param on_done: called with each step's name when it finishes
+    :returns: [(step name, seconds taken)] in the order steps finished
+    """
+    names = set(s.name for s in steps)
+    for s in steps:
+        if not s.requires <= names:
+            raise ValueError('Step {0} requires unknown steps: {1}'.format(
+                s.name, ', '.join(sorted(s.requires - names))))
+
+    finished = Queue()
+
+    def run(step):
+        start = time.time()
+        try:
+            step.fn()
+            finished.put((step, time.time() - start, None))
+        except:  # pylint: disable=bare-except
+            finished.put((step, time.time() - start, sys.exc_info()))
+
+    pending = list(steps)
+    running = set()
+    done = set()
+    timings = []
+    error = None
+    while True:
+        if error is None:
+            for step in [s for s in pending if s.requires <= done]:
+                pending.remove(step)
+                running.add(step.name)
+                thread = Thread(target=run, args=(step,))
+                thread.daemon = True
+                thread.start()
+        if not running:
+            break
+        step, seconds, exc_info = finished.get(True, _FOREVER_SECONDS)
+        running.remove(step.name)
+        if exc_info:
+            error = error or exc_info
+            continue
+        done.add(step.name)
+        timings.append((step.name, seconds))
+        if on_done:
+            on_done(step.name)
+
+    if error:
+        raise error[0], error[1], error[2]
+    if pending:
+        raise ValueError('Steps have circular requirements: {0}'.format(
+            ', '.join(sorted(s.name for s in pending))))
+    return timings
@@ -1,5 +1,12 @@
 #!/bin/bash
 
 source /usr/lib/ckan/bin/activate
+source /scripts/pip_cache.sh
+
+if [ -d /wheelhouse ]; then
+    "$PIP" install $PIP_OPTIONS ckanapi ckanserviceprovider
+    exit
+fi
+
 pip install ckanapi
 pip install -e git+https://github.com/ckan/ckan-service-provider#egg=ckanserviceprovider
@@ -13,4 +13,6 @@ if [ -e /etc/environment ]; then
     export http_proxy HTTP_PROXY https_proxy HTTPS_PROXY no_proxy NO_PROXY
 fi
 
-/usr/lib/ckan/bin/pip install -e "$1"
+source /scripts/pip_cache.sh
+
+"$PIP" install $PIP_OPTIONS -e "$1"
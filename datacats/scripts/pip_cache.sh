@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+# sourced by the scripts that install packages, sets $PIP and the
+# $PIP_OPTIONS to install with
+
+PIP=/usr/lib/ckan/bin/pip
+PIP_OPTIONS=
+# shared wheel cache, see datacats/cache.py
+if [ -d /pip-cache ]; then
+    if "$PIP" --version | grep -q '^pip [0-5]\.'; then
+        export PIP_DOWNLOAD_CACHE=/pip-cache/downloads
+    else
+        export PIP_CACHE_DIR=/pip-cache
+    fi
+fi
+# offline install: datacats install --wheelhouse
+if [ -d /wheelhouse ]; then
+    PIP_OPTIONS="--no-index --find-links=/wheelhouse"
+fi
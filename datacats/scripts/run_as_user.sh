@@ -8,8 +8,13 @@
 
 set -e
 
-userdel www-data
+# may run more than once in the same web worker container
+if id -u www-data >/dev/null 2>&1; then
+    userdel www-data
+fi
 
-useradd -d /project -u $(stat -c %u /project) -M -s /bin/bash shell
+if ! id -u shell >/dev/null 2>&1; then
+    useradd -d /project -u $(stat -c %u /project) -M -s /bin/bash shell
+fi
 
 sudo -i -u shell "$@"
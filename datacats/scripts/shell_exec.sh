@@ -0,0 +1,21 @@
+#!/bin/bash
+
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+set -e
+
+# run with docker exec in the web container, where www-data is serving
+# CKAN and can't be removed like shell.sh does, so share its uid if needed
+if ! id -u shell >/dev/null 2>&1; then
+    useradd -o -d /project -u $(stat -c %u /project) -M -s /bin/bash shell
+fi
+
+if [ "$#" -eq 0 ]; then
+    su -l shell
+else
+    sudo -i -u shell "$@"
+fi
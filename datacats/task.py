@@ -13,16 +13,66 @@ separated from their configuration object to make them easier to test.
 # inside these modules more easily
 import os
 from os import path
+import errno
 import ConfigParser
+import re
+import json
+import hashlib
+import stat
 import shutil
+import time
 
-from datacats import docker, validate, migrate
+from datacats import docker, validate, migrate, cache
 from datacats.error import DatacatsError
+from datacats.parallel import run_parallel, run_steps, Step
 from datacats.cli.pull import retrying_pull_image
 
+try:
+    # a faster directory listing than os.listdir + os.lstat, optional
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 
 DEFAULT_REMOTE_SERVER_TARGET = 'datacats@command.datacats.com'
 
+# {filename: ((mtime, size), SafeConfigParser)}, see read_config
+_configs = {}
+
+
+def read_config(filename):
+    """
+    Return a SafeConfigParser with filename read, parsing it again only if
+    its mtime or size changed since last time. The parser returned is
+    shared, don't modify it.
+
+    Raises ConfigParser.Error if filename can't be parsed.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        # read() ignores missing files
+        key = None
+    else:
+        key = (st.st_mtime, st.st_size)
+    cached = _configs.get(filename)
+    if key is not None and cached and cached[0] == key:
+        return cached[1]
+
+    cp = ConfigParser.SafeConfigParser()
+    cp.read([filename])
+    if key is not None:
+        _configs[filename] = (key, cp)
+    return cp
+
+
+def forget_config(filename):
+    """
+    Call after writing filename so read_config doesn't return the old
+    contents if the mtime and size happen to be the same
+    """
+    _configs.pop(filename, None)
+
 
 def list_sites(datadir):
     """
@@ -62,6 +112,7 @@ def save_new_site(site_name, sitedir, srcdir, port, address, site_url,
 
     with open(srcdir + '/.datacats-environment', 'w') as config:
         cp.write(config)
+    forget_config(srcdir + '/.datacats-environment')
 
     # save passwords to datadir
     cp = ConfigParser.SafeConfigParser()
@@ -73,6 +124,7 @@ def save_new_site(site_name, sitedir, srcdir, port, address, site_url,
     # Write to the sitedir so we maintain separate passwords.
     with open(sitedir + '/passwords.ini', 'w') as config:
         cp.write(config)
+    forget_config(sitedir + '/passwords.ini')
 
 
 def save_new_environment(name, datadir, srcdir, ckan_version,
@@ -102,6 +154,7 @@ def save_new_environment(name, datadir, srcdir, ckan_version,
 
     with open(srcdir + '/.datacats-environment', 'w') as config:
         cp.write(config)
+    forget_config(srcdir + '/.datacats-environment')
 
     save_srcdir_location(datadir, srcdir)
 
@@ -184,9 +237,8 @@ def load_environment(srcdir, datadir=None, allow_old=False):
     Returns (datadir, name, ckan_version, always_prod, deploy_target,
              remote_server_key)
     """
-    cp = ConfigParser.SafeConfigParser()
     try:
-        cp.read([srcdir + '/.datacats-environment'])
+        cp = read_config(srcdir + '/.datacats-environment')
     except ConfigParser.Error:
         raise DatacatsError('Error reading environment information')
 
@@ -258,12 +310,35 @@ def load_site(srcdir, datadir, site_name=None):
     if not validate.valid_name(site_name):
         raise DatacatsError('{} is not a valid site name.'.format(site_name))
 
-    cp = ConfigParser.SafeConfigParser()
     try:
-        cp.read([srcdir + '/.datacats-environment'])
+        cp = read_config(srcdir + '/.datacats-environment')
     except ConfigParser.Error:
         raise DatacatsError('Error reading environment information')
 
+    return _site_settings(cp, datadir, site_name)
+
+
+def load_all_sites(srcdir, datadir):
+    """
+    Load configuration values for every site in datadir, reading the
+    environment configuration once.
+
+    Returns {site name: (port, address, site_url, passwords)}
+    """
+    try:
+        cp = read_config(srcdir + '/.datacats-environment')
+    except ConfigParser.Error:
+        raise DatacatsError('Error reading environment information')
+
+    return dict((site_name, _site_settings(cp, datadir, site_name))
+                for site_name in list_sites(datadir))
+
+
+def _site_settings(cp, datadir, site_name):
+    """
+    Return (port, address, site_url, passwords) for site_name from the
+    environment configuration cp and the site's passwords.ini
+    """
     site_section = 'site_' + site_name
     try:
         port = cp.getint(site_section, 'port')
@@ -279,8 +354,10 @@ def load_site(srcdir, datadir, site_name=None):
         site_url = None
 
     passwords = {}
-    cp = ConfigParser.SafeConfigParser()
-    cp.read(datadir + '/sites/' + site_name + '/passwords.ini')
+    try:
+        cp = read_config(datadir + '/sites/' + site_name + '/passwords.ini')
+    except ConfigParser.Error:
+        raise DatacatsError('Error reading passwords for site {0}'.format(site_name))
     try:
         pw_options = cp.options('passwords')
     except ConfigParser.NoSectionError:
@@ -358,8 +435,8 @@ def data_complete(datadir, sitedir, get_container_name):
         return False
 
     if docker.is_boot2docker():
-        # Inspect returns None if the container doesn't exist.
-        return all(docker.inspect_container(get_container_name(x))
+        containers = docker.list_containers()
+        return all(get_container_name(x) in containers
                 for x in ('pgdata', 'venv'))
 
     return path.isdir(datadir + '/venv') and path.isdir(sitedir + '/postgres')
@@ -406,38 +483,30 @@ def create_virtualenv(srcdir, datadir, preload_image, get_container_name):
     """
     Populate venv from preloaded image
     """
-    try:
-        if docker.is_boot2docker():
-            docker.data_only_container(
-                get_container_name('venv'),
-                ['/usr/lib/ckan'],
-                )
-            img_id = docker.web_command(
-                '/bin/mv /usr/lib/ckan/ /usr/lib/ckan_original',
-                image=preload_image,
-                commit=True,
-                )
-            docker.web_command(
-                command='/bin/cp -a /usr/lib/ckan_original/. /usr/lib/ckan/.',
-                volumes_from=get_container_name('venv'),
-                image=img_id,
-                )
-            docker.remove_image(img_id)
-            return
+    if not docker.is_boot2docker():
+        return extract_preload(srcdir, datadir, preload_image, source=False)
 
-        docker.web_command(
-            command='/bin/cp -a /usr/lib/ckan/. /usr/lib/ckan_target/.',
-            rw={datadir + '/venv': '/usr/lib/ckan_target'},
+    try:
+        docker.data_only_container(
+            get_container_name('venv'),
+            ['/usr/lib/ckan'],
+            )
+        img_id = docker.web_command(
+            '/bin/mv /usr/lib/ckan/ /usr/lib/ckan_original',
             image=preload_image,
+            commit=True,
             )
+        docker.web_command(
+            command='/bin/cp -a /usr/lib/ckan_original/. /usr/lib/ckan/.',
+            volumes_from=get_container_name('venv'),
+            image=img_id,
+            )
+        docker.remove_image(img_id)
     finally:
-        rw = {datadir + '/venv': '/usr/lib/ckan'} if not docker.is_boot2docker() else {}
-        volumes_from = get_container_name('venv') if docker.is_boot2docker() else None
         # fix venv permissions
         docker.web_command(
             command='/bin/chown -R --reference=/project /usr/lib/ckan',
-            rw=rw,
-            volumes_from=volumes_from,
+            volumes_from=get_container_name('venv'),
             ro={srcdir: '/project'},
             )
 
@@ -447,28 +516,80 @@ def create_source(srcdir, preload_image, datapusher=False):
     Copy ckan source, datapusher source (optional), who.ini and schema.xml
     from preload image into srcdir
     """
-    try:
+    extract_preload(srcdir, None, preload_image, venv=False,
+                    datapusher=datapusher)
+
+
+def extract_preload(srcdir, datadir, preload_image, venv=True, source=True,
+                    datapusher=False):
+    """
+    Copy the virtualenv into datadir/venv and the ckan source, datapusher
+    source (optional), who.ini and schema.xml into srcdir from the preload
+    image in a single pass.
+
+    The directories are streamed straight out of the image when the
+    Docker daemon supports it and cloned from the host-side cache (see
+    datacats.cache) after the first time, otherwise they are copied by a
+    single container. Not for the boot2docker venv, see create_virtualenv.
+    """
+    copies = {}
+    if venv:
+        copies['/usr/lib/ckan'] = datadir + '/venv'
+    if source:
+        copies['/project/ckan'] = srcdir + '/ckan'
+        if datapusher:
+            copies['/project/datapusher'] = srcdir + '/datapusher'
+
+    if docker.archive_supported():
+        for target in copies.values():
+            if not path.isdir(target):
+                os.makedirs(target)
+        owner = None
+        if os.geteuid() == 0:
+            st = os.stat(srcdir)
+            owner = (st.st_uid, st.st_gid)
+        cached = cache.preload_dirs(preload_image, sorted(copies))
+        if cached is None:
+            docker.extract_from_image(preload_image, copies, owner)
+        else:
+            # the source trees are edited in place, never hardlink them
+            run_parallel(lambda src: cache.clone_tree(
+                cached[src], copies[src], owner,
+                hardlink=None if src == '/usr/lib/ckan' else False), copies)
+    else:
+        rw = {srcdir: '/project_target'}
+        if venv:
+            rw[datadir + '/venv'] = '/usr/lib/ckan_target'
+        commands = []
+        for src in sorted(copies):
+            commands.append('/bin/mkdir -p {0} && /bin/cp -a {1}/. {0}/.'.format(
+                _preload_target(src), src))
+        # fix permissions even if a copy fails
+        script = '{0}; rval=$?; {1}; exit $rval'.format(
+            ' && '.join(commands),
+            '/bin/chown -R --reference=/project_target /project_target' +
+            (' /usr/lib/ckan_target' if venv else ''))
         docker.web_command(
-            command='/bin/cp -a /project/ckan /project_target/ckan',
-            rw={srcdir: '/project_target'},
+            command=['/bin/sh', '-c', script],
+            rw=rw,
             image=preload_image)
-        if datapusher:
-            docker.web_command(
-                command='/bin/cp -a /project/datapusher /project_target/datapusher',
-                rw={srcdir: '/project_target'},
-                image=preload_image)
+
+    if source:
         shutil.copy(
             srcdir + '/ckan/ckan/config/who.ini',
             srcdir)
         shutil.copy(
             srcdir + '/ckan/ckan/config/solr/schema.xml',
             srcdir)
-    finally:
-        # fix srcdir permissions
-        docker.web_command(
-            command='/bin/chown -R --reference=/project /project',
-            rw={srcdir: '/project'},
-            )
+
+
+def _preload_target(src):
+    """
+    Where extract_preload's fallback container copies src to
+    """
+    if src == '/usr/lib/ckan':
+        return '/usr/lib/ckan_target'
+    return '/project_target/' + src.split('/')[-1]
 
 
 # Maps container extra names to actual names
@@ -476,11 +597,20 @@ EXTRA_IMAGE_MAPPING = {'redis': 'redis'}
 
 
 def start_supporting_containers(sitedir, srcdir, passwords,
-        get_container_name, extra_containers, log_syslog=False):
+        get_container_name, extra_containers, log_syslog=False,
+        ready_checks=None):
     """
     Start all supporting containers (containers required for CKAN to
     operate) if they aren't already running, along with some extra
     containers specified by the user
+
+    The containers don't depend on each other so they are all started at
+    once. ready_checks may map container types to functions that block
+    until that container is ready to use; each is run as soon as its
+    container has started and this returns once all of them are done.
+
+    :returns: {container type: seconds until it was started and ready}
+              for the containers that were started
     """
     if docker.is_boot2docker():
         docker.data_only_container(get_container_name('pgdata'),
@@ -495,61 +625,271 @@ def start_supporting_containers(sitedir, srcdir, passwords,
 
     needed = set(extra_containers).union({'postgres', 'solr'})
 
-    if not needed.issubset(running):
-        stop_supporting_containers(get_container_name, extra_containers)
+    if needed.issubset(running):
+        return {}
+
+    stop_supporting_containers(get_container_name, extra_containers)
 
+    containers = {
         # users are created when data dir is blank so we must pass
         # all the user passwords as environment vars
         # XXX: postgres entrypoint magic
-        docker.run_container(
-            name=get_container_name('postgres'),
+        'postgres': dict(
             image='datacats/postgres',
             environment=passwords,
             rw=rw,
-            volumes_from=volumes_from,
-            log_syslog=log_syslog)
-
-        docker.run_container(
-            name=get_container_name('solr'),
+            volumes_from=volumes_from),
+        'solr': dict(
             image='datacats/solr',
             rw={sitedir + '/solr': '/var/lib/solr'},
-            ro={srcdir + '/schema.xml': '/etc/solr/conf/schema.xml'},
-            log_syslog=log_syslog)
-
-        for container in extra_containers:
-            # We don't know a whole lot about the extra containers so we're just gonna have to
-            # mount /project and /datadir r/o even if they're not needed for ease of
-            # implementation.
-            docker.run_container(
-                name=get_container_name(container),
-                image=EXTRA_IMAGE_MAPPING[container],
-                ro={
-                    sitedir: '/datadir',
-                    srcdir: '/project'
-                },
-                log_syslog=log_syslog
-            )
+            ro={srcdir + '/schema.xml': '/etc/solr/conf/schema.xml'}),
+        }
+
+    for container in extra_containers:
+        # We don't know a whole lot about the extra containers so we're just gonna have to
+        # mount /project and /datadir r/o even if they're not needed for ease of
+        # implementation.
+        containers[container] = dict(
+            image=EXTRA_IMAGE_MAPPING[container],
+            ro={
+                sitedir: '/datadir',
+                srcdir: '/project'
+            })
+
+    ready_checks = ready_checks or {}
+
+    def start(container):
+        started = time.time()
+        docker.run_container(
+            name=get_container_name(container),
+            log_syslog=log_syslog,
+            **containers[container])
+        if container in ready_checks:
+            ready_checks[container]()
+        return container, time.time() - started
+
+    return dict(run_parallel(start, sorted(containers)))
+
+
+# containers killed without waiting for them to shut down
+KILLED_CONTAINERS = ('web', 'datapusher')
+# seconds containers get to shut down after SIGTERM before they are
+# killed when stopping fast, postgres keeps Docker's default to shut down
+# cleanly. Extra containers not listed get FAST_STOP_GRACE_SECONDS
+FAST_STOP_GRACE = {'postgres': None}
+FAST_STOP_GRACE_SECONDS = 1
+
+
+def stop_containers(get_container_name, containers, fast=False):
+    """
+    Stop and remove containers (eg. ['web', 'postgres']) at the same time.
+    web and datapusher are killed, postgres waits for them to be gone so
+    it can shut down cleanly and the rest get Docker's default 10 seconds
+    to stop, or FAST_STOP_GRACE_SECONDS if fast is True.
+    """
+    def stopper(container):
+        if container in KILLED_CONTAINERS:
+            return lambda: docker.remove_container(
+                get_container_name(container), force=True)
+        grace = (FAST_STOP_GRACE.get(container, FAST_STOP_GRACE_SECONDS)
+                 if fast else None)
+        return lambda: docker.remove_container(
+            get_container_name(container), grace=grace)
+
+    run_steps([
+        Step(c, stopper(c), requires=[k for k in KILLED_CONTAINERS
+                                      if c == 'postgres' and k in containers])
+        for c in containers])
 
 
-def stop_supporting_containers(get_container_name, extra_containers):
+def stop_supporting_containers(get_container_name, extra_containers, fast=False):
     """
     Stop postgres and solr containers, along with any specified extra containers
     """
-    docker.remove_container(get_container_name('postgres'))
-    docker.remove_container(get_container_name('solr'))
-    for container in extra_containers:
-        docker.remove_container(get_container_name(container))
+    stop_containers(get_container_name,
+                    ['postgres', 'solr'] + list(extra_containers), fast)
 
 
 def containers_running(get_container_name):
     """
     Return a list of containers tracked by this environment that are running
     """
+    containers = docker.list_containers()
     running = []
     for n in ['web', 'postgres', 'solr', 'datapusher', 'redis']:
-        info = docker.inspect_container(get_container_name(n))
-        if info and not info['State']['Running']:
+        info = containers.get(get_container_name(n))
+        if info and not docker.container_running(info):
             running.append(n + '(halted)')
         elif info:
             running.append(n)
     return running
+
+
+# the project name at the start of a requirement line
+REQUIREMENT_NAME_RE = re.compile(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*([<>=!~;\[]|$)')
+# options that take a path relative to the requirements file
+REQUIREMENT_PATH_OPTIONS = ('-r', '--requirement', '-c', '--constraint')
+
+
+def _project_key(name):
+    """
+    Return name normalized the way pip compares project names
+    """
+    return name.lower().replace('_', '-')
+
+
+def merge_requirements(srcdir, psrcs, develop=()):
+    """
+    Return the text of one requirements file (as seen from inside a
+    container with srcdir on /project) that combines the requirements files
+    of the packages in psrcs.
+
+    pip refuses a project required twice in one command, so the first
+    requirement line for each project wins and later ones are dropped with
+    a comment, e.g. ckan's pins win over an extension's when ckan is
+    first. Requirements for the packages in develop are dropped because
+    they are installed from source in the same command. Relative includes
+    are made absolute.
+    """
+    seen = dict((_project_key(name), '-e /project/' + name) for name in develop)
+    lines = []
+    for psrc in psrcs:
+        reqname = 'requirements.txt'
+        if not path.exists(path.join(srcdir, psrc, reqname)):
+            reqname = 'pip-requirements.txt'
+        with open(path.join(srcdir, psrc, reqname)) as f:
+            lines.append('# /project/{0}/{1}'.format(psrc, reqname))
+            for line in f:
+                line = line.split(' #')[0].strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split(None, 1)
+                if len(parts) == 2 and parts[0] in REQUIREMENT_PATH_OPTIONS:
+                    line = '{0} {1}'.format(parts[0], path.join(
+                        '/project', psrc, parts[1]))
+                match = REQUIREMENT_NAME_RE.match(line)
+                if match:
+                    name = _project_key(match.group(1))
+                    if name in seen:
+                        if line != seen[name]:
+                            lines.append('# {0} (using {1})'.format(line, seen[name]))
+                        continue
+                    seen[name] = line
+                elif line in lines:
+                    continue
+                lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+# records what "datacats install" installed, in the datadir
+INSTALL_MANIFEST = 'install-manifest.json'
+# the files in a package that decide what installing it does
+PACKAGE_INSTALL_FILES = ('setup.py', 'setup.cfg', 'requirements.txt',
+                         'pip-requirements.txt')
+
+
+def package_install_hash(srcdir, psrc):
+    """
+    Return a hash of the PACKAGE_INSTALL_FILES in package directory psrc
+    """
+    h = hashlib.sha1()
+    for name in PACKAGE_INSTALL_FILES:
+        filename = path.join(srcdir, psrc, name)
+        if not path.isfile(filename):
+            h.update('{0} missing\0'.format(name))
+            continue
+        with open(filename, 'rb') as f:
+            contents = f.read()
+        h.update('{0} {1}\0'.format(name, len(contents)))
+        h.update(contents)
+    return h.hexdigest()
+
+
+def load_install_manifest(datadir):
+    """
+    Return {package directory name: package_install_hash} for the packages
+    recorded as installed in datadir
+    """
+    try:
+        with open(path.join(datadir, INSTALL_MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_install_manifest(datadir, manifest):
+    filename = path.join(datadir, INSTALL_MANIFEST)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+
+
+# directories that won't have .pyc files worth cleaning
+PYC_SKIP_DIRS = frozenset(['.git', '.hg', '.svn', '.tox', 'node_modules',
+                           'bower_components'])
+PYC_DELETE_WORKERS = 8
+PYC_DELETE_BATCH = 500
+
+
+def _list_dir(dirname):
+    """
+    Return [(name, True if a directory)] for dirname without following
+    symlinks
+    """
+    if scandir is not None:
+        return [(e.name, e.is_dir(follow_symlinks=False)) for e in scandir(dirname)]
+    entries = []
+    for name in os.listdir(dirname):
+        try:
+            mode = os.lstat(path.join(dirname, name)).st_mode
+        except OSError:
+            continue
+        entries.append((name, stat.S_ISDIR(mode)))
+    return entries
+
+
+def find_pyc(top):
+    """
+    Return the .pyc files under top, skipping PYC_SKIP_DIRS and not
+    following symlinks
+    """
+    found = []
+    dirs = [top]
+    while dirs:
+        dirname = dirs.pop()
+        try:
+            entries = _list_dir(dirname)
+        except OSError:
+            continue
+        for name, is_dir in entries:
+            if is_dir:
+                if name not in PYC_SKIP_DIRS:
+                    dirs.append(path.join(dirname, name))
+            elif name.endswith('.pyc'):
+                found.append(path.join(dirname, name))
+    return found
+
+
+def _remove_files(filenames):
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def clean_pyc(srcdir, dry_run=False):
+    """
+    Remove the .pyc files in srcdir, using a pool of threads
+
+    :param dry_run: True to only find the files
+    :returns: (files removed or found, seconds taken)
+    """
+    start = time.time()
+    found = find_pyc(srcdir)
+    if not dry_run:
+        run_parallel(_remove_files, [found[i:i + PYC_DELETE_BATCH]
+                                     for i in range(0, len(found), PYC_DELETE_BATCH)],
+                     workers=PYC_DELETE_WORKERS)
+    return found, time.time() - start
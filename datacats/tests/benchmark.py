@@ -0,0 +1,170 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+"""Run datacats commands against a fake Docker daemon and report the
+Docker API round trips and wall time each one takes
+
+Usage:
+  benchmark [--latency=MS] [--repeat=N] [--json]
+
+Options:
+  --latency=MS   Delay each Docker API response by MS milliseconds [default: 2]
+  --repeat=N     Run the commands N times and report the fastest [default: 1]
+  --json         Print the results as JSON
+
+Run it with "python -m datacats.tests.benchmark". Each command runs in its
+own datacats process, with a temporary home
+directory, so the numbers include interpreter start up like a real run.
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from docopt import docopt
+
+from datacats.tests.fakedaemon import FakeDaemon, ROUTES, services_supported
+
+ENVIRONMENT_NAME = 'bench'
+
+# (name, datacats arguments) run in order, create leaves the site running
+COMMANDS = [
+    ('create', ['create', '-n', '--no-datapusher', ENVIRONMENT_NAME]),
+    ('info', ['info', ENVIRONMENT_NAME]),
+    ('stop', ['stop', ENVIRONMENT_NAME]),
+    ('start', ['start', ENVIRONMENT_NAME]),
+    ('install', ['install', '--force', ENVIRONMENT_NAME]),
+    ('purge', ['purge', '-y', '--delete-environment', ENVIRONMENT_NAME]),
+    ]
+
+REQUIRED_IMAGES = ['datacats/web', 'datacats/postgres', 'datacats/solr']
+
+# just enough of the preload image for create: the virtualenv and the
+# ckan source files datacats reads
+PRELOAD_FILES = {
+    '/usr/lib/ckan': {
+        'bin/python': '',
+        'bin/paster': '',
+        },
+    '/project/ckan': {
+        'setup.py': '',
+        'requirements.txt': '',
+        'ckan/config/who.ini': '[plugin:auth_tkt]\n',
+        'ckan/config/solr/schema.xml': '<schema/>\n',
+        'ckan/public/base/css/main.css': '',
+        },
+    }
+
+DEVELOPMENT_INI = """[app:main]
+ckan.plugins = datastore resource_proxy text_view
+"""
+
+
+def _make_config(daemon, container):
+    """
+    What paster make-config does: write development.ini to /project
+    """
+    target = daemon.host_path(container, '/project/development.ini')
+    with open(target, 'w') as f:
+        f.write(DEVELOPMENT_INI)
+
+
+def fake_daemon(latency_seconds):
+    """
+    Return a FakeDaemon, not started yet, with the images datacats needs
+    and every endpoint taking latency_seconds
+    """
+    daemon = FakeDaemon(
+        latency=dict((name, latency_seconds) for _, _, name in ROUTES),
+        services=True)
+    for image in REQUIRED_IMAGES:
+        daemon.add_image(image)
+    daemon.add_image('datacats/ckan:2.4', PRELOAD_FILES)
+    daemon.on_start.append(('paster make-config', _make_config))
+    return daemon
+
+
+def run_commands(daemon, commands=None):
+    """
+    Run each of commands (default COMMANDS) in a new datacats process
+    against daemon.
+
+    Returns [(name, seconds, {endpoint: requests})] and raises
+    RuntimeError if a command fails
+    """
+    home = mkdtemp()
+    workdir = mkdtemp()
+    env = dict(os.environ, HOME=home, DOCKER_HOST=daemon.base_url,
+               PYTHONPATH=path.dirname(path.dirname(path.dirname(
+                   path.abspath(__file__)))))
+    for name in ('DOCKER_TLS_VERIFY', 'DOCKER_CERT_PATH', 'DATACATS_WEB_WORKER'):
+        env.pop(name, None)
+    results = []
+    try:
+        for name, args in commands or COMMANDS:
+            before = len(daemon.calls)
+            start = time.time()
+            process = subprocess.Popen(
+                [sys.executable, '-c',
+                 'import sys; from datacats.cli.main import main; sys.exit(main())'] + args,
+                cwd=workdir, env=env, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate('')[0]
+            seconds = time.time() - start
+            if process.returncode:
+                raise RuntimeError('datacats {0} failed:\n{1}'.format(
+                    ' '.join(args), output))
+            calls = {}
+            for endpoint in daemon.calls[before:]:
+                calls[endpoint] = calls.get(endpoint, 0) + 1
+            results.append((name, seconds, calls))
+    finally:
+        rmtree(home, ignore_errors=True)
+        rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def report(results):
+    """
+    Return a table of the round trips and time taken by each command
+    """
+    lines = ['{0:<10} {1:>9} {2:>10}  {3}'.format(
+        'command', 'seconds', 'requests', 'most frequent')]
+    for name, seconds, calls in results:
+        frequent = sorted(calls.iteritems(), key=lambda c: (-c[1], c[0]))[:3]
+        lines.append('{0:<10} {1:>9.2f} {2:>10}  {3}'.format(
+            name, seconds, sum(calls.values()),
+            ', '.join('{0} {1}'.format(n, e) for e, n in frequent)))
+    return '\n'.join(lines)
+
+
+def main():
+    opts = docopt(__doc__)
+    if not services_supported():
+        sys.exit('The fake daemon needs to listen on 127.0.0.x addresses, '
+                 'which only Linux provides')
+    best = None
+    for _ in range(int(opts['--repeat'])):
+        with fake_daemon(float(opts['--latency']) / 1000) as daemon:
+            results = run_commands(daemon)
+        if best is None:
+            best = results
+        else:
+            best = [min(b, r, key=lambda x: x[1]) for b, r in zip(best, results)]
+    if opts['--json']:
+        print json.dumps([{'command': name, 'seconds': seconds, 'requests': calls}
+                          for name, seconds, calls in best], indent=2)
+    else:
+        print report(best)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,636 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+"""
+A stand-in for the Docker daemon: an HTTP server on a unix socket that
+answers the Docker Engine API requests datacats makes, so whole datacats
+commands can run against it (DOCKER_HOST=unix://<socket_path>) without
+Docker. Nothing is really run. Containers "exit" when they are waited
+for, and their output and exit codes are configured per command.
+
+Unlike fakedocker.FakeClient, requests go through docker-py, requests
+and the connection pool like they do with a real daemon, so round trips
+and their latency can be measured, see datacats.tests.benchmark.
+
+When services is True the fake daemon also answers the readiness checks
+datacats makes: every container gets its own 127.0.0.x address, postgres
+containers accept connections on port 5432 of it, solr containers answer
+HTTP on port 8080 and published ports answer HTTP on the host. Only
+Linux routes all of 127.0.0.0/8 to the loopback interface, check
+services_supported() first.
+"""
+
+import re
+import sys
+import json
+import time
+import base64
+import socket
+import struct
+import tarfile
+from os import path
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from itertools import count
+from urlparse import urlparse, parse_qs
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+API_VERSION = '1.21'
+
+# (method, path pattern, endpoint name) for each request handled, named
+# after the docker-py Client methods that make them
+ROUTES = [
+    ('GET', r'/_ping$', 'ping'),
+    ('GET', r'/version$', 'version'),
+    ('GET', r'/info$', 'info'),
+    ('GET', r'/events$', 'events'),
+    ('GET', r'/containers/json$', 'containers'),
+    ('POST', r'/containers/create$', 'create_container'),
+    ('GET', r'/containers/([^/]+)/json$', 'inspect_container'),
+    ('POST', r'/containers/([^/]+)/start$', 'start'),
+    ('POST', r'/containers/([^/]+)/wait$', 'wait'),
+    ('POST', r'/containers/([^/]+)/attach$', 'attach'),
+    ('GET', r'/containers/([^/]+)/logs$', 'logs'),
+    ('POST', r'/containers/([^/]+)/stop$', 'stop'),
+    ('POST', r'/containers/([^/]+)/kill$', 'kill'),
+    ('GET', r'/containers/([^/]+)/archive$', 'get_archive'),
+    ('POST', r'/containers/([^/]+)/exec$', 'exec_create'),
+    ('DELETE', r'/containers/([^/]+)$', 'remove_container'),
+    ('POST', r'/exec/([^/]+)/start$', 'exec_start'),
+    ('GET', r'/exec/([^/]+)/json$', 'exec_inspect'),
+    ('POST', r'/commit$', 'commit'),
+    ('GET', r'/images/json$', 'images'),
+    ('POST', r'/images/create$', 'pull'),
+    ('GET', r'/images/(.+)/json$', 'inspect_image'),
+    ('DELETE', r'/images/(.+)$', 'remove_image'),
+    ]
+_ROUTES = list((m, re.compile(p), n) for m, p, n in ROUTES)
+_VERSION_PREFIX = re.compile(r'^/v[0-9.]+')
+
+# the reply to a postgres StartupMessage asking for a password
+_PG_AUTH_REQUEST = 'R' + struct.pack('!ii', 8, 5) + 'salt'
+
+
+class NotFound(Exception):
+    status = 404
+
+
+class Conflict(Exception):
+    status = 409
+
+
+def _tag(name):
+    if ':' in name.split('/')[-1] or re.match('^[0-9a-f]{64}$', name):
+        return name
+    return name + ':latest'
+
+
+def _command_key(command):
+    return ' '.join(command) if isinstance(command, list) else (command or '')
+
+
+def _digest(tag):
+    return 'sha256:' + tag.encode('hex')[:64].ljust(64, '0')
+
+
+def _pull_statuses(image, layers=2, layer_size=1000000):
+    """
+    Status messages like the daemon's for pulling image
+    """
+    repo, tag = image.rsplit(':', 1)
+    statuses = [{'status': 'Pulling from ' + repo, 'id': tag}]
+    for n in range(layers):
+        layer = '{0:012x}'.format(n + 1)
+        statuses += [
+            {'status': 'Pulling fs layer', 'progressDetail': {}, 'id': layer},
+            {'status': 'Downloading', 'id': layer,
+             'progressDetail': {'current': layer_size / 2, 'total': layer_size}},
+            {'status': 'Downloading', 'id': layer,
+             'progressDetail': {'current': layer_size, 'total': layer_size}},
+            {'status': 'Download complete', 'progressDetail': {}, 'id': layer},
+            {'status': 'Pull complete', 'progressDetail': {}, 'id': layer},
+            ]
+    statuses += [
+        {'status': 'Digest: ' + _digest(image)},
+        {'status': 'Status: Downloaded newer image for ' + image},
+        ]
+    return statuses
+
+
+class _Listener(object):
+    """
+    Accepts connections on (host, port) in a thread and answers each with
+    the string respond() returns
+    """
+    def __init__(self, host, port, respond):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.respond = respond
+        thread = Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            try:
+                conn.recv(4096)  # pylint: disable=no-member
+                conn.sendall(self.respond())  # pylint: disable=no-member
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+def services_supported():
+    """
+    Return True if this host can listen on the 127.0.0.x container
+    addresses, which fake services need
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.2', 0))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def _http_ok():
+    return 'HTTP/1.0 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK'
+
+
+class _Server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hanging up mid-request (eg. datacats exiting while
+        # following logs) aren't errors in the daemon
+        if not isinstance(sys.exc_info()[1], socket.error):
+            UnixStreamServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        # pylint: disable=arguments-differ
+        pass
+
+    def address_string(self):
+        return 'unix'
+
+    def _handle(self):
+        self.server.fake_daemon.handle(self)
+
+    do_GET = do_POST = do_DELETE = do_PUT = do_HEAD = _handle
+
+
+class FakeDaemon(object):
+    """
+    Start with start() (or use as a context manager), point datacats or
+    docker-py at base_url and stop() when finished.
+
+    :param latency: {endpoint name from ROUTES: seconds} to wait before
+                    answering each request, to simulate a real daemon
+    :param services: answer readiness checks, see the module docstring
+    :param boot2docker: report that the daemon runs in boot2docker
+    """
+    def __init__(self, latency=None, services=False, boot2docker=False):
+        self.latency = latency or {}
+        self.services = services
+        self.boot2docker = boot2docker
+        # {command: exit status} and {command: [output chunks]}, commands
+        # are joined with spaces if they are lists
+        self.exit_codes = {}
+        self.output = {}
+        # [(command substring, fn(daemon, container dict))] called when a
+        # container running a matching command starts, to simulate what
+        # the command does to its volumes, see host_path
+        self.on_start = []
+        # {repository:tag or ID: {'Id': id, 'files': {directory: {relative
+        # path: contents}}}}, files are what get_archive returns
+        self.images = {}
+        # pulling an image not in here makes up its layers
+        self.pull_statuses = {}
+        self.containers = {}
+        self.execs = {}
+        # endpoint name of every request received, in order
+        self.calls = []
+        self._ids = count(1)
+        self._addresses = count(2)
+        self._lock = Lock()
+        self._tmpdir = mkdtemp()
+        self.socket_path = path.join(self._tmpdir, 'docker.sock')
+        self.base_url = 'unix://' + self.socket_path
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._server = _Server(self.socket_path, _Handler)
+        self._server.fake_daemon = self
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for container in self.containers.values():
+            self._stop_services(container)
+        rmtree(self._tmpdir, ignore_errors=True)
+
+    def count(self, endpoint=None):
+        """
+        Return the number of requests received for endpoint, or in total
+        """
+        with self._lock:
+            return len([c for c in self.calls if endpoint in (None, c)])
+
+    def add_image(self, name, files=None):
+        """
+        Make image name available, with {directory: {relative path:
+        contents}} for get_archive to return
+        """
+        self.images[_tag(name)] = {
+            'Id': _digest(_tag(name)),
+            'files': files or {},
+            }
+
+    def host_path(self, container, container_path):
+        """
+        Return where container_path inside container is on the host if it
+        is in a volume, or None
+        """
+        for bind in container['HostConfig'].get('Binds') or ():
+            host, inside = bind.split(':')[:2]
+            if container_path == inside or container_path.startswith(inside.rstrip('/') + '/'):
+                return host + container_path[len(inside.rstrip('/')):]
+        return None
+
+    # request handling
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        route = _VERSION_PREFIX.sub('', url.path)
+        for method, pattern, name in _ROUTES:
+            match = pattern.match(route)
+            if method == request.command and match:
+                break
+        else:
+            return self._send(request, 404, 'page not found', 'text/plain')
+
+        with self._lock:
+            self.calls.append(name)
+        delay = self.latency.get(name)
+        if delay:
+            time.sleep(delay)
+
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else ''
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).iteritems())
+        try:
+            with self._lock:
+                result = getattr(self, '_' + name)(
+                    params, json.loads(body) if body else None, *match.groups())
+        except (NotFound, Conflict) as e:
+            return self._send(request, e.status, str(e), 'text/plain')
+
+        if isinstance(result, _Stream):
+            return self._send_chunked(request, result)
+        status, result = result if isinstance(result, tuple) else (200, result)
+        if result is None:
+            return self._send(request, status, '', 'text/plain')
+        self._send(request, status, json.dumps(result), 'application/json')
+
+    def _send(self, request, status, body, content_type, headers=None):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _send_chunked(self, request, stream):
+        request.send_response(200)
+        request.send_header('Content-Type', stream.content_type)
+        request.send_header('Transfer-Encoding', 'chunked')
+        for name, value in stream.headers.iteritems():
+            request.send_header(name, value)
+        request.end_headers()
+        for chunk in stream.chunks:
+            if chunk:
+                request.wfile.write('{0:x}\r\n{1}\r\n'.format(len(chunk), chunk))
+        request.wfile.write('0\r\n\r\n')
+
+    def _find(self, name):
+        for cid, container in self.containers.iteritems():
+            if name in (cid, container['Name'][1:]) or (
+                    len(name) >= 12 and cid.startswith(name)):
+                return container
+        raise NotFound('No such container: ' + name)
+
+    def _image(self, name):
+        image = self.images.get(_tag(name))
+        if not image:
+            for image in self.images.values():
+                if image['Id'] in (name, 'sha256:' + name):
+                    return image
+            raise NotFound('No such image: ' + name)
+        return image
+
+    # endpoints, named after the docker-py methods
+
+    def _ping(self, params, body):
+        # pylint: disable=unused-argument
+        return 'OK'
+
+    def _version(self, params, body):
+        # pylint: disable=unused-argument
+        return {'ApiVersion': API_VERSION, 'Version': '1.9.1',
+                'Os': 'linux', 'Arch': 'amd64'}
+
+    def _info(self, params, body):
+        # pylint: disable=unused-argument
+        return {'OperatingSystem': 'Boot2Docker 1.9.1' if self.boot2docker
+                else 'Ubuntu 14.04', 'Containers': len(self.containers)}
+
+    def _events(self, params, body):
+        # pylint: disable=unused-argument
+        # the stream ends at once, callers fall back to polling
+        return _Stream([])
+
+    def _containers(self, params, body):
+        # pylint: disable=unused-argument
+        filters = json.loads(params.get('filters') or '{}')
+        names = filters.get('name') or []
+        out = []
+        for cid, c in sorted(self.containers.iteritems()):
+            if names and not any(n in c['Name'] for n in names):
+                continue
+            running = c['State']['Running']
+            if not running and params.get('all') not in ('1', 'True', 'true'):
+                continue
+            ports = []
+            for private, bindings in (c['HostConfig'].get('PortBindings') or {}).iteritems():
+                for binding in bindings or ():
+                    ports.append({'PrivatePort': int(private.split('/')[0]),
+                                  'PublicPort': int(binding['HostPort']),
+                                  'IP': binding.get('HostIp') or '0.0.0.0',
+                                  'Type': 'tcp'})
+            out.append({
+                'Id': cid,
+                'Names': [c['Name']],
+                'Image': c['Config']['Image'],
+                'Command': _command_key(c['Config']['Cmd']),
+                'Status': 'Up 1 seconds' if running else 'Exited ({0}) 1 seconds ago'.format(
+                    c['State']['ExitCode']),
+                'Ports': ports,
+                })
+        return out
+
+    def _create_container(self, params, body):
+        self._image(body['Image'])
+        name = params.get('name')
+        if name and any(c['Name'] == '/' + name for c in self.containers.values()):
+            raise Conflict('Conflict. The name "{0}" is already in use'.format(name))
+        cid = '{0:064x}'.format(next(self._ids))
+        self.containers[cid] = {
+            'Id': cid,
+            'Name': '/' + (name or cid[:12]),
+            'Config': {'Image': body['Image'], 'Cmd': body.get('Cmd'),
+                       'Env': body.get('Env'), 'Tty': bool(body.get('Tty'))},
+            'HostConfig': body.get('HostConfig') or {},
+            'State': {'Running': False, 'ExitCode': 0, 'Pid': 0},
+            'NetworkSettings': {'IPAddress': '', 'Ports': {}},
+            '_services': [],
+            }
+        return 201, {'Id': cid, 'Warnings': None}
+
+    def _inspect_container(self, params, body, name):
+        # pylint: disable=unused-argument
+        c = self._find(name)
+        return dict((k, v) for k, v in c.iteritems() if not k.startswith('_'))
+
+    def _start(self, params, body, name):
+        # pylint: disable=unused-argument
+        c = self._find(name)
+        if body:
+            # host config passed to start by older clients
+            c['HostConfig'].update(body)
+        if c['State']['Running']:
+            return 304, None
+        c['State'].update(Running=True, Pid=1)
+        c['NetworkSettings']['IPAddress'] = '127.0.0.{0}'.format(
+            next(self._addresses) % 250 + 2)
+        command = _command_key(c['Config']['Cmd'])
+        for substring, fn in self.on_start:
+            if substring in command:
+                fn(self, c)
+        if self.services:
+            self._start_services(c)
+        return 204, None
+
+    def _start_services(self, c):
+        ip = c['NetworkSettings']['IPAddress']
+        image = c['Config']['Image']
+        listen = []
+        if image.startswith('datacats/postgres') and c['Config']['Cmd'] is None:
+            listen.append((ip, 5432, lambda: _PG_AUTH_REQUEST))
+        if image.startswith('datacats/solr'):
+            listen.append((ip, 8080, _http_ok))
+        for bindings in (c['HostConfig'].get('PortBindings') or {}).values():
+            for binding in bindings or ():
+                listen.append((binding.get('HostIp') or '127.0.0.1',
+                               int(binding['HostPort']), _http_ok))
+        for host, port, respond in listen:
+            try:
+                c['_services'].append(_Listener(host, port, respond))
+            except socket.error:
+                pass
+
+    def _stop_services(self, c):
+        for listener in c['_services']:
+            listener.close()
+        del c['_services'][:]
+
+    def _exit(self, c):
+        if c['State']['Running']:
+            c['State'].update(
+                Running=False, Pid=0,
+                ExitCode=self.exit_codes.get(_command_key(c['Config']['Cmd']), 0))
+            self._stop_services(c)
+
+    def _wait(self, params, body, name):
+        # pylint: disable=unused-argument
+        c = self._find(name)
+        self._exit(c)
+        return {'StatusCode': c['State']['ExitCode']}
+
+    def _output_frames(self, command):
+        return [struct.pack('>BxxxL', 1, len(chunk)) + chunk
+                for chunk in self.output.get(_command_key(command), [])]
+
+    def _attach(self, params, body, name):
+        # pylint: disable=unused-argument
+        c = self._find(name)
+        return _Stream(self._output_frames(c['Config']['Cmd']),
+                       'application/vnd.docker.raw-stream')
+
+    def _logs(self, params, body, name):
+        # pylint: disable=unused-argument
+        c = self._find(name)
+        frames = self._output_frames(c['Config']['Cmd'])
+        if params.get('timestamps') == '1':
+            stamp = time.strftime('%Y-%m-%dT%H:%M:%S.000000000Z ', time.gmtime())
+            frames = [struct.pack('>BxxxL', 1, len(stamp) + len(f) - 8) + stamp + f[8:]
+                      for f in frames]
+        return _Stream(frames, 'application/vnd.docker.raw-stream')
+
+    def _stop(self, params, body, name):
+        # pylint: disable=unused-argument
+        self._exit(self._find(name))
+        return 204, None
+
+    _kill = _stop
+
+    def _remove_container(self, params, body, name):
+        # pylint: disable=unused-argument
+        c = self._find(name)
+        if c['State']['Running'] and params.get('force') not in ('1', 'True', 'true'):
+            raise Conflict('You cannot remove a running container')
+        self._stop_services(c)
+        del self.containers[c['Id']]
+        return 204, None
+
+    def _get_archive(self, params, body, name):
+        # pylint: disable=unused-argument
+        c = self._find(name)
+        directory = params['path']
+        files = self._image(c['Config']['Image'])['files']
+        if directory not in files:
+            raise NotFound('Could not find the file {0} in container'.format(directory))
+        top = directory.rstrip('/').split('/')[-1]
+        data = StringIO()
+        tar = tarfile.open(fileobj=data, mode='w')
+        info = tarfile.TarInfo(top)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+        for relative, contents in sorted(files[directory].iteritems()):
+            info = tarfile.TarInfo(top + '/' + relative)
+            info.size = len(contents)
+            info.mode = 0o644
+            tar.addfile(info, StringIO(contents))
+        tar.close()
+        stat = base64.b64encode(json.dumps({
+            'name': top, 'size': 4096, 'mode': 0o20000000755, 'mtime': '',
+            'linkTarget': ''}))
+        return _Stream([data.getvalue()], 'application/x-tar',
+                       {'X-Docker-Container-Path-Stat': stat})
+
+    def _exec_create(self, params, body, name):
+        # pylint: disable=unused-argument
+        c = self._find(name)
+        if not c['State']['Running']:
+            raise Conflict('Container {0} is not running'.format(name))
+        exec_id = '{0:064x}'.format(next(self._ids))
+        self.execs[exec_id] = body.get('Cmd')
+        return 201, {'Id': exec_id}
+
+    def _exec_start(self, params, body, exec_id):
+        # pylint: disable=unused-argument
+        if exec_id not in self.execs:
+            raise NotFound('No such exec instance: ' + exec_id)
+        return _Stream(self._output_frames(self.execs[exec_id]),
+                       'application/vnd.docker.raw-stream')
+
+    def _exec_inspect(self, params, body, exec_id):
+        # pylint: disable=unused-argument
+        if exec_id not in self.execs:
+            raise NotFound('No such exec instance: ' + exec_id)
+        return {'ID': exec_id, 'Running': False,
+                'ExitCode': self.exit_codes.get(_command_key(self.execs[exec_id]), 0)}
+
+    def _commit(self, params, body):
+        # pylint: disable=unused-argument
+        c = self._find(params['container'])
+        image_id = '{0:064x}'.format(next(self._ids))
+        self.images[image_id] = {
+            'Id': 'sha256:' + image_id,
+            'files': self._image(c['Config']['Image'])['files'],
+            }
+        return 201, {'Id': image_id}
+
+    def _images(self, params, body):
+        # pylint: disable=unused-argument
+        out = {}
+        for tag, image in self.images.iteritems():
+            info = out.setdefault(image['Id'], {
+                'Id': image['Id'], 'RepoTags': [], 'RepoDigests': [],
+                'Created': 0, 'Size': 0, 'VirtualSize': 0})
+            if ':' in tag:
+                info['RepoTags'].append(tag)
+                info['RepoDigests'].append(tag.rsplit(':', 1)[0] + '@' + _digest(tag))
+        return [i if i['RepoTags'] else dict(i, RepoTags=['<none>:<none>'])
+                for i in out.values()]
+
+    def _pull(self, params, body):
+        # pylint: disable=unused-argument
+        image = params['fromImage'] + ':' + (params.get('tag') or 'latest')
+        statuses = self.pull_statuses.get(image) or _pull_statuses(image)
+        if not any('error' in s for s in statuses):
+            files = self.images.get(image, {}).get('files')
+            self.add_image(image, files)
+        return _Stream([json.dumps(s) + '\r\n' for s in statuses])
+
+    def _inspect_image(self, params, body, name):
+        # pylint: disable=unused-argument
+        image = self._image(name)
+        return {'Id': image['Id'], 'RepoTags': [
+            t for t, i in self.images.iteritems() if i is image and ':' in t]}
+
+    def _remove_image(self, params, body, name):
+        # pylint: disable=unused-argument
+        image = self._image(name)
+        for tag in [t for t, i in self.images.iteritems() if i is image]:
+            del self.images[tag]
+        return [{'Deleted': image['Id']}]
+
+
+class _Stream(object):
+    """
+    A response sent with chunked transfer encoding, a chunk at a time
+    """
+    def __init__(self, chunks, content_type='application/json', headers=None):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.headers = headers or {}
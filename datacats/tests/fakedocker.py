@@ -0,0 +1,329 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+"""
+In-process stand-in for docker-py's Client so that code in datacats.docker,
+datacats.task and datacats.environment can be exercised without a Docker
+daemon. Install it with use_fake_client() and restore with
+restore_client().
+"""
+
+import json
+import time
+import tarfile
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from itertools import count
+
+from docker.errors import APIError
+from docker.utils import convert_volume_binds
+
+from datacats import docker
+
+
+# added to each output chunk by logs(timestamps=True)
+LOG_TIMESTAMP = '2015-10-01T12:34:56.789012345Z'
+
+
+class _Response(object):
+    """
+    Just enough of a requests response for APIError
+    """
+    def __init__(self, status_code, reason):
+        self.status_code = status_code
+        self.reason = reason
+        self.content = reason
+
+
+def _api_error(status_code, reason):
+    return APIError(reason, _Response(status_code, reason))
+
+
+class FakeClient(object):
+    """
+    Records every call made to it in self.calls as (method, args...)
+    tuples and sleeps for latency[method] seconds to simulate a daemon.
+    """
+    api_version = '1.21'
+
+    def __init__(self, latency=None, exit_codes=None):
+        self.calls = []
+        self.latency = latency or {}
+        self.exit_codes = exit_codes or {}
+        self.containers_by_id = {}
+        # every container created, including removed ones
+        self.created = []
+        self.image_ids = set()
+        self.execs = {}
+        # {container name: [(delay seconds, event dict)]} for events()
+        self.container_events = {}
+        # {image: {directory: {relative path: file contents}}} for get_archive()
+        self.image_files = {}
+        # {path: seconds} get_archive() takes to stream path, on top of latency
+        self.archive_latency = {}
+        # {image: image ID} for inspect_image(), made up from the name if missing
+        self.image_digests = {}
+        # {command: [output chunks]} for attach() and logs()
+        self.output = {}
+        # {image: [status dicts]} for pull(), images not in it fail
+        self.pull_statuses = {}
+        # {image: seconds} pull() takes for image, on top of latency
+        self.pull_latency = {}
+        # {repository:tag: digest} listed by images(), pull() adds to it
+        self.tagged = {}
+        # {container: timeout} of the last stop() of each container
+        self.stop_timeouts = {}
+        self._ids = count(1)
+
+    def _call(self, method, *args):
+        self.calls.append((method,) + args)
+        delay = self.latency.get(method)
+        if delay:
+            time.sleep(delay)
+
+    def count(self, method):
+        return len([c for c in self.calls if c[0] == method])
+
+    def _new_id(self):
+        return '{0:064x}'.format(next(self._ids))
+
+    def _find(self, container):
+        for cid, info in self.containers_by_id.iteritems():
+            if container in (cid, info['Name'].lstrip('/')):
+                return cid
+        raise _api_error(404, 'No such container: {0}'.format(container))
+
+    def info(self):
+        self._call('info')
+        return {'OperatingSystem': 'Ubuntu 14.04'}
+
+    def version(self):
+        self._call('version')
+        return {'ApiVersion': docker.MINIMUM_API_VERSION}
+
+    def create_host_config(self, **kwargs):
+        # computed locally by docker-py, not a daemon round-trip. Binds is
+        # how inspect_container reports the binds
+        if kwargs.get('binds'):
+            return dict(kwargs, Binds=convert_volume_binds(kwargs['binds']))
+        return kwargs
+
+    def create_container(self, image, command=None, name=None, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('create_container', image, command)
+        cid = self._new_id()
+        self.containers_by_id[cid] = {
+            'Id': cid,
+            'Name': '/' + (name or cid[:12]),
+            'Image': image,
+            'Command': command,
+            'State': {'Running': False, 'ExitCode': 0},
+            'NetworkSettings': {'Ports': None, 'IPAddress': '172.17.0.2'},
+            'HostConfig': kwargs.get('host_config') or {},
+            }
+        self.created.append(self.containers_by_id[cid])
+        return {'Id': cid}
+
+    def start(self, container):
+        self._call('start', container)
+        self.containers_by_id[self._find(container)]['State']['Running'] = True
+
+    def _output(self, container):
+        command = self.containers_by_id[self._find(container)]['Command']
+        return self.output.get(
+            ' '.join(command) if isinstance(command, list) else command, [])
+
+    def attach(self, container, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('attach', container)
+        return iter(self._output(container))
+
+    def wait(self, container):
+        self._call('wait', container)
+        info = self.containers_by_id[self._find(container)]
+        info['State']['Running'] = False
+        command = info['Command']
+        return self.exit_codes.get(
+            ' '.join(command) if isinstance(command, list) else command, 0)
+
+    def logs(self, container, stream=False, tail='all', timestamps=False, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('logs', container)
+        output = self._output(container)
+        if tail != 'all':
+            output = ''.join(output).splitlines(True)[-tail:]
+        if timestamps:
+            output = [LOG_TIMESTAMP + ' ' + chunk for chunk in output]
+        return iter(output) if stream else ''.join(output)
+
+    def exec_create(self, container, cmd, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('exec_create', container, cmd)
+        if not self.containers_by_id[self._find(container)]['State']['Running']:
+            raise _api_error(409, 'Container {0} is not running'.format(container))
+        exec_id = self._new_id()
+        self.execs[exec_id] = self.exit_codes.get(
+            ' '.join(cmd) if isinstance(cmd, list) else cmd, 0)
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('exec_start', exec_id['Id'])
+        return iter([])
+
+    def exec_inspect(self, exec_id):
+        self._call('exec_inspect', exec_id['Id'])
+        return {'ExitCode': self.execs[exec_id['Id']]}
+
+    def commit(self, container):
+        self._call('commit', container)
+        image_id = self._new_id()
+        self.image_ids.add(image_id)
+        return {'Id': image_id}
+
+    def stop(self, container, timeout=10):
+        self._call('stop', container)
+        self.stop_timeouts[container] = timeout
+        self.containers_by_id[self._find(container)]['State']['Running'] = False
+
+    def remove_container(self, container, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('remove_container', container)
+        del self.containers_by_id[self._find(container)]
+
+    def inspect_container(self, container):
+        self._call('inspect_container', container)
+        return self.containers_by_id[self._find(container)]
+
+    def containers(self, all=False, filters=None, **kwargs):
+        # pylint: disable=unused-argument,redefined-builtin
+        self._call('containers', filters)
+        out = []
+        for cid, info in self.containers_by_id.iteritems():
+            if filters and filters.get('name', '') not in info['Name']:
+                continue
+            running = info['State']['Running']
+            if not (running or all):
+                continue
+            ports = []
+            bindings = info['HostConfig'].get('port_bindings') or {}
+            for private, public in bindings.iteritems():
+                ip, public = public if isinstance(public, tuple) else ('0.0.0.0', public)
+                ports.append({'PrivatePort': private, 'PublicPort': public,
+                              'IP': ip, 'Type': 'tcp'})
+            out.append({
+                'Id': cid,
+                'Names': [info['Name']],
+                'Image': info['Image'],
+                'Status': 'Up 1 seconds' if running else 'Exited (0) 1 seconds ago',
+                'Ports': ports,
+                })
+        return out
+
+    def events(self, since=None, until=None, filters=None, decode=None):
+        # pylint: disable=unused-argument
+        self._call('events', filters)
+        name = (filters or {}).get('container')
+        for delay, event in self.container_events.get(name, []):
+            time.sleep(delay)
+            yield event
+        # like the daemon, keep the stream open until the until timestamp
+        if until is not None:
+            time.sleep(max(0, until - time.time()))
+
+    def get_archive(self, container, path):
+        self._call('get_archive', container, path)
+        image = self.containers_by_id[self._find(container)]['Image']
+        files = self.image_files.get(image, {})
+        if path not in files:
+            raise _api_error(404, 'Could not find the file {0}'.format(path))
+        top = path.rstrip('/').split('/')[-1]
+        data = StringIO()
+        tar = tarfile.open(fileobj=data, mode='w')
+        top_info = tarfile.TarInfo(top)
+        top_info.type = tarfile.DIRTYPE
+        top_info.mode = 0o755
+        tar.addfile(top_info)
+        for name, contents in sorted(files[path].iteritems()):
+            info = tarfile.TarInfo(top + '/' + name)
+            info.size = len(contents)
+            tar.addfile(info, StringIO(contents))
+        tar.close()
+        data.seek(0)
+        # streaming the archive, the container may be removed meanwhile
+        time.sleep(self.archive_latency.get(path, 0))
+        return data, {'name': top}
+
+    def inspect_image(self, image):
+        self._call('inspect_image', image)
+        if image not in self.image_files and image not in self.image_ids:
+            raise _api_error(404, 'No such image: {0}'.format(image))
+        return {'Id': self.image_digests.get(image, 'sha256:' + image.encode('hex'))}
+
+    def images(self, name=None, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('images', name)
+        return [{'Id': 'sha256:' + tag.encode('hex'), 'RepoTags': [tag],
+                 'RepoDigests': [tag.rsplit(':', 1)[0] + '@' + digest]}
+                for tag, digest in self.tagged.iteritems()
+                if name in (None, tag, tag.rsplit(':', 1)[0])]
+
+    def pull(self, image, stream=False, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('pull', image)
+        time.sleep(self.pull_latency.get(image, 0))
+        statuses = self.pull_statuses.get(
+            image, [{'error': 'image {0} not found'.format(image)}])
+        if image in self.pull_statuses:
+            self.tagged[docker.image_tag(image)] = 'sha256:' + image.encode('hex')
+        lines = [json.dumps(s) for s in statuses]
+        return iter(lines) if stream else '\n'.join(lines)
+
+    def remove_image(self, image, **kwargs):
+        # pylint: disable=unused-argument
+        self._call('remove_image', image)
+        if image not in self.image_ids:
+            raise _api_error(404, 'No such image: {0}'.format(image))
+        self.image_ids.remove(image)
+
+
+# (client, boot2docker, handshake cache, temporary directory for the
+# handshake cache) saved by use_fake_client
+_saved = []
+
+
+def use_fake_client(client=None):
+    """
+    Make datacats.docker use client (a new FakeClient by default) and
+    return it.
+    """
+    if not _saved:
+        _saved.extend([docker._docker, docker._boot2docker, docker.HANDSHAKE_CACHE,
+                       mkdtemp()])
+        # don't read or write the user's handshake cache
+        docker.HANDSHAKE_CACHE = _saved[3] + '/docker-handshake.json'
+    client = client or FakeClient()
+    docker._docker = client
+    docker._boot2docker = None
+    docker.forget_local_images()
+    del docker._committed_images[:]
+    docker._web_workers.clear()
+    docker._forget_containers()
+    return client
+
+
+def restore_client():
+    if _saved:
+        docker._docker = _saved[0]
+        docker._boot2docker = _saved[1]
+        docker.HANDSHAKE_CACHE = _saved[2]
+        rmtree(_saved[3])
+        del _saved[:]
+    del docker._committed_images[:]
+    docker._web_workers.clear()
+    docker._forget_containers()
+    docker.forget_local_images()
@@ -0,0 +1,185 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import os
+import sys
+import time
+from os import path
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import TestCase, skipUnless
+
+from docker.errors import APIError
+
+from datacats import cache
+from datacats.cli import main
+from datacats.tests.fakedocker import use_fake_client, restore_client
+
+IMAGE = 'datacats/ckan:2.4'
+OTHER_IMAGE = 'datacats/ckan:2.3'
+ARCHIVE_LATENCY_SECONDS = 0.1
+
+
+class TestPreloadCache(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        for image in (IMAGE, OTHER_IMAGE):
+            self.client.image_files[image] = {
+                '/usr/lib/ckan': {'bin/python': 'x' * 1000}}
+        self.cachedir = mkdtemp()
+        self.saved_cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = self.cachedir
+
+    def tearDown(self):
+        restore_client()
+        cache.CACHE_DIR = self.saved_cache_dir
+        os.environ.pop(cache.PRELOAD_CACHE_SIZE_ENV, None)
+        rmtree(self.cachedir)
+
+    def _entries(self):
+        return sorted(os.listdir(cache.cache_dir('preload')))
+
+    def test_failed_extraction_cleaned_up(self):
+        self.client.archive_latency['/usr/lib/ckan'] = ARCHIVE_LATENCY_SECONDS
+        self.assertRaises(APIError, cache.preload_dirs,
+                          IMAGE, ['/usr/lib/ckan', '/missing'])
+        # a copy still running after preload_dirs returned would leave its
+        # staging directory behind
+        time.sleep(ARCHIVE_LATENCY_SECONDS * 2)
+        entry, = self._entries()
+        self.assertEqual(os.listdir(path.join(cache.cache_dir('preload'), entry)),
+                         ['.image'])
+
+    def test_extracted_once(self):
+        first = cache.preload_dirs(IMAGE, ['/usr/lib/ckan'])
+        second = cache.preload_dirs(IMAGE, ['/usr/lib/ckan'])
+        self.assertEqual(first, second)
+        self.assertEqual(self.client.count('get_archive'), 1)
+        with open(path.join(first['/usr/lib/ckan'], 'bin', 'python')) as f:
+            self.assertEqual(f.read(), 'x' * 1000)
+
+    def test_new_image_id_replaces_entry(self):
+        old = cache.preload_dirs(IMAGE, ['/usr/lib/ckan'])['/usr/lib/ckan']
+        self.client.image_digests[IMAGE] = 'sha256:' + 'f' * 64
+        new = cache.preload_dirs(IMAGE, ['/usr/lib/ckan'])['/usr/lib/ckan']
+        self.assertNotEqual(old, new)
+        self.assertFalse(path.exists(old))
+        self.assertEqual(self.client.count('get_archive'), 2)
+        self.assertEqual(self._entries(), ['f' * 64])
+
+    def test_least_recently_used_evicted(self):
+        os.environ[cache.PRELOAD_CACHE_SIZE_ENV] = '1'
+        # make each entry count as half a megabyte
+        self.client.image_files[IMAGE]['/usr/lib/ckan']['big'] = 'x' * 600000
+        self.client.image_files[OTHER_IMAGE]['/usr/lib/ckan']['big'] = 'x' * 600000
+        cache.preload_dirs(OTHER_IMAGE, ['/usr/lib/ckan'])
+        cache.preload_dirs(IMAGE, ['/usr/lib/ckan'])
+        self.assertEqual(self._entries(), [IMAGE.encode('hex')])
+
+    def test_disabled(self):
+        os.environ[cache.PRELOAD_CACHE_SIZE_ENV] = '0'
+        self.assertIsNone(cache.preload_dirs(IMAGE, ['/usr/lib/ckan']))
+        self.assertEqual(self.client.count('get_archive'), 0)
+
+    def test_missing_image(self):
+        self.assertIsNone(cache.preload_dirs('datacats/ckan:1.0', ['/usr/lib/ckan']))
+
+
+class TestPrunePipCache(TestCase):
+    def setUp(self):
+        self.cachedir = mkdtemp()
+        self.saved_cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = self.cachedir
+        pip_cache = cache.pip_cache_dir('2.4')
+        for age, name in enumerate(['new.whl', 'old/b.whl', 'old/a.whl']):
+            filename = path.join(pip_cache, 'wheels', name)
+            if not path.isdir(path.dirname(filename)):
+                os.makedirs(path.dirname(filename))
+            with open(filename, 'w') as f:
+                f.write('x' * 100)
+            when = 1000000000 - age * 1000
+            os.utime(filename, (when, when))
+
+    def tearDown(self):
+        cache.CACHE_DIR = self.saved_cache_dir
+        rmtree(self.cachedir)
+
+    def test_oldest_removed_first(self):
+        self.assertEqual(cache.prune_pip_cache(150), (2, 200))
+        wheels = cache.cache_dir('pip', '2.4', 'wheels')
+        self.assertEqual(os.listdir(wheels), ['new.whl'])
+
+    def test_under_limit(self):
+        self.assertEqual(cache.prune_pip_cache(300), (0, 0))
+
+    def test_version_directory_kept(self):
+        cache.prune_pip_cache(0)
+        self.assertEqual(os.listdir(cache.cache_dir('pip')), ['2.4'])
+
+    def test_tweak_without_environment(self):
+        self.addCleanup(setattr, sys, 'argv', sys.argv)
+        self.addCleanup(setattr, sys, 'stdout', sys.stdout)
+        # run where there is no environment to load
+        self.assertFalse(path.exists('.datacats-environment'))
+        sys.argv = ['datacats', 'tweak', '--prune-cache', '--cache-size=0']
+        sys.stdout = StringIO()
+        main.main()
+        self.assertIn('Removed 3 files', sys.stdout.getvalue())
+
+
+class TestCloneTree(TestCase):
+    def setUp(self):
+        self.src = mkdtemp()
+        self.dst = mkdtemp()
+        os.makedirs(path.join(self.src, 'lib', 'python2.7'))
+        with open(path.join(self.src, 'lib', 'python2.7', 'os.py'), 'w') as f:
+            f.write('import posix')
+        os.symlink('lib/python2.7', path.join(self.src, 'python'))
+        with open(path.join(self.src, '.size'), 'w') as f:
+            f.write('12')
+
+    def tearDown(self):
+        rmtree(self.src)
+        rmtree(self.dst)
+
+    def test_copy(self):
+        cache.clone_tree(self.src, self.dst, hardlink=False)
+        copied = path.join(self.dst, 'lib', 'python2.7', 'os.py')
+        with open(copied) as f:
+            self.assertEqual(f.read(), 'import posix')
+        self.assertNotEqual(os.stat(copied).st_ino,
+                            os.stat(path.join(self.src, 'lib', 'python2.7', 'os.py')).st_ino)
+        self.assertEqual(os.readlink(path.join(self.dst, 'python')), 'lib/python2.7')
+        self.assertFalse(path.exists(path.join(self.dst, '.size')))
+
+    def test_hardlink(self):
+        source = path.join(self.src, 'lib', 'python2.7', 'os.py')
+        linked = path.join(self.dst, 'os.py')
+        cloner = cache._Cloner(hardlink=True)
+        cloner.clone(source, linked)
+        with open(linked) as f:
+            self.assertEqual(f.read(), 'import posix')
+        # reflinks are preferred when this filesystem has them
+        if cloner.methods[0] == 'hardlink':
+            self.assertTrue(path.samefile(source, linked))
+
+    def test_hardlink_only_unchanged_files(self):
+        source = path.join(self.src, 'lib', 'python2.7', 'os.py')
+        st = os.lstat(source)
+        self.assertTrue(cache._linkable(source, None))
+        self.assertTrue(cache._linkable(source, (st.st_uid, st.st_gid)))
+        self.assertFalse(cache._linkable(source, (st.st_uid + 1, st.st_gid)))
+        self.assertFalse(cache._linkable(path.join(self.src, 'easy-install.pth'), None))
+
+    @skipUnless(os.geteuid() == 0, 'needs root to give files to another owner')
+    def test_cached_files_keep_owner(self):
+        source = path.join(self.src, 'lib', 'python2.7', 'os.py')
+        st = os.lstat(source)
+        cache.clone_tree(self.src, self.dst, (st.st_uid + 1, st.st_gid), hardlink=True)
+        self.assertEqual(os.lstat(source).st_uid, st.st_uid)
+        self.assertEqual(os.lstat(path.join(self.dst, 'lib', 'python2.7', 'os.py')).st_uid,
+                         st.st_uid + 1)
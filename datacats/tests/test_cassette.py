@@ -0,0 +1,119 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import os
+import json
+import time
+from os import path
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from docker.errors import APIError
+
+from datacats import docker, cassette
+from datacats.error import DatacatsError
+from datacats.tests.fakedocker import FakeClient, use_fake_client, restore_client
+
+IMAGE = 'datacats/ckan:2.4'
+LATENCY_SECONDS = 0.05
+
+
+class TestCassette(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.filename = path.join(self.tmpdir, 'cassette.json')
+        self.client = FakeClient()
+        self.client.output['echo hello'] = ['hel', 'lo\n']
+        self.client.image_files[IMAGE] = {'/usr/lib/ckan': {'bin/python': '\x7fELF\xff'}}
+
+    def tearDown(self):
+        restore_client()
+        os.environ.pop(cassette.CASSETTE_ENV, None)
+        rmtree(self.tmpdir)
+
+    def _commands(self):
+        out = StringIO()
+        docker.web_command(['echo', 'hello'], stream_output=out)
+        target = path.join(self.tmpdir, 'venv')
+        os.mkdir(target)
+        docker.extract_from_image(IMAGE, {'/usr/lib/ckan': target})
+        with open(path.join(target, 'bin/python'), 'rb') as f:
+            python = f.read()
+        rmtree(target)
+        return out.getvalue(), python, docker.inspect_container('missing')
+
+    def _record(self):
+        recorder = cassette.RecordingClient(self.client, self.filename)
+        use_fake_client(recorder)
+        results = self._commands()
+        recorder.save()
+        restore_client()
+        return results
+
+    def test_replay_results(self):
+        recorded = self._record()
+        self.assertEqual(recorded, ('hello\n', '\x7fELF\xff', None))
+        replay = cassette.ReplayClient(self.filename, scale=0)
+        use_fake_client(replay)
+        self.assertEqual(self._commands(), recorded)
+        self.assertEqual(replay.unplayed(), 0)
+
+    def test_replay_error(self):
+        recorder = cassette.RecordingClient(self.client, self.filename)
+        with self.assertRaises(APIError) as recorded:
+            recorder.inspect_container('missing')
+        recorder.save()
+        with self.assertRaises(APIError) as replayed:
+            cassette.ReplayClient(self.filename).inspect_container('missing')
+        self.assertEqual(replayed.exception.response.status_code, 404)
+        self.assertEqual(str(replayed.exception), str(recorded.exception))
+
+    def test_replay_matches_arguments(self):
+        recorder = cassette.RecordingClient(self.client, self.filename)
+        first = recorder.create_container(IMAGE, name='first')
+        second = recorder.create_container(IMAGE, name='second')
+        recorder.save()
+        replay = cassette.ReplayClient(self.filename)
+        self.assertEqual(replay.create_container(IMAGE, name='second'), second)
+        self.assertEqual(replay.create_container(IMAGE, name='other'), first)
+        with self.assertRaises(DatacatsError):
+            replay.create_container(IMAGE, name='first')
+
+    def test_replay_scale(self):
+        self.client.latency['info'] = LATENCY_SECONDS
+        recorder = cassette.RecordingClient(self.client, self.filename)
+        recorder.info()
+        recorder.info()
+        recorder.save()
+        replay = cassette.ReplayClient(self.filename, scale=0)
+        start = time.time()
+        replay.info()
+        self.assertLess(time.time() - start, LATENCY_SECONDS)
+        replay.scale = 1
+        start = time.time()
+        replay.info()
+        self.assertGreaterEqual(time.time() - start, LATENCY_SECONDS)
+
+    def test_get_docker_replays_from_env(self):
+        self._record()
+        os.environ[cassette.CASSETTE_ENV] = 'replay:' + self.filename
+        use_fake_client()
+        docker._docker = None
+        self.assertIsInstance(docker._get_docker(), cassette.ReplayClient)
+        self.assertEqual(self._commands()[0], 'hello\n')
+
+    def test_bad_env(self):
+        os.environ[cassette.CASSETTE_ENV] = self.filename
+        with self.assertRaises(DatacatsError):
+            cassette.from_env()
+
+    def test_other_version(self):
+        with open(self.filename, 'w') as f:
+            json.dump({'version': 0, 'calls': []}, f)
+        with self.assertRaises(DatacatsError):
+            cassette.ReplayClient(self.filename)
@@ -1,12 +1,34 @@
+import time
+from os import path
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+from datacats import docker
+from datacats.cli import pull
 from datacats.cli.pull import _retry_func
 from datacats.error import DatacatsError
+from datacats.tests.fakedocker import use_fake_client, restore_client
 from unittest import TestCase
 
+PULL_LATENCY_SECONDS = 0.1
+
 
 def raise_an_error(_):
     raise DatacatsError('Hi')
 
 
+def _layer_statuses(layer, size):
+    return [
+        {'status': 'Pulling fs layer', 'progressDetail': {}, 'id': layer},
+        {'status': 'Downloading', 'id': layer,
+         'progressDetail': {'current': size / 2, 'total': size}},
+        {'status': 'Downloading', 'id': layer,
+         'progressDetail': {'current': size, 'total': size}},
+        {'status': 'Pull complete', 'progressDetail': {}, 'id': layer},
+        ]
+
+
 class TestPullCli(TestCase):
     def test_cli_pull_retry(self):
         def count(*dummy, **_):
@@ -20,3 +42,99 @@ class TestPullCli(TestCase):
         except DatacatsError as e:
             self.assertEqual(count.counter, 4)
             self.failIf('We wanted this to happen' not in str(e))
+
+    def test_retry_backoff(self):
+        start = time.time()
+        with self.assertRaises(DatacatsError):
+            _retry_func(raise_an_error, None, 4, lambda *_: None, 'Error',
+                        delay=0.02)
+        # 0.02 + 0.04 + 0.08
+        self.assertGreaterEqual(time.time() - start, 0.14)
+
+
+class TestPullImages(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.client.latency['pull'] = PULL_LATENCY_SECONDS
+        self.retry_delay = pull.PULL_RETRY_DELAY_SECONDS
+        pull.PULL_RETRY_DELAY_SECONDS = 0
+        self.tmpdir = mkdtemp()
+        self.pulled_cache = pull.PULLED_IMAGES_CACHE
+        pull.PULLED_IMAGES_CACHE = path.join(self.tmpdir, 'pulled.json')
+        for image in pull.IMAGES:
+            self.client.pull_statuses[image] = (
+                [{'status': 'Pulling from ' + image, 'id': 'latest'}] +
+                _layer_statuses('base', 2000000) +
+                _layer_statuses(image, 1000000))
+
+    def tearDown(self):
+        pull.PULL_RETRY_DELAY_SECONDS = self.retry_delay
+        pull.PULLED_IMAGES_CACHE = self.pulled_cache
+        rmtree(self.tmpdir)
+        restore_client()
+
+    def test_pulled_concurrently(self):
+        out = StringIO()
+        start = time.time()
+        pull.pull_images(pull.IMAGES, workers=len(pull.IMAGES), out=out)
+        self.assertLess(time.time() - start, PULL_LATENCY_SECONDS * 2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(sorted(l.split()[0] for l in lines), sorted(pull.IMAGES))
+        for line in lines:
+            self.assertIn('done', line)
+            self.assertIn('2/2   layers    3.0 MB / 3.0 MB', line)
+
+    def test_failure_retried_then_raised(self):
+        out = StringIO()
+        with self.assertRaises(DatacatsError):
+            pull.pull_images(pull.IMAGES + ['missing'], out=out)
+        self.assertEqual(
+            len([c for c in self.client.calls if c == ('pull', 'missing')]),
+            pull.PULL_ATTEMPTS)
+        self.assertIn('failed', [l for l in out.getvalue().splitlines()
+                                 if l.startswith('missing')][0])
+
+    def test_failure_raised_after_other_pulls(self):
+        # 'missing' fails at once, well before the other pulls finish
+        self.client.latency['pull'] = 0
+        for image in pull.IMAGES:
+            self.client.pull_latency[image] = PULL_LATENCY_SECONDS
+        out = StringIO()
+        images = pull.IMAGES + ['missing']
+        with self.assertRaises(DatacatsError):
+            pull.pull_images(images, workers=len(images), out=out)
+        # the other pulls still finish and are reported and recorded
+        # before the error reaches the caller
+        states = dict(l.split()[:2] for l in out.getvalue().splitlines())
+        self.assertEqual(states, dict([(i, 'done') for i in pull.IMAGES] +
+                                      [('missing', 'failed')]))
+        self.assertEqual(pull.stale_images(images), ['missing'])
+
+    def test_current_images_skipped(self):
+        self.assertEqual(pull.stale_images(pull.IMAGES), pull.IMAGES)
+        pull.pull_images(pull.IMAGES, out=StringIO())
+        self.assertEqual(pull.stale_images(pull.IMAGES), [])
+        self.assertEqual(self.client.count('images'), 2)
+
+    def test_changed_image_pulled(self):
+        pull.pull_images(pull.IMAGES, out=StringIO())
+        self.client.tagged['datacats/solr:latest'] = 'sha256:0123'
+        docker.forget_local_images()
+        self.assertEqual(pull.stale_images(pull.IMAGES), ['datacats/solr'])
+
+    def test_expired_image_pulled(self):
+        pull.pull_images(pull.IMAGES, out=StringIO())
+        ttl = pull.PULL_CHECK_TTL_SECONDS
+        pull.PULL_CHECK_TTL_SECONDS = -1
+        try:
+            self.assertEqual(pull.stale_images(pull.IMAGES), pull.IMAGES)
+        finally:
+            pull.PULL_CHECK_TTL_SECONDS = ttl
+
+    def test_offline(self):
+        with self.assertRaises(DatacatsError):
+            pull.pull({'--all': False, '--offline': True})
+        pull.pull_images(pull.IMAGES, out=StringIO())
+        pull.pull({'--all': False, '--offline': True})
+        self.assertEqual(len([c for c in self.client.calls if c[0] == 'pull']),
+                         len(pull.IMAGES))
@@ -0,0 +1,557 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import os
+import re
+import time
+import sys
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from docker.errors import APIError
+
+from datacats import docker, scripts, cache
+from datacats.parallel import run_parallel
+from datacats import environment as environment_module
+from datacats.environment import Environment, WEB_WORKER_ENV
+from datacats.error import DatacatsError, WebCommandError
+from datacats.tests.fakedocker import use_fake_client, restore_client, LOG_TIMESTAMP
+
+ARCHIVE_LATENCY_SECONDS = 0.1
+# what the fake daemon takes to commit a container to an image
+COMMIT_LATENCY_SECONDS = 0.05
+STEPS = 5
+
+
+class TestWebCommand(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+
+    def tearDown(self):
+        restore_client()
+
+    def test_no_commit_by_default(self):
+        docker.web_command('true')
+        self.assertEqual(self.client.count('commit'), 0)
+        self.assertEqual(self.client.image_ids, set())
+
+    def test_commit_returns_tracked_image(self):
+        image_id = docker.web_command('true', commit=True)
+        self.assertEqual(docker._committed_images, [image_id])
+        docker.remove_image(image_id)
+        self.assertEqual(docker._committed_images, [])
+
+    def test_remove_committed_images(self):
+        for _ in range(3):
+            docker.web_command('true', commit=True)
+        self.assertEqual(docker.remove_committed_images(), [])
+        self.assertEqual(self.client.image_ids, set())
+        self.assertEqual(docker._committed_images, [])
+
+
+class TestExtractFromImage(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.client.archive_latency['/usr/lib/ckan'] = ARCHIVE_LATENCY_SECONDS
+        self.client.image_files['datacats/ckan:2.4'] = {
+            '/usr/lib/ckan': {'bin/python': 'python'}}
+        self.targets = {'/usr/lib/ckan': mkdtemp(), '/missing': mkdtemp()}
+
+    def tearDown(self):
+        restore_client()
+        for target in self.targets.values():
+            rmtree(target)
+
+    def test_failed_path_waits_for_others(self):
+        self.assertRaises(APIError, docker.extract_from_image,
+                          'datacats/ckan:2.4', self.targets)
+        # the container is only removed once every copy has finished
+        self.assertEqual(self.client.calls[-1][0], 'remove_container')
+        with open(os.path.join(self.targets['/usr/lib/ckan'], 'bin', 'python')) as f:
+            self.assertEqual(f.read(), 'python')
+
+
+class TestLogs(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+
+    def tearDown(self):
+        restore_client()
+
+    def test_buffer_keeps_tail(self):
+        logs = docker.LogBuffer(10)
+        for chunk in ('abc\n', 'defghij\n', 'kl', 'mnop\n'):
+            logs.write(chunk)
+        self.assertEqual(logs.getvalue(), 'ij\nklmnop\n')
+        self.assertEqual(logs.tail(),
+                         '[... earlier output truncated ...]\nklmnop\n')
+
+    def test_buffer_tee(self):
+        tee = StringIO()
+        logs = docker.LogBuffer(2, tee)
+        logs.write('abc')
+        logs.write('def')
+        self.assertEqual(tee.getvalue(), 'abcdef')
+        self.assertEqual(logs.getvalue(), 'ef')
+
+    def test_iter_lines(self):
+        self.assertEqual(
+            list(docker.iter_lines(['a', 'b\nc\n', '\nd'])),
+            ['ab\n', 'c\n', '\n', 'd'])
+
+    def test_collect_logs(self):
+        self.client.output['talk'] = ['one\n', 'two\n', 'three\n']
+        c = docker.run_container(None, 'datacats/web', 'talk')
+        tee = StringIO()
+        self.assertEqual(docker.collect_logs(c['Id'], tee=tee),
+                         'one\ntwo\nthree\n')
+        self.assertEqual(tee.getvalue(), 'one\ntwo\nthree\n')
+        self.assertEqual(docker.collect_logs(c['Id'], 6), 'three\n')
+        self.assertEqual(list(docker.stream_logs(c['Id'])),
+                         ['one\n', 'two\n', 'three\n'])
+
+    def test_multiplex_logs(self):
+        self.client.output['web'] = ['GET /\n', 'GET /api\n']
+        self.client.output['db'] = ['ready\n', 'GET slow\n']
+        names = [docker.run_container(None, 'datacats/web', c)['Id']
+                 for c in ('web', 'db')]
+        lines = list(docker.multiplex_logs(names, pattern=re.compile('GET'),
+                                           buffer_lines=1))
+        self.assertEqual(
+            sorted(lines),
+            sorted([(names[0], LOG_TIMESTAMP, 'GET /\n'),
+                    (names[0], LOG_TIMESTAMP, 'GET /api\n'),
+                    (names[1], LOG_TIMESTAMP, 'GET slow\n')]))
+        # lines from one container stay in order
+        self.assertEqual([l for n, _, l in lines if n == names[0]],
+                         ['GET /\n', 'GET /api\n'])
+
+    def test_multiplex_logs_missing_container(self):
+        lines = list(docker.multiplex_logs(['gone']))
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0][2].startswith('Error following logs'))
+
+    def test_web_command_error_has_log_tail(self):
+        self.client.exit_codes['fail'] = 1
+        self.client.output['fail'] = ['x' * 99 + '\n'] * 1000 + ['the end\n']
+        with self.assertRaises(WebCommandError) as cm:
+            docker.web_command('fail')
+        self.assertLessEqual(len(cm.exception.logs), docker.LOG_TAIL_BYTES + 100)
+        self.assertTrue(cm.exception.logs.endswith('the end\n'))
+
+
+class TestRunCommand(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.datadir = mkdtemp()
+        self.environment = Environment('bench', self.datadir, self.datadir,
+                                       'primary', port=5000)
+
+    def tearDown(self):
+        restore_client()
+        rmtree(self.datadir)
+
+    def _run_steps(self, **kwargs):
+        """
+        Return the seconds STEPS run_command calls take
+        """
+        start = time.time()
+        for _ in range(STEPS):
+            self.environment.run_command('true', **kwargs)
+        return time.time() - start
+
+    def test_run_command_does_not_commit(self):
+        self.environment.run_command('true')
+        self.assertEqual(self.client.count('commit'), 0)
+        self.assertEqual(self.client.image_ids, set())
+
+    def test_commit_only_when_asked(self):
+        self._run_steps(commit=True)
+        self.assertEqual(self.client.count('commit'), STEPS)
+        self._run_steps()
+        self.assertEqual(self.client.count('commit'), STEPS)
+
+    def test_step_latency_without_commit(self):
+        self.client.latency['commit'] = COMMIT_LATENCY_SECONDS
+        self.assertGreaterEqual(self._run_steps(commit=True),
+                                STEPS * COMMIT_LATENCY_SECONDS)
+        # each step saves the commit round trip
+        self.assertLess(self._run_steps(), STEPS * COMMIT_LATENCY_SECONDS)
+
+
+class TestWebWorker(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.datadir = mkdtemp()
+        for package in ('ckan', 'ckanext-a'):
+            os.makedirs(self.datadir + '/' + package)
+            open(self.datadir + '/' + package + '/setup.py', 'w').close()
+        self.environment = Environment('worker', self.datadir, self.datadir,
+                                       'primary', '2.4', port=5000)
+        os.environ[WEB_WORKER_ENV] = '1'
+        self.saved_cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = self.datadir + '/cache'
+
+    def tearDown(self):
+        del os.environ[WEB_WORKER_ENV]
+        cache.CACHE_DIR = self.saved_cache_dir
+        restore_client()
+        rmtree(self.datadir)
+
+    def test_one_container_for_many_steps(self):
+        self.environment.install_package_develop('ckan')
+        self.environment.install_package_develop('ckanext-a')
+        self.environment.create_ckan_ini()
+        self.assertEqual(self.client.count('create_container'), 1)
+        self.assertEqual(self.client.count('exec_create'), 3)
+        execs = [c for c in self.client.calls if c[0] == 'exec_create']
+        self.assertEqual(execs[1][2], [
+            '/scripts/run_as_user.sh', '/scripts/install_package.sh',
+            '/project/ckanext-a'])
+
+        docker.stop_web_workers()
+        self.assertEqual(self.client.containers_by_id, {})
+
+    def test_pip_cache_mounted(self):
+        self.environment.install_package_develop('ckan')
+        binds = self.client.created[0]['HostConfig']['binds']
+        self.assertEqual(binds[cache.pip_cache_dir('2.4')],
+                         {'bind': '/pip-cache', 'ro': False})
+
+    def test_wheelhouse_uses_new_container(self):
+        open(self.datadir + '/ckanext-a/requirements.txt', 'w').close()
+        self.environment.install_package_requirements(
+            'ckanext-a', wheelhouse=self.datadir + '/ckan')
+        self.assertEqual(self.client.count('exec_create'), 0)
+        binds = self.client.created[0]['HostConfig']['binds']
+        self.assertEqual(binds[self.datadir + '/ckan'],
+                         {'bind': '/wheelhouse', 'ro': True})
+        self.assertEqual(binds[cache.pip_cache_dir('2.4')],
+                         {'bind': '/pip-cache', 'ro': False})
+        self.assertEqual(binds[scripts.get_script_path('pip_cache.sh')],
+                         {'bind': '/scripts/pip_cache.sh', 'ro': True})
+
+    def test_batch_install_one_container(self):
+        open(self.datadir + '/ckanext-a/requirements.txt', 'w').close()
+        self.environment.install_packages(['ckan', 'ckanext-a'], ['ckanext-a'])
+        self.assertEqual(len(self.client.created), 1)
+        self.assertEqual(self.client.created[0]['Command'], [
+            '/scripts/run_as_user.sh', '/scripts/run.sh',
+            '-r', '/requirements.txt', '-e', '/project/ckan', '-e', '/project/ckanext-a'])
+
+    def test_exit_code_raises(self):
+        self.client.exit_codes['false'] = 1
+        self.assertRaises(WebCommandError, self.environment.run_command,
+                          ['false'])
+
+    def test_db_commands_use_new_container(self):
+        os.makedirs(self.environment.sitedir + '/run')
+        with open(self.datadir + '/development.ini', 'w') as ini:
+            ini.write('[app:main]\n')
+        self.environment.passwords = dict.fromkeys([
+            'CKAN_PASSWORD', 'DATASTORE_RO_PASSWORD', 'DATASTORE_RW_PASSWORD',
+            'BEAKER_SESSION_SECRET'], 'pw')
+        self.environment.run_command('true', db_links=True)
+        self.assertEqual(self.client.count('exec_create'), 0)
+        self.assertEqual(self.client.count('wait'), 1)
+
+    def test_other_mounts_use_new_container(self):
+        self.environment.run_command('true', ro={'/etc/hosts': '/input'})
+        self.environment.run_command(
+            'true', ro={scripts.get_script_path('purge.sh'): '/scripts/run.sh'})
+        self.assertEqual(self.client.count('exec_create'), 0)
+        self.assertEqual(self.client.count('wait'), 2)
+
+
+class TestContainerListing(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.datadir = mkdtemp()
+
+    def tearDown(self):
+        restore_client()
+        rmtree(self.datadir)
+
+    def test_many_sites_one_listing(self):
+        docker.run_container('datacats_web_env_primary', 'datacats/web',
+                             port_bindings={5000: ('127.0.0.1', 5123)})
+        docker.run_container('datacats_postgres_env_primary', 'datacats/postgres')
+        docker.run_container('datacats_solr_env_two', 'datacats/solr')
+        docker.remove_container('datacats_solr_env_two', force=False)
+        docker.run_container('datacats_solr_env_two', 'datacats/solr')
+        self.client.stop('datacats_solr_env_two')
+        self.client.calls = []
+
+        running = {}
+        addresses = {}
+        for site in ('primary', 'two', 'three'):
+            environment = Environment('env', self.datadir, self.datadir, site,
+                                      port=5000)
+            running[site] = environment.containers_running()
+            addresses[site] = environment.web_address()
+
+        self.assertEqual(running, {
+            'primary': ['web', 'postgres'],
+            'two': ['solr(halted)'],
+            'three': []})
+        self.assertEqual(addresses['primary'], 'http://127.0.0.1:5123/')
+        self.assertEqual(addresses['two'], None)
+        self.assertEqual(self.client.count('containers'), 1)
+        self.assertEqual(self.client.count('inspect_container'), 0)
+
+    def test_listing_refreshed_after_changes(self):
+        self.assertEqual(docker.list_containers(), {})
+        docker.run_container('datacats_web_env_primary', 'datacats/web')
+        self.assertEqual(list(docker.list_containers()),
+                         ['datacats_web_env_primary'])
+        docker.remove_container('datacats_web_env_primary', force=True)
+        self.assertEqual(docker.list_containers(), {})
+        self.assertEqual(self.client.count('containers'), 3)
+
+    def test_listing_while_forgotten(self):
+        docker.run_container('datacats_web_env_primary', 'datacats/web')
+        self.client.latency['containers'] = 0.01
+
+        def list_or_forget(i):
+            if i % 2:
+                # while the other threads are listing
+                time.sleep(0.005)
+                return docker._forget_containers()
+            return list(docker.list_containers())
+        results = run_parallel(list_or_forget, range(20), workers=10)
+        self.assertEqual(results[::2], [['datacats_web_env_primary']] * 10)
+
+
+class _Subprocess(object):
+    """
+    Records the commands environment.subprocess.call would run
+    """
+    def __init__(self):
+        self.calls = []
+
+    def call(self, args):
+        self.calls.append(args)
+        return 0
+
+
+class TestWebShell(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.datadir = mkdtemp()
+        self.environment = Environment('shell', self.datadir, self.datadir,
+                                       'primary', port=5000)
+        os.makedirs(self.environment.sitedir + '/run')
+        os.makedirs(self.datadir + '/ckan')
+        for ini in ('development.ini', 'ckan/test-core.ini'):
+            with open(self.datadir + '/' + ini, 'w') as f:
+                f.write('[app:main]\n')
+        self.environment.passwords = dict.fromkeys([
+            'CKAN_PASSWORD', 'DATASTORE_RO_PASSWORD', 'DATASTORE_RW_PASSWORD',
+            'BEAKER_SESSION_SECRET'], 'pw')
+        self.subprocess = _Subprocess()
+        self._subprocess = environment_module.subprocess
+        environment_module.subprocess = self.subprocess
+
+    def tearDown(self):
+        environment_module.subprocess = self._subprocess
+        restore_client()
+        rmtree(self.datadir)
+
+    def _start_web(self, shell):
+        self.environment._create_run_ini(5000, production=not shell)
+        self.environment._run_web_container(
+            5000, ['/scripts/web.sh'], '127.0.0.1', datapusher=False, shell=shell)
+
+    def test_web_mounts(self):
+        self._start_web(shell=True)
+        mounts = docker.container_mounts(
+            docker.inspect_container('datacats_web_shell_primary'))
+        self.assertEqual(mounts['/project'], False)
+        self.assertEqual(mounts['/usr/lib/ckan'], False)
+        self.assertEqual(mounts['/scripts'], True)
+        self.assertEqual(mounts['/project/ckan/test-core.ini'], True)
+        self.assertTrue(self.environment.web_shell_available())
+
+    def test_shell_execs_into_web(self):
+        self._start_web(shell=True)
+        os.remove(self.environment.sitedir + '/run/test.ini')
+        self.environment.interactive_shell(['ls'])
+        args = self.subprocess.calls[0]
+        self.assertEqual(args[:3], ['docker', 'exec', '-i'])
+        self.assertEqual(args[-3:], ['datacats_web_shell_primary', '/scripts/shell_exec.sh', 'ls'])
+        # nothing regenerated before the command runs
+        self.assertFalse(os.path.exists(self.environment.sitedir + '/run/test.ini'))
+        self.assertEqual(self.client.count('create_container'), 1)
+
+    def test_paster_execs_into_web(self):
+        self._start_web(shell=True)
+        self.environment.interactive_shell(['db', 'init'], paster=True)
+        self.assertEqual(self.subprocess.calls[0][-6:], [
+            '/scripts/shell_exec.sh', '/scripts/paster_cd.sh', 'ckan',
+            'db', 'init', '--config=/project/development.ini'])
+
+    def test_start_keeps_project_read_only(self):
+        with open(self.datadir + '/development.ini', 'w') as f:
+            f.write('[app:main]\nckan.plugins = \n')
+        os.makedirs(self.datadir + '/ckan/ckan/public/base/css')
+        open(self.datadir + '/ckan/ckan/public/base/css/main.debug.css', 'w').close()
+        self.environment.start_ckan()
+        mounts = docker.container_mounts(
+            docker.inspect_container('datacats_web_shell_primary'))
+        self.assertEqual(mounts['/project/'], True)
+        self.assertFalse(os.path.exists(self.environment.sitedir + '/run/test.ini'))
+        self.assertFalse(self.environment.web_shell_available())
+
+    def test_production_web_uses_new_container(self):
+        self._start_web(shell=False)
+        self.assertFalse(self.environment.web_shell_available())
+        self.environment.interactive_shell(['ls'])
+        self.assertEqual(self.subprocess.calls[0][1], 'run')
+
+    def test_detach_uses_new_container(self):
+        self._start_web(shell=True)
+        self.environment.interactive_shell(['ls'], detach=True)
+        self.assertEqual(self.subprocess.calls[0][1], 'run')
+
+
+class TestDbInit(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.datadir = mkdtemp()
+        self.environment = Environment('dbinit', self.datadir, self.datadir,
+                                       'primary', port=5000)
+        os.makedirs(self.environment.sitedir + '/run')
+        with open(self.datadir + '/development.ini', 'w') as ini:
+            ini.write('[app:main]\n')
+        self.environment.passwords = dict.fromkeys([
+            'CKAN_PASSWORD', 'DATASTORE_RO_PASSWORD', 'DATASTORE_RW_PASSWORD',
+            'BEAKER_SESSION_SECRET'], 'pw')
+        docker.run_container('datacats_postgres_dbinit_primary',
+                             'datacats/postgres')
+        self.probes = []
+        self._postgres_probe = environment_module.postgres_probe
+
+        def postgres_probe(host):
+            def probe(remaining):
+                # pylint: disable=unused-argument
+                self.probes.append(host)
+                return True if len(self.probes) >= 3 else None
+            return probe
+        environment_module.postgres_probe = postgres_probe
+        self._address_reachable = environment_module.address_reachable
+        environment_module.address_reachable = lambda host, port: True
+
+    def tearDown(self):
+        environment_module.postgres_probe = self._postgres_probe
+        environment_module.address_reachable = self._address_reachable
+        restore_client()
+        rmtree(self.datadir)
+
+    def test_db_init_runs_once_postgres_is_ready(self):
+        self.client.calls = []
+        self.environment.ckan_db_init()
+        self.assertEqual(self.probes, ['172.17.0.2'] * 3)
+        self.assertEqual(self.client.count('create_container'), 1)
+        self.assertEqual(self.client.count('commit'), 0)
+
+    def test_unreachable_address_probed_with_exec(self):
+        environment_module.address_reachable = lambda host, port: False
+        self.environment.wait_for_postgres_available()
+        self.assertEqual(self.probes, [])
+        execs = [c for c in self.client.calls if c[0] == 'exec_create']
+        self.assertEqual(execs[0][1:], ('datacats_postgres_dbinit_primary',
+                                        ['pg_isready', '-q', '-h', '127.0.0.1']))
+
+
+class TestHandshakeCache(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.tmpdir = mkdtemp()
+        docker.HANDSHAKE_CACHE = self.tmpdir + '/cache/docker-handshake.json'
+        self.saved_host = os.environ.get('DOCKER_HOST')
+        os.environ['DOCKER_HOST'] = 'tcp://192.168.99.100:2376'
+
+    def tearDown(self):
+        if self.saved_host is None:
+            del os.environ['DOCKER_HOST']
+        else:
+            os.environ['DOCKER_HOST'] = self.saved_host
+        restore_client()
+        rmtree(self.tmpdir)
+
+    def test_saved_per_host(self):
+        docker._save_handshake(api_version='1.21')
+        self.assertEqual(docker._load_handshake()['api_version'], '1.21')
+        os.environ['DOCKER_HOST'] = 'unix:///var/run/docker.sock'
+        self.assertEqual(docker._load_handshake(), {})
+
+    def test_expires(self):
+        docker._save_handshake(api_version='1.21',
+                               time=time.time() - docker.HANDSHAKE_TTL_SECONDS - 1)
+        self.assertEqual(docker._load_handshake(), {})
+
+    def test_forget(self):
+        docker._save_handshake(api_version='1.21')
+        docker.forget_handshake()
+        self.assertEqual(docker._load_handshake(), {})
+
+    def test_forget_checks_machine(self):
+        def stopped():
+            raise DatacatsError('Please start your docker-machine')
+        self.addCleanup(setattr, sys, 'platform', sys.platform)
+        self.addCleanup(setattr, docker, '_machine_check_connectivity',
+                        docker._machine_check_connectivity)
+        sys.platform = 'darwin'
+        docker._machine_check_connectivity = stopped
+        docker._save_handshake(api_version='1.21')
+        with self.assertRaises(DatacatsError):
+            docker.forget_handshake()
+        self.assertEqual(docker._load_handshake(), {})
+
+    def test_client_from_saved_version(self):
+        docker._save_handshake(api_version='1.21')
+        docker._docker = None
+        # no daemon to talk to, so this only works without a handshake
+        self.assertEqual(docker._get_docker().api_version, '1.21')
+
+    def test_boot2docker_detected_once(self):
+        self.assertFalse(docker.is_boot2docker())
+        docker._boot2docker = None
+        self.assertFalse(docker.is_boot2docker())
+        self.assertEqual(self.client.count('info'), 1)
+        self.assertFalse(docker._load_handshake()['boot2docker'])
+
+
+class TestConnectionPool(TestCase):
+    def test_unix_socket_pool_shared(self):
+        client = docker.Client(base_url='unix:///var/run/docker.sock',
+                               version=docker.MINIMUM_API_VERSION)
+        docker._enlarge_connection_pools(client)
+        adapter = client.get_adapter('http+docker://localunixsocket/containers/json')
+        first = adapter.get_connection('http+docker://localunixsocket/containers/json')
+        second = adapter.get_connection('http+docker://localunixsocket/info')
+        self.assertIs(first, second)
+        self.assertEqual(first.pool.maxsize, docker.DOCKER_POOL_SIZE)
+
+    def test_unknown_unix_adapter_kept(self):
+        client = docker.Client(base_url='unix:///var/run/docker.sock',
+                               version=docker.MINIMUM_API_VERSION)
+        adapter = client.get_adapter('http+docker://localunixsocket/info')
+        # laid out like docker-py releases before 1.7
+        del adapter.pools
+        docker._enlarge_connection_pools(client)
+        self.assertIs(client.get_adapter('http+docker://localunixsocket/info'),
+                      adapter)
+
+    def test_tcp_pool_size(self):
+        client = docker.Client(base_url='tcp://127.0.0.1:2375',
+                               version=docker.MINIMUM_API_VERSION)
+        docker._enlarge_connection_pools(client)
+        pool = client.get_adapter('http://127.0.0.1:2375').get_connection(
+            'http://127.0.0.1:2375/info')
+        self.assertEqual(pool.pool.maxsize, docker.DOCKER_POOL_SIZE)
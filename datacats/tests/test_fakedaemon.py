@@ -0,0 +1,77 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import time
+from StringIO import StringIO
+from unittest import TestCase, skipUnless
+
+from docker import Client
+
+from datacats import docker
+from datacats.error import WebCommandError
+from datacats.tests.fakedaemon import FakeDaemon, API_VERSION, services_supported
+from datacats.tests.fakedocker import use_fake_client, restore_client
+from datacats.tests import benchmark
+
+LATENCY_SECONDS = 0.05
+
+
+class TestFakeDaemon(TestCase):
+    def setUp(self):
+        self.daemon = FakeDaemon()
+        self.daemon.add_image('datacats/web')
+        self.daemon.start()
+        use_fake_client(Client(base_url=self.daemon.base_url, version=API_VERSION))
+
+    def tearDown(self):
+        restore_client()
+        self.daemon.stop()
+
+    def test_web_command_output(self):
+        self.daemon.output['echo hello'] = ['hello\n']
+        out = StringIO()
+        docker.web_command(['echo', 'hello'], stream_output=out)
+        self.assertEqual(out.getvalue(), 'hello\n')
+        self.assertEqual(self.daemon.count('create_container'), 1)
+        self.assertEqual(self.daemon.count('remove_container'), 1)
+        self.assertEqual(self.daemon.containers, {})
+
+    def test_web_command_exit_code(self):
+        self.daemon.output['false'] = ['oops\n']
+        self.daemon.exit_codes['false'] = 1
+        with self.assertRaises(WebCommandError) as cm:
+            docker.web_command('false')
+        self.assertIn('oops', cm.exception.logs)
+
+    def test_run_and_remove_container(self):
+        docker.run_container('fake_web', 'datacats/web', '/scripts/web.sh')
+        self.assertTrue(docker.inspect_container('fake_web')['State']['Running'])
+        docker.remove_container('fake_web')
+        self.assertEqual(docker.inspect_container('fake_web'), None)
+
+    def test_pull_adds_image(self):
+        self.assertFalse(docker.image_exists('datacats/solr'))
+        list(docker.pull_stream('datacats/solr'))
+        docker.forget_local_images()
+        self.assertTrue(docker.image_exists('datacats/solr'))
+
+    def test_latency(self):
+        self.daemon.latency['version'] = LATENCY_SECONDS
+        start = time.time()
+        docker._get_docker().version()
+        self.assertGreaterEqual(time.time() - start, LATENCY_SECONDS)
+        self.assertEqual(self.daemon.count('version'), 1)
+
+
+class TestBenchmark(TestCase):
+    @skipUnless(services_supported(), 'needs 127.0.0.x addresses (Linux)')
+    def test_commands_succeed(self):
+        with benchmark.fake_daemon(0) as daemon:
+            results = benchmark.run_commands(daemon)
+        self.assertEqual([name for name, _, _ in results],
+                         [name for name, _ in benchmark.COMMANDS])
+        for _, _, calls in results:
+            self.assertTrue(calls)
@@ -0,0 +1,79 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from datacats.cli import install
+from datacats.environment import Environment
+from datacats.tests.fakedocker import use_fake_client, restore_client
+
+
+class FakeInstallEnvironment(Environment):
+    """
+    Records installs instead of running them in containers
+    """
+    def __init__(self, target):
+        super(FakeInstallEnvironment, self).__init__(
+            'test', target, target + '/data', 'primary', '2.4')
+        os.makedirs(self.datadir)
+        self.installed = []
+
+    def install_package_develop(self, psrc, stream_output=None, wheelhouse=None):
+        self.installed.append(psrc)
+
+    def install_package_requirements(self, psrc, stream_output=None, wheelhouse=None):
+        self.installed.append(psrc + ' requirements')
+
+
+class TestIncrementalInstall(TestCase):
+    def setUp(self):
+        use_fake_client()
+        self.target = mkdtemp()
+        for psrc in ('ckan', 'ckanext-a'):
+            os.makedirs(self.target + '/' + psrc)
+            with open(self.target + '/' + psrc + '/setup.py', 'w') as f:
+                f.write('setup()')
+            with open(self.target + '/' + psrc + '/requirements.txt', 'w') as f:
+                f.write('requests\n')
+        self.environment = FakeInstallEnvironment(self.target)
+        self.wheelhouse = self.target + '/ckan'
+
+    def tearDown(self):
+        restore_client()
+        rmtree(self.target)
+
+    def _install(self, **kwargs):
+        del self.environment.installed[:]
+        return install.install_all(self.environment, False, quiet=True,
+                                   wheelhouse=self.wheelhouse, **kwargs)
+
+    def test_unchanged_skipped(self):
+        self.assertEqual(self._install(), ['ckan', 'ckanext-a'])
+        self.assertEqual(self._install(), [])
+        self.assertEqual(self.environment.installed, [])
+
+    def test_changed_reinstalled(self):
+        self._install()
+        with open(self.target + '/ckanext-a/setup.cfg', 'w') as f:
+            f.write('[egg_info]\n')
+        self.assertEqual(self._install(), ['ckanext-a'])
+        self.assertEqual(self.environment.installed,
+                         ['ckanext-a', 'ckanext-a requirements'])
+
+    def test_force(self):
+        self._install()
+        self.assertEqual(self._install(force=True), ['ckan', 'ckanext-a'])
+
+    def test_failed_install_not_recorded(self):
+        def fail(psrc, *args):
+            raise ValueError(psrc, args)
+        self.environment.install_package_requirements = fail
+        self.assertRaises(ValueError, self._install)
+        del self.environment.install_package_requirements
+        self.assertEqual(self._install(), ['ckan', 'ckanext-a'])
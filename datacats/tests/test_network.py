@@ -0,0 +1,140 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import socket
+import time
+from threading import Thread
+from unittest import TestCase
+
+from datacats import docker, network
+from datacats.tests.fakedocker import use_fake_client, restore_client
+
+
+def _probe_after(seconds):
+    start = time.time()
+
+    def probe(remaining):
+        # pylint: disable=unused-argument
+        probe.calls += 1
+        return True if time.time() - start >= seconds else None
+    probe.calls = 0
+    return probe
+
+
+def _serve(*replies):
+    """
+    Accept a connection on a local port for each of replies in turn, send
+    it the reply and return the port
+    """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def serve():
+        # pylint: disable=no-member
+        for reply in replies:
+            conn, _ = server.accept()
+            conn.recv(1024)
+            conn.sendall(reply)
+            conn.close()
+        server.close()
+    thread = Thread(target=serve)
+    # left waiting if fewer connections are made
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def _http_reply(status):
+    return 'HTTP/1.0 {0}\r\nContent-Length: 0\r\n\r\n'.format(status)
+
+
+class TestWaitForReady(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        docker.run_container('datacats_web_env_primary', 'datacats/web')
+
+    def tearDown(self):
+        restore_client()
+
+    def test_ready_with_backoff(self):
+        probe = _probe_after(0.5)
+        self.assertTrue(network.wait_for_ready(
+            'datacats_web_env_primary', probe, 5))
+        # a fixed 0.1s poll would take ~6 tries
+        self.assertLess(probe.calls, 6)
+
+    def test_die_event_ends_wait(self):
+        self.client.container_events['datacats_web_env_primary'] = [
+            (0.2, {'status': 'die'})]
+        start = time.time()
+        self.assertFalse(network.wait_for_ready(
+            'datacats_web_env_primary', _probe_after(60), 5))
+        self.assertLess(time.time() - start, 2)
+
+    def test_stopped_container_without_events(self):
+        self.client.stop('datacats_web_env_primary')
+        self.assertFalse(network.wait_for_ready(
+            'datacats_web_env_primary', _probe_after(60), 5))
+
+    def test_timeout(self):
+        self.assertRaises(network.ServiceTimeout, network.wait_for_ready,
+                          'datacats_web_env_primary', _probe_after(60), 0.3)
+
+    def test_solr_loading(self):
+        port = _serve(_http_reply('503 Service Unavailable'), _http_reply('200 OK'))
+        self.assertTrue(network.wait_for_ready(
+            'datacats_web_env_primary', network.solr_probe('127.0.0.1', port), 5))
+
+    def test_watch_closed_when_ready(self):
+        watches = []
+
+        class Watch(network._DeathWatch):
+            def __init__(self, *args):
+                super(Watch, self).__init__(*args)
+                watches.append(self)
+        self.patch(network, '_DeathWatch', Watch)
+        self.patch(network, 'WATCH_WINDOW_SECONDS', 1)
+        self.assertTrue(network.wait_for_ready(
+            'datacats_web_env_primary', _probe_after(0), 60))
+        # the events stream is released within a window, not after 60s
+        watches[0]._thread.join(3)
+        self.assertFalse(watches[0]._thread.is_alive())
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+
+class TestAddressReachable(TestCase):
+    def test_refused(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        self.assertTrue(network.address_reachable('127.0.0.1', port))
+
+    def test_listening(self):
+        port = _serve('')
+        self.assertTrue(network.address_reachable('127.0.0.1', port))
+
+
+class TestPostgresProbe(TestCase):
+    def test_accepting_connections(self):
+        port = _serve('R\0\0\0\x08\0\0\0\x03')
+        self.assertTrue(network.postgres_probe('127.0.0.1', port)(1))
+
+    def test_starting_up(self):
+        port = _serve('E\0\0\0\x30SFATAL\0C57P03\0Mthe database system '
+                      'is starting up\0\0')
+        self.assertEqual(network.postgres_probe('127.0.0.1', port)(1), None)
+
+    def test_not_listening(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        self.assertEqual(network.postgres_probe('127.0.0.1', port)(1), None)
@@ -0,0 +1,60 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import os
+import sys
+import json
+import subprocess
+from os.path import dirname, abspath
+from unittest import TestCase
+
+from datacats.cli import main
+
+ROOT = dirname(dirname(dirname(abspath(__file__))))
+# what "datacats --help" may spend importing datacats.cli.main, several
+# times what it needs. Set DATACATS_IMPORT_BUDGET_MS on slow machines
+IMPORT_BUDGET_ENV = 'DATACATS_IMPORT_BUDGET_MS'
+IMPORT_BUDGET_MS = 150
+IMPORT_RUNS = 3
+# slow to import and only needed once a command runs
+HEAVY_MODULES = ['docker', 'requests', 'clint', 'lockfile', 'watchdog',
+                 'datacats.docker', 'datacats.environment']
+
+_IMPORT = '''
+import sys, time, json
+start = time.time()
+import datacats.cli.main
+print json.dumps([time.time() - start, sorted(sys.modules)])
+'''
+
+
+def _import_main():
+    """
+    Return (seconds, modules loaded) for importing datacats.cli.main in a
+    new interpreter
+    """
+    out = subprocess.check_output([sys.executable, '-c', _IMPORT], cwd=ROOT)
+    return json.loads(out)
+
+
+class TestStartup(TestCase):
+    def test_no_heavy_imports(self):
+        _, modules = _import_main()
+        self.assertEqual([m for m in HEAVY_MODULES if m in modules], [])
+
+    def test_import_budget(self):
+        budget = float(os.environ.get(IMPORT_BUDGET_ENV, IMPORT_BUDGET_MS))
+        seconds = min(_import_main()[0] for _ in range(IMPORT_RUNS))
+        self.assertLess(seconds * 1000, budget)
+
+    def test_help_runs(self):
+        out = subprocess.check_output(
+            [sys.executable, '-m', 'datacats.cli.main', '--help'], cwd=ROOT)
+        self.assertIn('datacats COMMAND', out)
+
+    def test_every_command_importable(self):
+        for command in main.COMMANDS:
+            self.assertTrue(main._command_function(command).__doc__, command)
@@ -0,0 +1,349 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+import time
+from os import path, makedirs, symlink
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from datacats import task, cache
+from datacats.error import DatacatsError
+from datacats.parallel import Step, run_steps, run_parallel
+from datacats.tests.fakedocker import use_fake_client, restore_client
+
+START_LATENCY_SECONDS = 0.2
+
+
+def _container_name(container_type):
+    return 'datacats_{0}_env_primary'.format(container_type)
+
+
+class TestStartSupportingContainers(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.client.latency['start'] = START_LATENCY_SECONDS
+        self.sitedir = mkdtemp()
+
+    def tearDown(self):
+        restore_client()
+        rmtree(self.sitedir)
+
+    def test_started_concurrently(self):
+        ready = []
+        start = time.time()
+        timings = task.start_supporting_containers(
+            self.sitedir, self.sitedir, {}, _container_name, ['redis'],
+            ready_checks={'postgres': lambda: ready.append('postgres'),
+                          'solr': lambda: ready.append('solr')})
+        elapsed = time.time() - start
+
+        self.assertEqual(sorted(timings), ['postgres', 'redis', 'solr'])
+        self.assertEqual(sorted(ready), ['postgres', 'solr'])
+        self.assertLess(elapsed, START_LATENCY_SECONDS * 2)
+        self.assertEqual(sorted(task.containers_running(_container_name)),
+                         ['postgres', 'redis', 'solr'])
+
+    def test_already_running(self):
+        task.start_supporting_containers(
+            self.sitedir, self.sitedir, {}, _container_name, [])
+        self.client.calls = []
+        self.assertEqual(task.start_supporting_containers(
+            self.sitedir, self.sitedir, {}, _container_name, []), {})
+        self.assertEqual(self.client.count('start'), 0)
+
+
+STOP_LATENCY_SECONDS = 0.2
+ALL_CONTAINERS = ['web', 'datapusher', 'postgres', 'solr', 'redis']
+
+
+class TestStopContainers(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        for container in ALL_CONTAINERS:
+            self.client.create_container('image', name=_container_name(container))
+            self.client.start(_container_name(container))
+
+    def tearDown(self):
+        restore_client()
+
+    def test_stopped_concurrently(self):
+        self.client.latency['stop'] = STOP_LATENCY_SECONDS
+        start = time.time()
+        task.stop_containers(_container_name, ALL_CONTAINERS)
+        self.assertLess(time.time() - start, STOP_LATENCY_SECONDS * 2)
+        self.assertEqual(task.containers_running(_container_name), [])
+        self.assertEqual(self.client.stop_timeouts, dict(
+            (_container_name(c), 10) for c in ['postgres', 'solr', 'redis']))
+
+    def test_postgres_stopped_after_web(self):
+        self.client.latency['remove_container'] = STOP_LATENCY_SECONDS
+        task.stop_containers(_container_name, ALL_CONTAINERS)
+        calls = self.client.calls
+        self.assertGreater(calls.index(('stop', _container_name('postgres'))),
+                           calls.index(('remove_container', _container_name('web'))))
+        self.assertGreater(calls.index(('stop', _container_name('postgres'))),
+                           calls.index(('remove_container', _container_name('datapusher'))))
+
+    def test_fast(self):
+        task.stop_supporting_containers(_container_name, ['redis'], fast=True)
+        self.assertEqual(self.client.stop_timeouts, {
+            _container_name('postgres'): 10,
+            _container_name('solr'): task.FAST_STOP_GRACE_SECONDS,
+            _container_name('redis'): task.FAST_STOP_GRACE_SECONDS})
+        self.assertEqual(task.containers_running(_container_name), ['web', 'datapusher'])
+
+
+PRELOAD_IMAGE = 'datacats/ckan:2.4'
+CKAN_CONFIG = {'who.ini': '[who]', 'solr/schema.xml': '<schema/>'}
+
+
+class TestExtractPreload(TestCase):
+    def setUp(self):
+        self.client = use_fake_client()
+        self.client.image_files[PRELOAD_IMAGE] = {
+            '/usr/lib/ckan': {'bin/python': 'python', 'bin/paster': 'paster'},
+            '/project/ckan': dict(('ckan/config/' + name, contents)
+                                  for name, contents in CKAN_CONFIG.iteritems()),
+            '/project/datapusher': {'setup.py': 'setup()'},
+            }
+        self.srcdir = mkdtemp()
+        self.datadir = mkdtemp()
+        self.cachedir = mkdtemp()
+        self.saved_cache_dir = cache.CACHE_DIR
+        cache.CACHE_DIR = self.cachedir
+
+    def tearDown(self):
+        restore_client()
+        cache.CACHE_DIR = self.saved_cache_dir
+        rmtree(self.srcdir)
+        rmtree(self.datadir)
+        rmtree(self.cachedir)
+
+    def test_streamed_without_starting_a_container(self):
+        task.extract_preload(self.srcdir, self.datadir, PRELOAD_IMAGE,
+                             datapusher=True)
+        self.assertEqual(self.client.count('create_container'), 1)
+        self.assertEqual(self.client.count('start'), 0)
+        self.assertEqual(self.client.count('get_archive'), 3)
+        self.assertEqual(self.client.containers_by_id, {})
+        with open(path.join(self.datadir, 'venv', 'bin', 'paster')) as f:
+            self.assertEqual(f.read(), 'paster')
+        self.assertTrue(path.isfile(path.join(self.srcdir, 'datapusher', 'setup.py')))
+        with open(path.join(self.srcdir, 'schema.xml')) as f:
+            self.assertEqual(f.read(), '<schema/>')
+        self.assertTrue(path.isfile(path.join(self.srcdir, 'who.ini')))
+
+    def test_second_environment_cloned_from_cache(self):
+        task.extract_preload(self.srcdir, self.datadir, PRELOAD_IMAGE)
+        srcdir2, datadir2 = mkdtemp(), mkdtemp()
+        try:
+            task.extract_preload(srcdir2, datadir2, PRELOAD_IMAGE)
+            with open(path.join(datadir2, 'venv', 'bin', 'python')) as f:
+                self.assertEqual(f.read(), 'python')
+            self.assertTrue(path.isfile(path.join(srcdir2, 'schema.xml')))
+        finally:
+            rmtree(srcdir2)
+            rmtree(datadir2)
+        self.assertEqual(self.client.count('get_archive'), 2)
+
+    def test_one_container_without_archive_support(self):
+        self.client.api_version = '1.19'
+        # the fake container doesn't copy anything, provide the config
+        for name, contents in CKAN_CONFIG.iteritems():
+            filename = path.join(self.srcdir, 'ckan', 'ckan', 'config', name)
+            if not path.isdir(path.dirname(filename)):
+                makedirs(path.dirname(filename))
+            with open(filename, 'w') as f:
+                f.write(contents)
+        task.extract_preload(self.srcdir, self.datadir, PRELOAD_IMAGE)
+        self.assertEqual(self.client.count('start'), 1)
+        self.assertEqual(self.client.count('get_archive'), 0)
+        command = self.client.calls[0][2]
+        self.assertIn('/bin/cp -a /usr/lib/ckan/. /usr/lib/ckan_target/.', command[2])
+        self.assertIn('/bin/cp -a /project/ckan/. /project_target/ckan/.', command[2])
+        self.assertNotIn('datapusher', command[2])
+        self.assertTrue(path.isfile(path.join(self.srcdir, 'schema.xml')))
+
+
+class TestRunParallel(TestCase):
+    def test_results_in_order(self):
+        self.assertEqual(run_parallel(lambda n: n * 2, [3, 1, 2]), [6, 2, 4])
+
+    def test_failure_raised_after_others_finish(self):
+        done = []
+
+        def call(n):
+            if n == 0:
+                raise DatacatsError('failed')
+            time.sleep(0.1)
+            done.append(n)
+
+        self.assertRaises(DatacatsError, run_parallel, call, [0, 1, 2])
+        self.assertEqual(sorted(done), [1, 2])
+
+
+class TestRunSteps(TestCase):
+    def test_independent_steps_run_in_parallel(self):
+        order = []
+
+        def step(name, seconds=0):
+            def fn():
+                time.sleep(seconds)
+                order.append(name)
+            return fn
+
+        start = time.time()
+        timings = run_steps([
+            Step('a', step('a')),
+            Step('b', step('b', 0.2), ['a']),
+            Step('c', step('c', 0.2), ['a']),
+            Step('d', step('d'), ['b', 'c']),
+            ])
+        self.assertLess(time.time() - start, 0.35)
+        self.assertEqual(order[0], 'a')
+        self.assertEqual(order[-1], 'd')
+        self.assertEqual(sorted(name for name, _ in timings), ['a', 'b', 'c', 'd'])
+
+    def test_failure_cancels_downstream(self):
+        ran = []
+
+        def fail():
+            raise DatacatsError('failed')
+
+        self.assertRaises(DatacatsError, run_steps, [
+            Step('a', fail),
+            Step('b', lambda: ran.append('b'), ['a']),
+            Step('c', lambda: ran.append('c'), ['b']),
+            ])
+        self.assertEqual(ran, [])
+
+    def test_unknown_requirement(self):
+        self.assertRaises(ValueError, run_steps, [Step('a', int, ['b'])])
+
+    def test_circular_requirements(self):
+        self.assertRaises(ValueError, run_steps, [
+            Step('a', int, ['b']), Step('b', int, ['a'])])
+
+
+class TestMergeRequirements(TestCase):
+    def setUp(self):
+        self.srcdir = mkdtemp()
+        for psrc, reqs in [
+                ('ckan', 'requests==2.3.0\nPylons==0.9.7  # web framework\n'),
+                ('ckanext-a', '# comment\nrequests>=2.0\nckan\n'
+                              '-r dev-requirements.txt\npylons==0.9.7\n'),
+                ('ckanext-b', 'lxml\n')]:
+            makedirs(path.join(self.srcdir, psrc))
+            reqname = 'pip-requirements.txt' if psrc == 'ckanext-b' else 'requirements.txt'
+            with open(path.join(self.srcdir, psrc, reqname), 'w') as f:
+                f.write(reqs)
+
+    def tearDown(self):
+        rmtree(self.srcdir)
+
+    def test_first_requirement_wins(self):
+        merged = task.merge_requirements(
+            self.srcdir, ['ckan', 'ckanext-a', 'ckanext-b'], ['ckan', 'ckanext-a'])
+        self.assertEqual(merged.splitlines(), [
+            '# /project/ckan/requirements.txt',
+            'requests==2.3.0',
+            'Pylons==0.9.7',
+            '# /project/ckanext-a/requirements.txt',
+            '# requests>=2.0 (using requests==2.3.0)',
+            '# ckan (using -e /project/ckan)',
+            '-r /project/ckanext-a/dev-requirements.txt',
+            '# pylons==0.9.7 (using Pylons==0.9.7)',
+            '# /project/ckanext-b/pip-requirements.txt',
+            'lxml',
+            ])
+
+    def test_develop_names_normalized(self):
+        with open(path.join(self.srcdir, 'ckanext-b', 'pip-requirements.txt'), 'w') as f:
+            f.write('ckanext-C_d\n')
+        merged = task.merge_requirements(self.srcdir, ['ckanext-b'], ['ckanext_c-D'])
+        self.assertEqual(merged.splitlines(), [
+            '# /project/ckanext-b/pip-requirements.txt',
+            '# ckanext-C_d (using -e /project/ckanext_c-D)',
+            ])
+
+
+class TestCleanPyc(TestCase):
+    def setUp(self):
+        self.srcdir = mkdtemp()
+        self.outside = mkdtemp()
+        for name in ['ckan/ckan/model/__init__.pyc', 'ckan/ckan/model/__init__.py',
+                     'ckanext-a/.git/hooks/x.pyc', 'ckanext-a/node_modules/y.pyc',
+                     'setup.pyc']:
+            filename = path.join(self.srcdir, name)
+            if not path.isdir(path.dirname(filename)):
+                makedirs(path.dirname(filename))
+            open(filename, 'w').close()
+        open(path.join(self.outside, 'linked.pyc'), 'w').close()
+        symlink(self.outside, path.join(self.srcdir, 'linked'))
+
+    def tearDown(self):
+        rmtree(self.srcdir)
+        rmtree(self.outside)
+
+    def test_dry_run(self):
+        found, _ = task.clean_pyc(self.srcdir, dry_run=True)
+        self.assertEqual(sorted(found), [
+            path.join(self.srcdir, 'ckan/ckan/model/__init__.pyc'),
+            path.join(self.srcdir, 'setup.pyc')])
+        self.assertTrue(path.exists(path.join(self.srcdir, 'setup.pyc')))
+
+    def test_removed(self):
+        removed, _ = task.clean_pyc(self.srcdir)
+        self.assertEqual(len(removed), 2)
+        self.assertEqual(task.find_pyc(self.srcdir), [])
+        self.assertTrue(path.exists(path.join(self.srcdir, 'ckan/ckan/model/__init__.py')))
+        self.assertTrue(path.exists(path.join(self.outside, 'linked.pyc')))
+
+
+class TestLoadAllSites(TestCase):
+    def setUp(self):
+        self.srcdir = mkdtemp()
+        self.datadir = mkdtemp()
+        with open(self.srcdir + '/.datacats-environment', 'w') as f:
+            f.write('[datacats]\nname = env\nckan_version = 2.4\n\n'
+                    '[site_primary]\nport = 5000\n\n'
+                    '[site_test]\nport = 5001\nsite_url = http://test\n')
+        for site in ('primary', 'test'):
+            makedirs(path.join(self.datadir, 'sites', site))
+            with open(path.join(self.datadir, 'sites', site, 'passwords.ini'), 'w') as f:
+                f.write('[passwords]\nbeaker_session_secret = {0}\n'.format(site))
+
+    def tearDown(self):
+        rmtree(self.srcdir)
+        rmtree(self.datadir)
+
+    def test_all_sites(self):
+        sites = task.load_all_sites(self.srcdir, self.datadir)
+        self.assertEqual(sites, {
+            'primary': (5000, None, None,
+                        {'BEAKER_SESSION_SECRET': 'primary'}),
+            'test': (5001, None, 'http://test',
+                     {'BEAKER_SESSION_SECRET': 'test'}),
+            })
+
+    def test_matches_load_site(self):
+        sites = task.load_all_sites(self.srcdir, self.datadir)
+        for site in ('primary', 'test'):
+            self.assertEqual(sites[site],
+                             task.load_site(self.srcdir, self.datadir, site))
+
+    def test_config_parsed_once(self):
+        filename = self.srcdir + '/.datacats-environment'
+        self.assertIs(task.read_config(filename), task.read_config(filename))
+
+    def test_config_change_seen(self):
+        filename = self.srcdir + '/.datacats-environment'
+        task.load_site(self.srcdir, self.datadir, 'primary')
+        with open(filename, 'a') as f:
+            f.write('address = 0.0.0.0\n')
+        self.assertEqual(task.load_site(self.srcdir, self.datadir, 'test')[1],
+                         '0.0.0.0')
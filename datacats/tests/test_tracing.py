@@ -0,0 +1,58 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+from unittest import TestCase
+
+from datacats import docker, tracing
+from datacats.tests.fakedocker import FakeClient, use_fake_client, restore_client
+
+
+class TestTracing(TestCase):
+    def setUp(self):
+        tracing.enable()
+        self.client = use_fake_client(tracing.TracedClient(FakeClient()))
+        self.fake = self.client._client
+
+    def tearDown(self):
+        tracing.disable()
+        restore_client()
+
+    def test_api_calls_recorded(self):
+        self.fake.output['talk'] = ['hello\n', 'world\n']
+        c = docker.run_container('talker', 'datacats/web', 'talk')
+        self.assertEqual(docker.collect_logs(c['Id']), 'hello\nworld\n')
+        docker.remove_container('talker')
+
+        calls = [(s['category'], s['name']) for s in tracing.spans()]
+        self.assertIn(('docker', 'create_container'), calls)
+        self.assertIn(('docker', 'attach'), calls)
+        self.assertIn(('datacats', 'run_container'), calls)
+        self.assertIn(('datacats', 'remove_container'), calls)
+        attach = [s for s in tracing.spans() if s['name'] == 'attach'][0]
+        # the stream is measured once it has been read
+        self.assertEqual(attach['size'], len('hello\nworld\n'))
+        self.assertEqual(attach['target'], c['Id'][:12])
+
+    def test_chrome_trace(self):
+        docker.inspect_container('missing')
+        events = tracing.chrome_trace()['traceEvents']
+        self.assertEqual([e['name'] for e in events],
+                         ['inspect_container', 'inspect_container'])
+        self.assertEqual(set(e['ph'] for e in events), set(['X']))
+        self.assertEqual(events[1]['args']['target'], 'missing')
+
+    def test_summary(self):
+        for _ in range(3):
+            docker.inspect_container('missing')
+        summary = tracing.summary()
+        self.assertIn('Slowest Docker API calls', summary)
+        self.assertIn('     3', summary)
+        self.assertIn('inspect_container (datacats)', summary)
+
+    def test_disabled(self):
+        tracing.disable()
+        docker.inspect_container('missing')
+        self.assertEqual(tracing.spans(), [])
@@ -19,5 +19,8 @@ class TestValidate(TestCase):
     def test_name_with_leading_numbers(self):
         self.assertFalse(valid_name('42seven'))
 
+    def test_reserved_name(self):
+        self.assertFalse(valid_name('cache'))
+
     def test_name_too_short(self):
         self.assertFalse(valid_deploy_name('foo'))
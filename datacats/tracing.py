@@ -0,0 +1,190 @@
+# Copyright 2014-2015 Boxkite Inc.
+
+# This file is part of the DataCats package and is released under
+# the terms of the GNU Affero General Public License version 3.0.
+# See LICENSE.txt or http://www.fsf.org/licensing/licenses/agpl-3.0.html
+
+"""
+Timing of Docker API calls for "datacats --profile". Nothing is recorded
+until enable() is called.
+"""
+
+import json
+import time
+from collections import Iterator
+from functools import wraps
+from threading import Lock, current_thread
+
+# [(category, name, target, start, seconds, size, thread id)] when enabled
+_spans = None
+_started = None
+_lock = Lock()
+
+
+def enable():
+    global _spans, _started
+    _spans = []
+    _started = time.time()
+
+
+def disable():
+    global _spans
+    _spans = None
+
+
+def enabled():
+    return _spans is not None
+
+
+def record(category, name, target, start, seconds, size=None):
+    """
+    Record a call to name (on target, a container or image) that started
+    at start and took seconds, returning size bytes
+    """
+    if _spans is None:
+        return
+    with _lock:
+        _spans.append((category, name, target, start, seconds, size,
+                       current_thread().ident))
+
+
+def spans():
+    """
+    Return the calls recorded so far as dicts, in the order they started
+    """
+    return [dict(zip(('category', 'name', 'target', 'start', 'seconds',
+                      'size', 'thread'), s))
+            for s in sorted(_spans or (), key=lambda s: s[3])]
+
+
+def _target(args, kwargs):
+    target = args[0] if args else (kwargs.get('container') or kwargs.get('image'))
+    if isinstance(target, dict):
+        target = target.get('Id')
+    if isinstance(target, basestring):
+        return target[:12] if len(target) == 64 else target
+    return None
+
+
+def _size(result):
+    if isinstance(result, basestring):
+        return len(result)
+    if isinstance(result, (dict, list)):
+        # about the size of the JSON it was decoded from
+        try:
+            return len(json.dumps(result))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def _traced_generator(category, name, target, start, generator):
+    # streaming calls aren't finished until their output has been read
+    size = 0
+    try:
+        for chunk in generator:
+            size += _size(chunk) or 0
+            yield chunk
+    finally:
+        record(category, name, target, start, time.time() - start, size)
+
+
+def _call(category, name, fn, args, kwargs):
+    start = time.time()
+    target = _target(args, kwargs)
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        record(category, name, target, start, time.time() - start)
+        raise
+    if isinstance(result, Iterator):
+        return _traced_generator(category, name, target, start, result)
+    record(category, name, target, start, time.time() - start, _size(result))
+    return result
+
+
+def traced(fn):
+    """
+    Decorator recording calls to fn when tracing is enabled
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _spans is None:
+            return fn(*args, **kwargs)
+        return _call('datacats', fn.__name__, fn, args, kwargs)
+    return wrapper
+
+
+class TracedClient(object):
+    """
+    Wraps a docker-py Client to record every method call made on it
+    """
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return _call('docker', name, attr, args, kwargs)
+        return call
+
+
+def chrome_trace():
+    """
+    Return the recorded calls in Chrome's trace event format, for
+    chrome://tracing or other trace viewers
+    """
+    events = []
+    for s in spans():
+        args = {}
+        if s['target']:
+            args['target'] = s['target']
+        if s['size'] is not None:
+            args['bytes'] = s['size']
+        events.append({
+            'name': s['name'],
+            'cat': s['category'],
+            'ph': 'X',
+            'ts': int((s['start'] - _started) * 1e6),
+            'dur': int(s['seconds'] * 1e6),
+            'pid': 1,
+            'tid': s['thread'],
+            'args': args,
+            })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_trace(filename):
+    with open(filename, 'w') as f:
+        json.dump(chrome_trace(), f)
+
+
+def summary(slowest=10):
+    """
+    Return a table of the slowest Docker API calls and the number of
+    calls and time taken by each kind of call
+    """
+    api = [s for s in spans() if s['category'] == 'docker']
+    lines = ['Slowest Docker API calls:',
+             '  {0:>9}  {1:>10}  {2:<20} {3}'.format('ms', 'bytes', 'call', 'target')]
+    for s in sorted(api, key=lambda s: -s['seconds'])[:slowest]:
+        lines.append('  {0:>9.1f}  {1:>10}  {2:<20} {3}'.format(
+            s['seconds'] * 1000, '' if s['size'] is None else s['size'],
+            s['name'], s['target'] or ''))
+
+    totals = {}
+    for s in spans():
+        key = (s['category'], s['name'])
+        count, seconds = totals.get(key, (0, 0))
+        totals[key] = (count + 1, seconds + s['seconds'])
+    lines += ['', 'Calls:',
+              '  {0:>6}  {1:>10}  {2}'.format('count', 'total ms', 'call')]
+    for (category, name), (count, seconds) in sorted(
+            totals.iteritems(), key=lambda t: -t[1][1]):
+        lines.append('  {0:>6}  {1:>10.1f}  {2}'.format(
+            count, seconds * 1000,
+            name if category == 'docker' else '{0} ({1})'.format(name, category)))
+    return '\n'.join(lines)
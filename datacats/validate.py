@@ -8,13 +8,15 @@ import re
 
 NAME_RE = r'[a-z][a-z0-9]*$'
 DATACATS_NAME_RE = r'[a-z][a-z0-9]{4,}$'
+# directories in ~/.datacats that aren't environments
+RESERVED_NAMES = ('cache',)
 
 
 def valid_name(n):
     """
     Return True for environment names that may be used locally
     """
-    return bool(re.match(NAME_RE, n))
+    return bool(re.match(NAME_RE, n)) and n not in RESERVED_NAMES
 
 
 def valid_deploy_name(n):
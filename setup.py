@@ -39,6 +39,9 @@ setup(
         'datacats.cli',
         ],
     install_requires=install_requires,
+    extras_require={
+        'scandir': ['scandir'],  # faster pyc cleaning on python 2
+        },
     include_package_data=True,
     test_suite='datacats.tests',
     zip_safe=False,